@@ -0,0 +1,62 @@
+"""
+bootstrap.py: the __main__ of the mqsubmit zipapp built by bundle.sh
+
+mqsubmit and its modules are imported from the zipapp itself. Its dependencies (boto3, botocore and theirs,
+precompiled) are under lib/ in the zipapp, but botocore reads its API models from files, so they are extracted to
+~/.cache/mqsubmit/<build> the first time one of them is imported and used from there after that. mqsubmit imports
+boto3 only once a command talks to AWS, so --help, argument errors and --plan never extract anything.
+"""
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import zipfile
+
+# Where the dependencies are in the zipapp, and the file listing the build and the packages under it
+libFolder = "lib"
+buildFile = "BUILD"
+cacheRoot = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'mqsubmit')
+
+
+class Dependencies(object):
+    """
+    A meta path finder that finds nothing itself: the first import of one of the bundled packages extracts them and
+    puts their folder on sys.path, where the normal import machinery then finds them
+    """
+    def __init__(self, bundle):
+        self.bundle = bundle
+        build = __loader__.get_data(os.path.join(bundle, buildFile)).decode('utf-8').split()
+        self.folder = os.path.join(cacheRoot, build[0])
+        self.packages = set(build[1:])
+
+    def find_spec(self, name, path=None, target=None):
+        if name.split('.')[0] in self.packages and self.folder not in sys.path:
+            self.extract()
+            sys.path.insert(1, self.folder)
+        return None
+
+    def extract(self):
+        """
+        Extract lib/ into the cache, under a temporary name first so that a concurrent mqsubmit never sees half of it
+        """
+        if os.path.isdir(self.folder):
+            return
+        if not os.path.isdir(cacheRoot):
+            os.makedirs(cacheRoot)
+        tmp = tempfile.mkdtemp(prefix='extract-', dir=cacheRoot)
+        try:
+            with zipfile.ZipFile(self.bundle) as archive:
+                archive.extractall(tmp, [n for n in archive.namelist() if n.startswith(libFolder + "/")])
+            try:
+                os.rename(os.path.join(tmp, libFolder), self.folder)
+            except OSError:
+                # another mqsubmit extracted the same build first
+                if not os.path.isdir(self.folder):
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+sys.meta_path.insert(0, Dependencies(__loader__.archive))
+runpy.run_module('mqsubmit', run_name='__main__')
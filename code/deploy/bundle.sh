@@ -1,8 +1,28 @@
 #!/bin/bash
-cp mqsubmit.py __main__.py
-zip mqsubmit.zip __main__.py > /dev/null 2>&1
-echo '#!/usr/bin/python' > mqsubmit.pex
-cat mqsubmit.zip >> mqsubmit.pex
-rm __main__.py mqsubmit.zip
-chmod 755 mqsubmit.pex
-echo "mqsubmit.pex has been created"
+# Builds mqsubmit.pyz, a zipapp of mqsubmit with its pinned dependencies (requirements-bundle.txt), everything
+# precompiled, that runs without "module load". Build it with the Python it will run with (PYTHON, default python3);
+# INTERPRETER sets its #! line.
+set -e
+deploy=$(cd "$(dirname "$0")" && pwd)
+code=$(dirname "$deploy")
+python=${PYTHON:-python3}
+build=$(mktemp -d)
+trap 'rm -rf "$build"' EXIT
+
+$python -m pip install --quiet --no-deps --no-compile --target "$build/lib" -r "$deploy/requirements-bundle.txt"
+rm -rf "$build/lib/bin"
+(cd "$code" && cp mqcheck.py mqfetch.py mqmetrics.py mqpar.py mqshard.py mqstatus.py mqsubmit.py "$build")
+cp "$deploy/bootstrap.py" "$build/__main__.py"
+
+# Hash-based .pyc files stay valid after the dependencies are extracted with new file times; the zipapp's own modules
+# get theirs next to the source, where zipimport looks for them
+$python -m compileall -q --invalidation-mode unchecked-hash "$build/lib"
+$python -m compileall -q -b --invalidation-mode unchecked-hash "$build"/*.py
+
+# The build (a hash of the dependencies) and the packages the bootstrap extracts on first import
+id=$(cd "$build/lib" && find . -type f -not -name '*.pyc' | sort | xargs sha256sum | sha256sum | cut -c1-16)
+(echo "$id"; ls "$build/lib" | grep -v -e '\.dist-info$' -e '\.egg-info$' -e '^__pycache__$' | sed 's/\.py$//') > "$build/BUILD"
+
+rm -f mqsubmit.pyz
+$python -m zipapp "$build" -o mqsubmit.pyz -p "${INTERPRETER:-/usr/bin/env python3}" -c
+echo "mqsubmit.pyz has been created"
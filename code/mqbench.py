@@ -0,0 +1,699 @@
+#!/usr/bin/env python
+"""
+mqbench.py: benchmarks the mqsubmit submit path offline
+
+Runs the real submit code (adjustConfig, checkfiles, getDataSize, checkJobAlreadyExists, uploadS3 and the job server
+launch, plus the pre-flight scan) on a synthetic job against a local S3/EC2 stand-in instead of AWS, and appends the
+wall time, peak RSS and throughput of every stage to a results file so that revisions can be compared.
+
+    mqbench.py run [options]                       benchmark the submit path, append the results
+    mqbench.py startup [options]                   time mqsubmit's start-up for every subcommand, append the results
+    mqbench.py compare [options] <results file>    compare two runs stage by stage, exit 1 on a regression
+
+The stand-in is moto (pip install moto), either in this process or, with --endpoint-url, a moto server (or any other
+S3/EC2 emulator) in a process of its own, which keeps the emulator's memory out of the RSS numbers. Synthetic jobs are
+generated once per size and kept in the work directory: N Thermo RAW look-alike files of S MB each (the mqpar.xml
+lists every one of them) and a FASTA file of F MB.
+
+The start-up benchmark runs mqsubmit (mqsubmit.py, or the zipapp deploy/bundle.sh builds) in a new process for each
+command that needs no AWS (--help of every subcommand, an argument error, --plan) and records the wall time and
+whether boto3 was imported (the peak RSS of a child process isn't known, a forked child starts with this one's).
+"""
+
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+# mqsubmit keeps its hash and image caches under the home directory; the benchmark gets a home of its own so that it
+# neither uses nor changes the caches of the person running it, and can start each repeat with cold caches
+benchHome = tempfile.mkdtemp(prefix='mqbench-home-')
+os.environ['HOME'] = benchHome
+os.environ['USERPROFILE'] = benchHome
+
+import mqsubmit
+
+
+# The account moto pretends to be, so the instance profile ARN mqsubmit launches job servers with resolves
+benchAccount = "458818213009"
+benchRegion = "us-west-2"
+# Synthetic job sizes: number of raw files, MB per raw file, MB of FASTA
+presets = {
+    'small': {'files': 20, 'size': 8, 'fasta': 16},
+    'many-files': {'files': 2000, 'size': 1, 'fasta': 16},
+    'large-files': {'files': 8, 'size': 512, 'fasta': 16},
+    'large-fasta': {'files': 4, 'size': 8, 'fasta': 2048},
+}
+defaultPreset = 'small'
+defaultResults = "mqbench-results.jsonl"
+# A stage is only a regression if it got slower by this much (percent of the median) and by more than noiseFloor seconds
+defaultThreshold = 10
+noiseFloor = 0.05
+# Seconds between samples of the resident set size
+rssInterval = 0.01
+# The mqsubmit command lines 'startup' times ({mqconfig} is the synthetic job's mqpar.xml), after the bare interpreter
+startupCases = [
+    ('help', ['--help']),
+    ('missingArguments', []),
+    ('plan', ['--plan', '-m', '{mqconfig}', '-n', 'startup', '-d', 'mqbench', '-e', 'mqbench@example.org']),
+    ('bakeHelp', ['bake', '--help']),
+    ('batchHelp', ['batch', '--help']),
+    ('fetchHelp', ['fetch', '--help']),
+    ('metricsHelp', ['metrics', '--help']),
+    ('statusHelp', ['status', '--help']),
+]
+startupJob = {'files': 4, 'size': 1, 'fasta': 1}
+
+
+def currentRss():
+    """
+    The resident set size of this process in bytes (Linux); elsewhere the peak so far is the best there is
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RssMonitor(object):
+    """
+    Samples the resident set size in the background while a stage runs and keeps the peak. Worker processes (the
+    pre-flight scan's process pool) are not included.
+    """
+    def __init__(self):
+        self.peak = currentRss()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+
+    def sample(self):
+        while not self.done.wait(rssInterval):
+            self.peak = max(self.peak, currentRss())
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, currentRss())
+        return self.peak
+
+
+class Emulator(object):
+    """
+    The local S3/EC2 stand-in. Every repeat starts from an empty in-process moto; an emulator at an endpoint URL is
+    shared by the repeats, which use job folders of their own.
+    """
+    def __init__(self, endpoint=None):
+        self.endpoint = endpoint
+        self.mocks = []
+
+    def describe(self):
+        try:
+            import moto
+            version = moto.__version__
+        except ImportError:
+            version = None
+        if self.endpoint:
+            return "emulator at {0}".format(self.endpoint)
+        return "moto {0} in-process".format(version)
+
+    def start(self):
+        """
+        Point mqsubmit's shared AWS clients at the stand-in
+        """
+        if not self.endpoint:
+            os.environ['MOTO_ACCOUNT_ID'] = benchAccount
+            os.environ['AWS_ACCESS_KEY_ID'] = 'mqbench'
+            os.environ['AWS_SECRET_ACCESS_KEY'] = 'mqbench'
+            os.environ.pop('AWS_SESSION_TOKEN', None)
+            self.mocks = motoMocks()
+            for mock in self.mocks:
+                mock.start()
+        mqsubmit.loadAws()
+        mqsubmit.awsClients.clear()
+        mqsubmit.awsSession = None
+        if self.endpoint:
+            os.environ.setdefault('AWS_ACCESS_KEY_ID', 'mqbench')
+            os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'mqbench')
+            mqsubmit.awsSession = mqsubmit.boto3.session.Session()
+            for service in ['s3', 'ec2']:
+                mqsubmit.awsClients[(service, benchRegion)] = mqsubmit.awsSession.client(service, region_name=benchRegion,
+                    endpoint_url=self.endpoint, config=mqsubmit.botocore.config.Config(max_pool_connections=mqsubmit.awsPoolSize))
+
+    def client(self, service):
+        mqsubmit.loadAws()
+        if (service, benchRegion) in mqsubmit.awsClients:
+            return mqsubmit.awsClients[(service, benchRegion)]
+        if self.endpoint:
+            return mqsubmit.boto3.client(service, region_name=benchRegion, endpoint_url=self.endpoint)
+        return mqsubmit.boto3.client(service, region_name=benchRegion)
+
+    def setup(self, stockImage):
+        """
+        Create what the submit path expects to find: the buckets, the job server instance profile and a network for
+        the job servers. The fixed subnet and security group mqsubmit launches into are swapped for the emulator's.
+        Returns the image the job servers are started from, as (AMI ID, baked).
+        """
+        s3 = self.client('s3')
+        existing = [b['Name'] for b in s3.list_buckets().get('Buckets', [])]
+        for bucket in [mqsubmit.jobsBucket, mqsubmit.imageBucket]:
+            if bucket not in existing:
+                s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': benchRegion})
+        iam = self.client('iam')
+        try:
+            iam.create_instance_profile(InstanceProfileName='maxquant')
+        except iam.exceptions.EntityAlreadyExistsException:
+            pass
+
+        ec2 = mqsubmit.awsClient('ec2', benchRegion)
+        vpc = ec2.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+        subnet = ec2.create_subnet(VpcId=vpc, CidrBlock='10.0.0.0/24')['Subnet']['SubnetId']
+        group = ec2.create_security_group(GroupName="mqbench-{0}".format(vpc), Description='mqbench', VpcId=vpc)['GroupId']
+
+        def network(params, **kwargs):
+            params['SubnetId'] = subnet
+            params['SecurityGroupIds'] = [group]
+        ec2.meta.events.register('provide-client-params.ec2.RunInstances', network)
+
+        images = ec2.describe_images(Owners=['amazon']).get('Images') or ec2.describe_images().get('Images')
+        if images:
+            imageId = images[0]['ImageId']
+        else:
+            instanceId = ec2.run_instances(ImageId='ami-12345678', MinCount=1, MaxCount=1)['Instances'][0]['InstanceId']
+            imageId = ec2.create_image(InstanceId=instanceId, Name='mqbench')['ImageId']
+        return imageId, not stockImage
+
+    def stop(self):
+        for mock in reversed(self.mocks):
+            mock.stop()
+        self.mocks = []
+
+
+def motoMocks():
+    """
+    moto's S3, EC2 and IAM mocks (one mock for all of them in moto 5)
+    """
+    try:
+        from moto import mock_aws
+        return [mock_aws()]
+    except ImportError:
+        pass
+    try:
+        from moto import mock_s3, mock_ec2, mock_iam
+    except ImportError:
+        print("The benchmark needs moto (pip install moto), or an S3/EC2 emulator given with --endpoint-url")
+        sys.exit(1)
+    return [mock_s3(), mock_ec2(), mock_iam()]
+
+
+def writeRawFile(path, size, block, nonce):
+    """
+    A Thermo RAW look-alike: the file signature, a per-file nonce (so the blob store sees distinct files) and then
+    random data up to the size
+    """
+    with open(path, 'wb') as fh:
+        header = mqsubmit.mqcheck.thermoMagic + nonce
+        fh.write(header)
+        left = size - len(header)
+        while left > 0:
+            fh.write(block[:left])
+            left -= len(block)
+
+
+def writeFasta(path, size, rng):
+    """
+    A FASTA file of about the size with UniProt style headers (unique identifiers for the default parse rule) and
+    random protein sequences
+    """
+    residues = "ACDEFGHIKLMNPQRSTVWY"
+    pool = "".join(rng.choice(residues) for n in range(1 << 16))
+    written, number = 0, 0
+    with open(path, 'w') as fh:
+        while written < size:
+            entries = []
+            for n in range(1000):
+                number += 1
+                start = rng.randrange(len(pool) - 1200)
+                sequence = pool[start:start + rng.randrange(100, 1200)]
+                lines = [sequence[i:i + 60] for i in range(0, len(sequence), 60)]
+                entries.append(">sp|B{0:08d}|BENCH{0}_HUMAN Synthetic protein {0} OS=Homo sapiens\n{1}\n".format(number, "\n".join(lines)))
+            chunk = "".join(entries)
+            fh.write(chunk)
+            written += len(chunk)
+
+
+def writeConfig(path, datafiles, fasta):
+    """
+    An mqpar.xml as the MaxQuant GUI writes it, listing every raw file (Windows paths on the machine it was made on)
+    """
+    root = ET.Element('MaxQuantParams')
+    info = ET.SubElement(ET.SubElement(root, 'fastaFiles'), 'FastaFileInfo')
+    ET.SubElement(info, 'fastaFilePath').text = "X:\\fast\\bench\\job\\{0}".format(fasta)
+    ET.SubElement(info, 'identifierParseRule').text = mqsubmit.mqcheck.defaultIdentifierRule
+    ET.SubElement(info, 'descriptionParseRule').text = '>(.*)'
+    ET.SubElement(root, 'numThreads').text = '1'
+    ET.SubElement(root, 'matchBetweenRuns').text = 'True'
+    perFile = [('filePaths', 'string', lambda f: "X:\\fast\\bench\\job\\{0}".format(f)), ('experiments', 'string', lambda f: ''),
+        ('fractions', 'short', lambda f: '32767'), ('ptms', 'boolean', lambda f: 'False'), ('paramGroupIndices', 'int', lambda f: '0')]
+    for name, kind, value in perFile:
+        element = ET.SubElement(root, name)
+        for f in datafiles:
+            ET.SubElement(element, kind).text = value(f)
+    mods = ET.SubElement(ET.SubElement(ET.SubElement(root, 'parameterGroups'), 'parameterGroup'), 'variableModifications')
+    for mod in ['Oxidation (M)', 'Acetyl (Protein N-term)']:
+        ET.SubElement(mods, 'string').text = mod
+    ET.ElementTree(root).write(path, encoding='utf-8', xml_declaration=True)
+
+
+def makeJob(workDir, files, size, fasta, seed):
+    """
+    Generate the synthetic job in the work directory, unless it is already there. Returns the job directory and the
+    path of the pristine mqpar.xml (copied to the job's mqpar.xml every repeat).
+    """
+    spec = {'files': files, 'size': size, 'fasta': fasta, 'seed': seed}
+    jobDir = os.path.join(workDir, "job-{files}x{size}MB-fasta{fasta}MB-seed{seed}".format(**spec))
+    marker = os.path.join(jobDir, 'job.json')
+    template = os.path.join(jobDir, 'mqpar.template.xml')
+    if os.path.isfile(marker):
+        return jobDir, template
+
+    sys.stdout.write("Generating a synthetic job in {0}...".format(jobDir))
+    sys.stdout.flush()
+    started = time.time()
+    if os.path.isdir(jobDir):
+        shutil.rmtree(jobDir)
+    os.makedirs(jobDir)
+    rng = random.Random(seed)
+    block = bytes(bytearray(rng.getrandbits(8) for n in range(1 << 20)))
+    datafiles = ["bench-{0:05d}.raw".format(n) for n in range(1, files + 1)]
+    for n, name in enumerate(datafiles):
+        writeRawFile(os.path.join(jobDir, name), size * 1024 * 1024, block, "{0:016d}".format(n).encode('ascii'))
+    writeFasta(os.path.join(jobDir, 'bench.fasta'), fasta * 1024 * 1024, rng)
+    writeConfig(template, datafiles, 'bench.fasta')
+    with open(marker, 'w') as fh:
+        json.dump(spec, fh)
+    print(" Done in {0}".format(mqsubmit.formatDuration(time.time() - started)))
+    return jobDir, template
+
+
+def revision():
+    """
+    The git revision of the code being benchmarked, marked '+' if the working tree has changes
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, stderr=subprocess.STDOUT).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here, stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return rev + ("+" if dirty else "")
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def runStage(name, fn, quiet):
+    """
+    Run one stage of the submit path: its wall time and the peak RSS of this process while it ran. mqsubmit's
+    progress output is dropped unless --verbose.
+    """
+    monitor = RssMonitor().start()
+    stdout = sys.stdout
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    started = time.time()
+    try:
+        fn()
+    except SystemExit:
+        sys.stdout = stdout
+        print("\nThe {0} stage exited; rerun with --verbose to see why".format(name))
+        raise
+    finally:
+        seconds = time.time() - started
+        if quiet and sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+        peak = monitor.stop()
+    return seconds, peak
+
+
+def runRepeat(parms, emulator, jobDir, template, repeat):
+    """
+    One pass through the submit path on a fresh copy of the job. Returns [(stage, seconds, peak RSS, bytes, files)]
+    in stage order and the seconds of each phase mqsubmit's own telemetry recorded.
+    """
+    if not parms.warm:
+        shutil.rmtree(os.path.join(benchHome, '.mqsubmit'), ignore_errors=True)
+    emulator.start()
+    try:
+        image = emulator.setup(parms.stockImage)
+        mqconfig = os.path.join(jobDir, 'mqpar.xml')
+        shutil.copy(template, mqconfig)
+        jobName = "bench{0}r{1}".format(int(time.time()), repeat)
+        mqparams = mqsubmit.jobParams(parms, jobName, 'mqbench', 'mqbench@example.org', jobDir=jobDir)
+        mqparams['progress'] = False
+        mqparams['image'] = image
+        jobFolder = "{0}-{1}".format(mqparams['department'], mqparams['jobName'])
+        mqBucket = mqsubmit.jobsBucket
+        state = {}
+
+        def adjust():
+            state['datafiles'], state['fastas'] = mqsubmit.adjustConfig(mqconfig, mqsubmit.jobServerDir, mqparams)
+
+        def paths():
+            return [mqsubmit.jobPath(mqparams, f) for f in state['datafiles'] + state['fastas']]
+
+        stages = []
+        if parms.preflight:
+            stages.append(('preflight', lambda: mqsubmit.preflight(mqconfig, mqparams), 'input'))
+        stages.extend([
+            ('adjustConfig', adjust, 'config'),
+            ('checkfiles', lambda: mqsubmit.checkfiles(paths()), 'stat'),
+            ('getDataSize', lambda: mqsubmit.getDataSize([mqsubmit.jobPath(mqparams, f) for f in state['datafiles']]), 'data'),
+            ('checkJobAlreadyExists', lambda: mqsubmit.checkJobAlreadyExists(mqBucket, jobFolder), None),
+            ('uploadS3', lambda: mqsubmit.uploadS3(mqBucket, jobFolder, mqparams, mqconfig, mqsubmit.TransferJournal()), 'input'),
+            ('startWorker', lambda: mqsubmit.startJobWorkers(mqBucket, mqparams, mqsubmit.TransferJournal()), None),
+        ])
+
+        results = []
+        for name, fn, volume in stages:
+            configBytes = os.path.getsize(mqconfig)
+            seconds, peak = runStage(name, fn, not parms.verbose)
+            if volume == 'config':
+                nbytes, nfiles = configBytes, 1
+            elif volume == 'data':
+                nbytes, nfiles = 0, len(state['datafiles'])
+            elif volume == 'stat':
+                nbytes, nfiles = 0, len(paths())
+            elif volume == 'input':
+                inputs = paths() if 'datafiles' in state else [os.path.join(jobDir, f) for f in os.listdir(jobDir) if f.endswith(('.raw', '.fasta'))]
+                nbytes, nfiles = sum(os.path.getsize(f) for f in inputs), len(inputs)
+            else:
+                nbytes, nfiles = 0, 0
+            results.append((name, seconds, peak, nbytes, nfiles))
+
+        phases = {}
+        for phase in mqparams['metrics'].data()['phases']:
+            phases[phase['phase']] = phases.get(phase['phase'], 0) + phase['seconds']
+        return results, phases
+    finally:
+        emulator.stop()
+
+
+def formatSeconds(seconds):
+    """
+    Stage time for the tables: milliseconds below a second
+    """
+    if seconds < 1:
+        return "{0:.1f}ms".format(seconds * 1000)
+    return "{0:.3f}s".format(seconds)
+
+
+def formatRate(stage):
+    """
+    Throughput of a stage for the table: MB/s for stages that move or read data, files/s for the ones that only look at
+    the files
+    """
+    if stage['bytes'] and stage['median'] > 0:
+        return "{0}/s".format(mqsubmit.formatBytes(stage['bytes'] / stage['median']))
+    if stage['files'] and stage['median'] > 0:
+        return "{0:.0f} files/s".format(stage['files'] / stage['median'])
+    return "-"
+
+
+def formatRss(stage):
+    """
+    Peak RSS for the tables ("-" for the start-up runs, which don't measure it)
+    """
+    return mqsubmit.formatBytes(stage['peakRss']) if stage['peakRss'] else "-"
+
+
+def runCommand(argv):
+    """
+    mqbench.py run: benchmark the submit path on a synthetic job and append the results to the results file
+    """
+    p = optparse.OptionParser(usage="%prog run [options]")
+    p.add_option('--preset',  action='store', type='choice', choices=sorted(presets), dest='preset', help='[OPTIONAL] Synthetic job size: {0} (default: {1})'.format(", ".join(sorted(presets)), defaultPreset))
+    p.add_option('--files',  action='store', type='int', dest='files', help='[OPTIONAL] Number of raw files (and mqpar.xml filePaths entries)')
+    p.add_option('--size',  action='store', type='int', dest='size', help='[OPTIONAL] MB per raw file')
+    p.add_option('--fasta',  action='store', type='int', dest='fasta', help='[OPTIONAL] MB of FASTA')
+    p.add_option('--seed',  action='store', type='int', dest='seed', help='[OPTIONAL] Random seed of the synthetic job (default: 1)')
+    p.add_option('--repeats',  action='store', type='int', dest='repeats', help='[OPTIONAL] Number of passes through the submit path (default: 3)')
+    p.add_option('--warm',  action='store_true', dest='warm', help='[OPTIONAL] Keep the hash and image caches between repeats')
+    p.add_option('--endpoint-url',  action='store', type='string', dest='endpoint', help='[OPTIONAL] Use the S3/EC2 emulator at this URL instead of moto in this process')
+    p.add_option('--workdir',  action='store', type='string', dest='workdir', help='[OPTIONAL] Where synthetic jobs are generated and kept (default: {0})'.format(os.path.join(tempfile.gettempdir(), 'mqbench')))
+    p.add_option('--results',  action='store', type='string', dest='results', help='[OPTIONAL] Results file to append to (default: {0})'.format(defaultResults))
+    p.add_option('--label',  action='store', type='string', dest='label', help='[OPTIONAL] A note stored with the results')
+    p.add_option('-v', '--verbose',  action='store_true', dest='verbose', help='[OPTIONAL] Show the output of mqsubmit')
+    mqsubmit.addSubmitOptions(p)
+    p.set_defaults(preset=defaultPreset, seed=1, repeats=3, warm=False, workdir=os.path.join(tempfile.gettempdir(), 'mqbench'),
+        results=defaultResults, verbose=False)
+    parms, args = p.parse_args(argv)
+    job = dict(presets[parms.preset])
+    for name in ['files', 'size', 'fasta']:
+        if getattr(parms, name) is not None:
+            job[name] = max(getattr(parms, name), 1)
+    parms.repeats = max(parms.repeats, 1)
+
+    jobDir, template = makeJob(parms.workdir, job['files'], job['size'], job['fasta'], parms.seed)
+    mqsubmit.configureAws(max(parms.uploadWorkers, 1) * max(parms.partWorkers, 1) + 10)
+    emulator = Emulator(parms.endpoint)
+
+    print("Benchmarking revision {0} against {1}: {2} raw file(s) of {3}MB and {4}MB of FASTA, {5} repeat(s)".format(revision(),
+        emulator.describe(), job['files'], job['size'], job['fasta'], parms.repeats))
+    passes = []
+    try:
+        for repeat in range(1, parms.repeats + 1):
+            sys.stdout.write("\tRepeat {0}...".format(repeat))
+            sys.stdout.flush()
+            started = time.time()
+            passes.append(runRepeat(parms, emulator, jobDir, template, repeat))
+            print(" Done in {0}".format(mqsubmit.formatDuration(time.time() - started)))
+    finally:
+        mqsubmit.time = time
+        shutil.rmtree(benchHome, ignore_errors=True)
+
+    stages = {}
+    order = []
+    for results, phases in passes:
+        for name, seconds, peak, nbytes, nfiles in results:
+            if name not in stages:
+                order.append(name)
+                stages[name] = {'seconds': [], 'peakRss': 0, 'bytes': nbytes, 'files': nfiles}
+            stages[name]['seconds'].append(seconds)
+            stages[name]['peakRss'] = max(stages[name]['peakRss'], peak)
+    for stage in stages.values():
+        stage['median'] = median(stage['seconds'])
+        stage['min'] = min(stage['seconds'])
+        stage['throughput'] = stage['bytes'] / stage['median'] if stage['median'] > 0 else None
+    phaseNames = set(name for results, phases in passes for name in phases)
+    phases = dict((name, median([p.get(name, 0) for r, p in passes])) for name in phaseNames)
+
+    options = dict((name, getattr(parms, name)) for name in ['uploadWorkers', 'partSize', 'partWorkers', 'dedup', 'compress',
+        'preflight', 'shards', 'stockImage', 'planner', 'warm', 'market'])
+    record = {'revision': revision(), 'label': parms.label, 'date': time.strftime("%Y-%m-%dT%H:%M:%S"), 'host': platform.node(),
+        'python': platform.python_version(), 'boto3': mqsubmit.boto3.__version__, 'emulator': emulator.describe(),
+        'job': dict(job, seed=parms.seed), 'options': options, 'repeats': parms.repeats,
+        'stages': [dict(stages[name], stage=name) for name in order], 'phases': phases}
+    with open(parms.results, 'a') as fh:
+        fh.write(json.dumps(record, sort_keys=True) + "\n")
+
+    columns = "{0:<22} {1:>9} {2:>9} {3:>9} {4:>10} {5:>16}"
+    print("\n" + columns.format("Stage", "Median", "Min", "Max", "Peak RSS", "Throughput"))
+    for name in order:
+        stage = stages[name]
+        print(columns.format(name, formatSeconds(stage['median']), formatSeconds(stage['min']), formatSeconds(max(stage['seconds'])),
+            mqsubmit.formatBytes(stage['peakRss']), formatRate(stage)))
+    total = sum(stage['median'] for stage in stages.values())
+    print(columns.format("Total", formatSeconds(total), "", "", "", ""))
+    print("\nResults appended to {0}".format(parms.results))
+
+
+def timeProcess(command, cwd):
+    """
+    Run a command to the end with its output dropped: its wall time and its exit status
+    """
+    with open(os.devnull, 'w') as devnull:
+        started = time.time()
+        status = subprocess.call(command, cwd=cwd, stdout=devnull, stderr=devnull)
+    return time.time() - started, status
+
+
+def importsAws(command, cwd):
+    """
+    Whether a command imports boto3 or botocore, from the interpreter's -X importtime report
+    """
+    child = subprocess.Popen(command[:1] + ['-X', 'importtime'] + command[1:], cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = child.communicate()
+    modules = [line.rsplit('|', 1)[-1].strip() for line in err.decode('utf-8', 'replace').splitlines() if line.startswith('import time:')]
+    return any(m.split('.')[0] in ('boto3', 'botocore') for m in modules)
+
+
+def startupCommand(argv):
+    """
+    mqbench.py startup: time mqsubmit's start-up, each command in a new process, and append the results to the
+    results file (compare them like the submit path's)
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    p = optparse.OptionParser(usage="%prog startup [options]")
+    p.add_option('--bundle',  action='store', type='string', dest='bundle', help='[OPTIONAL] Time this mqsubmit zipapp (built by deploy/bundle.sh) instead of mqsubmit.py')
+    p.add_option('--python',  action='store', type='string', dest='python', help='[OPTIONAL] Python interpreter to run mqsubmit with (default: this one)')
+    p.add_option('--repeats',  action='store', type='int', dest='repeats', help='[OPTIONAL] Number of runs of each command (default: 5)')
+    p.add_option('--workdir',  action='store', type='string', dest='workdir', help='[OPTIONAL] Where the synthetic job for --plan is generated and kept (default: {0})'.format(os.path.join(tempfile.gettempdir(), 'mqbench')))
+    p.add_option('--results',  action='store', type='string', dest='results', help='[OPTIONAL] Results file to append to (default: {0})'.format(defaultResults))
+    p.add_option('--label',  action='store', type='string', dest='label', help='[OPTIONAL] A note stored with the results')
+    p.set_defaults(python=sys.executable, repeats=5, workdir=os.path.join(tempfile.gettempdir(), 'mqbench'), results=defaultResults)
+    parms, args = p.parse_args(argv)
+    parms.repeats = max(parms.repeats, 1)
+    target = os.path.abspath(parms.bundle) if parms.bundle else os.path.join(here, 'mqsubmit.py')
+    if not os.path.isfile(target):
+        p.error("Can't find {0}".format(target))
+
+    jobDir, template = makeJob(parms.workdir, startupJob['files'], startupJob['size'], startupJob['fasta'], 1)
+    mqconfig = os.path.join(jobDir, 'mqpar.xml')
+    cases = [('interpreter', [parms.python, '-c', 'pass'])]
+    cases.extend((name, [parms.python, target] + [a.format(mqconfig=mqconfig) for a in args]) for name, args in startupCases)
+
+    print("Timing the start-up of {0} (revision {1}) with {2}, {3} run(s) per command".format(os.path.basename(target), revision(),
+        parms.python, parms.repeats))
+    stages = []
+    try:
+        for name, command in cases:
+            shutil.copy(template, mqconfig)
+            runs = [timeProcess(command, jobDir) for n in range(parms.repeats)]
+            stages.append({'stage': name, 'seconds': [r[0] for r in runs], 'median': median([r[0] for r in runs]),
+                'min': min(r[0] for r in runs), 'peakRss': 0, 'exit': runs[-1][1],
+                'aws': importsAws(command, jobDir), 'bytes': 0, 'files': 0, 'throughput': None})
+    finally:
+        shutil.rmtree(benchHome, ignore_errors=True)
+
+    record = {'revision': revision(), 'label': parms.label, 'date': time.strftime("%Y-%m-%dT%H:%M:%S"), 'host': platform.node(),
+        'python': subprocess.check_output([parms.python, '-c', 'import platform; print(platform.python_version())']).decode().strip(),
+        'emulator': 'none', 'job': {'startup': os.path.basename(target)}, 'options': {}, 'repeats': parms.repeats,
+        'stages': stages, 'phases': {}}
+    with open(parms.results, 'a') as fh:
+        fh.write(json.dumps(record, sort_keys=True) + "\n")
+
+    columns = "{0:<18} {1:>9} {2:>9} {3:>9} {4:>5} {5:>6}"
+    print("\n" + columns.format("Command", "Median", "Min", "Max", "Exit", "boto3"))
+    for stage in stages:
+        print(columns.format(stage['stage'], formatSeconds(stage['median']), formatSeconds(stage['min']), formatSeconds(max(stage['seconds'])),
+            stage['exit'], "yes" if stage['aws'] else "no"))
+    print("\nResults appended to {0}".format(parms.results))
+
+
+def loadResults(path):
+    """
+    The runs recorded in a results file, oldest first
+    """
+    runs = []
+    with open(path) as fh:
+        for line in fh:
+            if line.strip():
+                runs.append(json.loads(line))
+    return runs
+
+
+def sameSetup(a, b):
+    """
+    Two runs can be compared if they benchmarked the same job with the same options against the same kind of emulator.
+    An option only one of them records (it was added or removed in between) is left out.
+    """
+    options = [name for name in a['options'] if name in b['options']]
+    return (a['job'] == b['job'] and all(a['options'][name] == b['options'][name] for name in options)
+        and a['emulator'].split(' ')[0] == b['emulator'].split(' ')[0])
+
+
+def pickRun(runs, ref):
+    """
+    A run by position (-1 is the latest) or by revision (the latest run of it)
+    """
+    try:
+        return runs[int(ref)]
+    except (ValueError, IndexError):
+        pass
+    for run in reversed(runs):
+        if run['revision'].startswith(ref) or run.get('label') == ref:
+            return run
+    print("There is no run '{0}' in the results file".format(ref))
+    sys.exit(1)
+
+
+def compareCommand(argv):
+    """
+    mqbench.py compare: compare the stages of two runs (by default the latest run and the one before it with the same
+    job and options); exits 1 if a stage got slower by more than the threshold
+    """
+    p = optparse.OptionParser(usage="%prog compare [options] <results file> [<before> [<after>]]\n\nRuns are given by revision, label or position (-1 is the latest)")
+    p.add_option('--threshold',  action='store', type='float', dest='threshold', help='[OPTIONAL] Percent slower that counts as a regression (default: {0})'.format(defaultThreshold))
+    p.set_defaults(threshold=defaultThreshold)
+    parms, args = p.parse_args(argv)
+    if not 1 <= len(args) <= 3:
+        p.error("A results file is required")
+    runs = loadResults(args[0])
+    if not runs:
+        print("The results file has no runs")
+        sys.exit(1)
+
+    after = pickRun(runs, args[2]) if len(args) == 3 else runs[-1]
+    if len(args) >= 2:
+        before = pickRun(runs, args[1])
+    else:
+        earlier = [run for run in runs[:runs.index(after)] if sameSetup(run, after)]
+        if not earlier:
+            print("There is no earlier run of the same job and options to compare the latest run with")
+            sys.exit(1)
+        before = earlier[-1]
+    if not sameSetup(before, after):
+        print("Warning: the runs benchmarked different jobs, options or emulators")
+
+    print("Comparing {0} ({1}) with {2} ({3})".format(before['revision'], before['date'], after['revision'], after['date']))
+    columns = "{0:<22} {1:>9} {2:>9} {3:>8} {4:>10} {5:>10}"
+    print("\n" + columns.format("Stage", "Before", "After", "Change", "RSS before", "RSS after"))
+    beforeStages = dict((stage['stage'], stage) for stage in before['stages'])
+    regressions = []
+    for stage in after['stages']:
+        name = stage['stage']
+        old = beforeStages.get(name)
+        if old is None:
+            print(columns.format(name, "-", formatSeconds(stage['median']), "new", "-", formatRss(stage)))
+            continue
+        change = 100.0 * (stage['median'] - old['median']) / old['median'] if old['median'] > 0 else 0
+        flag = ""
+        if change > parms.threshold and stage['median'] - old['median'] > noiseFloor:
+            regressions.append(name)
+            flag = " <-- slower"
+        print(columns.format(name, formatSeconds(old['median']), formatSeconds(stage['median']), "{0:+.0f}%".format(change),
+            formatRss(old), formatRss(stage)) + flag)
+    if regressions:
+        print("\n{0} stage(s) more than {1:g}% slower: {2}".format(len(regressions), parms.threshold, ", ".join(regressions)))
+        sys.exit(1)
+    print("\nNo stage is more than {0:g}% slower".format(parms.threshold))
+
+
+if __name__ == "__main__":
+
+    subcommands = {'run': runCommand, 'startup': startupCommand, 'compare': compareCommand}
+    if len(sys.argv) < 2 or sys.argv[1] not in subcommands:
+        print("usage: mqbench.py run [options]\n       mqbench.py startup [options]\n       mqbench.py compare [options] <results file> [<before> [<after>]]")
+        sys.exit(1)
+    subcommands[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,210 @@
+"""
+mqcheck.py: pre-flight scan of the input files of a MaxQuant job
+
+Every data and FASTA file is scanned before anything is uploaded or a job server is started, so a truncated mzXML or a
+FASTA that MaxQuant can't parse is caught in seconds instead of hours into a billed job. The files are scanned in a
+process pool; big files are memory-mapped rather than read. Each scan returns the problems found (which stop the
+submit), warnings and per-file stats (scans, sequences, residues) that the instance planner can use.
+"""
+import mmap
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Files at least this big are memory-mapped instead of read into memory
+mmapThreshold = 32 * 1024 * 1024
+# How much of the end of a file holds the closing tags and the mzXML index offset
+tailSize = 64 * 1024
+# MaxQuant's default identifierParseRule
+defaultIdentifierRule = r'>([^\s]*)'
+# Thermo RAW files start with "Finnigan" in UTF-16 after a two byte marker
+thermoMagic = b'\x01\xa1' + u'Finnigan'.encode('utf-16-le')
+# Report at most this many examples of a problem
+maxExamples = 5
+
+
+def openData(path):
+    """
+    The contents of a file as a bytes-like object: memory-mapped for big files, read for small ones. Returns the data
+    and the open file (None if the file was read) that has to be closed once the data is no longer used.
+    """
+    size = os.path.getsize(path)
+    fh = open(path, 'rb')
+    if size >= mmapThreshold:
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ), fh
+    try:
+        return fh.read(), None
+    finally:
+        fh.close()
+
+
+def scanMzXML(data, result):
+    """
+    mzXML: the closing tags are there, the index offset and every scan offset in the index point at what they should,
+    and the number of scans matches what the run declares
+    """
+    tail = data[-tailSize:]
+    if not tail.rstrip().endswith(b'</mzXML>'):
+        result['problems'].append("does not end with </mzXML> (truncated?)")
+    if data.rfind(b'</msRun>') == -1:
+        result['problems'].append("has no </msRun> closing tag (truncated?)")
+
+    scans = None
+    m = re.search(br'<indexOffset>\s*(\d+)\s*</indexOffset>', tail)
+    if m:
+        indexOffset = int(m.group(1))
+        if data[indexOffset:indexOffset + 6] != b'<index':
+            result['problems'].append("index offset {0} does not point at the index".format(indexOffset))
+        else:
+            scans, bad = 0, []
+            for offset in re.finditer(br'<offset id="(\d+)"\s*>\s*(\d+)\s*</offset>', data[indexOffset:]):
+                scans += 1
+                position = int(offset.group(2))
+                if data[position:position + 5] != b'<scan':
+                    bad.append(offset.group(1).decode('ascii'))
+            if bad:
+                result['problems'].append("{0} index offset(s) don't point at their scan (scan {1})".format(len(bad), ", ".join(bad[:maxExamples])))
+            result['stats']['indexed'] = True
+    if scans is None:
+        scans = sum(1 for scan in re.finditer(br'<scan\s', data))
+        result['stats']['indexed'] = False
+    result['stats']['scans'] = scans
+
+    declared = re.search(br'<msRun[^>]*\sscanCount="(\d+)"', data[:tailSize])
+    if declared and int(declared.group(1)) != scans:
+        result['problems'].append("declares {0} scans but has {1}".format(int(declared.group(1)), scans))
+    if scans == 0:
+        result['problems'].append("has no scans")
+
+
+def scanMzML(data, result):
+    """
+    mzML: the closing tags are there and the spectra are counted
+    """
+    tail = data[-tailSize:].rstrip()
+    if not (tail.endswith(b'</mzML>') or tail.endswith(b'</indexedmzML>')):
+        result['problems'].append("does not end with </mzML> or </indexedmzML> (truncated?)")
+    spectra = sum(1 for spectrum in re.finditer(br'<spectrum\s', data))
+    result['stats']['scans'] = spectra
+    if spectra == 0:
+        result['problems'].append("has no spectra")
+
+
+def scanRaw(header, result):
+    """
+    Thermo RAW: binary, so only the file signature is checked
+    """
+    if header[:len(thermoMagic)] != thermoMagic:
+        result['problems'].append("is not a Thermo RAW file (bad file signature)")
+
+
+def iterLines(data):
+    """
+    The lines of the data, streamed from a memory-mapped file
+    """
+    if isinstance(data, mmap.mmap):
+        return iter(data.readline, b'')
+    return iter(data.splitlines())
+
+
+def scanFasta(data, result, rule):
+    """
+    FASTA: every header yields an identifier with the configuration's identifierParseRule, identifiers are unique and
+    every entry has a sequence. Counts the sequences and residues.
+    """
+    try:
+        identifier = re.compile(rule.encode('utf-8'))
+    except re.error:
+        identifier = None
+        result['warnings'].append("identifierParseRule '{0}' can't be checked here".format(rule))
+
+    sequences, residues, longest, current = 0, 0, 0, None
+    seen, unparsed, duplicates, empty, orphan = set(), [], [], [], False
+    lineNumber = 0
+    for line in iterLines(data):
+        lineNumber += 1
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(b'>'):
+            if current is not None and current[1] == 0:
+                empty.append(current[0])
+            sequences += 1
+            current = [lineNumber, 0]
+            if identifier is not None:
+                # like MaxQuant (.NET Regex.Match), the rule may match anywhere in the header
+                m = identifier.search(line)
+                name = m.group(1) if m and m.groups() else None
+                if not name:
+                    unparsed.append(lineNumber)
+                elif name in seen:
+                    duplicates.append(lineNumber)
+                else:
+                    seen.add(name)
+        elif current is None:
+            orphan = True
+        else:
+            current[1] += len(line)
+            residues += len(line)
+            longest = max(longest, current[1])
+    if current is not None and current[1] == 0:
+        empty.append(current[0])
+
+    if orphan:
+        result['problems'].append("has sequence data before the first header")
+    if unparsed:
+        result['problems'].append("{0} header(s) don't give an identifier with '{1}' (line {2})".format(len(unparsed), rule,
+            ", ".join(str(n) for n in unparsed[:maxExamples])))
+    if duplicates:
+        result['warnings'].append("{0} duplicate identifier(s) (line {1})".format(len(duplicates), ", ".join(str(n) for n in duplicates[:maxExamples])))
+    if empty:
+        result['warnings'].append("{0} header(s) without a sequence (line {1})".format(len(empty), ", ".join(str(n) for n in empty[:maxExamples])))
+    if sequences == 0:
+        result['problems'].append("has no sequences")
+    result['stats'].update({'sequences': sequences, 'residues': residues, 'longest': longest})
+
+
+scanners = {'.mzxml': scanMzXML, '.mzml': scanMzML}
+fastaExtensions = ['.fasta', '.fa', '.faa']
+
+
+def scanFile(path, rule=None):
+    """
+    Scan one input file. Returns {'file', 'problems', 'warnings', 'stats', 'seconds'}.
+    """
+    started = time.time()
+    result = {'file': path, 'problems': [], 'warnings': [], 'stats': {}}
+    extension = os.path.splitext(path)[1].lower()
+    if not os.path.isfile(path):
+        result['problems'].append("was not found")
+    elif os.path.getsize(path) == 0:
+        result['problems'].append("is empty")
+    elif extension == '.raw':
+        with open(path, 'rb') as fh:
+            scanRaw(fh.read(len(thermoMagic)), result)
+    elif extension in scanners or extension in fastaExtensions:
+        data, fh = openData(path)
+        try:
+            if extension in fastaExtensions:
+                scanFasta(data, result, rule or defaultIdentifierRule)
+            else:
+                scanners[extension](data, result)
+        finally:
+            if fh is not None:
+                data.close()
+                fh.close()
+    result['seconds'] = time.time() - started
+    return result
+
+
+def scanFiles(files, workers=None):
+    """
+    Scan a list of (path, identifierParseRule or None) in a process pool. Returns the results in the same order.
+    """
+    if not files:
+        return []
+    workers = max(min(workers or multiprocessing.cpu_count(), len(files)), 1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(scanFile, [f for f, rule in files], [rule for f, rule in files]))
@@ -0,0 +1,245 @@
+"""
+mqfetch.py: selective retrieval of MaxQuant job results
+
+The job server uploads the 'combined' folder of a finished job as one zip bundle,
+maxquant-<job folder>-results-combined.zip, and the parts of it named by the job's --unzipped policy file by file
+under <job folder>/combined/. 'mqsubmit fetch' downloads only the files asked for: from the combined/ prefix when they
+are there, otherwise single members of the bundle, found by reading the zip's central directory with range requests. This module has no AWS code: it picks the files, reads zip structures through a
+readRange(start, end) function, checks what was downloaded (S3 ETags, zip CRC-32s) and keeps the journal that lets an
+interrupted fetch pick up where it stopped; mqsubmit does the rest.
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import struct
+import threading
+import zlib
+
+# S3 prefix (under the job folder) of the job's combined folder, and the results bundle next to it
+combinedPrefix = "combined"
+resultsBundle = "maxquant-{0}-results-combined.zip"
+# Objects (and zip members) are downloaded in ranges of this many bytes, several at a time
+rangeSize = 8 * 1024 * 1024
+# Read and checked in pieces of this many bytes
+readSize = 1024 * 1024
+# The end of central directory record is at most this far from the end of a zip (22 bytes + a 64KB comment)
+tailSize = 22 + 65535 + 20
+
+# Zip record signatures and layouts (APPNOTE.TXT 4.3)
+endSignature = b'PK\x05\x06'
+endStruct = struct.Struct('<4sHHHHIIH')
+zip64LocatorSignature = b'PK\x06\x07'
+zip64LocatorStruct = struct.Struct('<4sIQI')
+zip64EndSignature = b'PK\x06\x06'
+zip64EndStruct = struct.Struct('<4sQHHIIQQQQ')
+centralSignature = b'PK\x01\x02'
+centralStruct = struct.Struct('<4sHHHHHHIIIHHHHHII')
+localSignature = b'PK\x03\x04'
+localStruct = struct.Struct('<4sHHHHHIIIHH')
+zip64Extra = 0x0001
+# Compression methods the bundle can use (.NET's ZipFile deflates, very small files are stored)
+stored, deflated = 0, 8
+
+
+def selected(name, only):
+    """
+    True if the file (its path relative to combined/, e.g. txt/proteinGroups.txt) was asked for: no selection means
+    everything, otherwise a name matches a selection that is the same path, a folder it is in or a glob pattern
+    """
+    if not only:
+        return True
+    for pattern in only:
+        pattern = pattern.replace('\\', '/').strip('/')
+        if name == pattern or name.startswith(pattern + '/') or fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+def ranges(start, length):
+    """
+    Split length bytes from start into download ranges: a list of (start, end) with end exclusive
+    """
+    return [(offset, min(offset + rangeSize, start + length)) for offset in range(start, start + length, rangeSize)] or [(start, start)]
+
+
+def endOfCentralDirectory(readRange, size):
+    """
+    Find the central directory of a zip of the given size: returns (offset, size, entries). Zip64 bundles (over 4GB
+    or 65535 files) keep the real values in a zip64 record the tail points to.
+    """
+    tailStart = max(size - tailSize, 0)
+    tail = readRange(tailStart, size)
+    at = tail.rfind(endSignature)
+    if at < 0 or at + endStruct.size > len(tail):
+        raise ValueError("not a zip file (no end of central directory record)")
+    end = endStruct.unpack_from(tail, at)
+    entries, cdSize, cdOffset = end[4], end[5], end[6]
+    if 0xFFFFFFFF in (cdSize, cdOffset) or entries == 0xFFFF:
+        locator = at - zip64LocatorStruct.size
+        if locator < 0 or tail[locator:locator + 4] != zip64LocatorSignature:
+            raise ValueError("zip64 end of central directory locator not found")
+        zip64Offset = zip64LocatorStruct.unpack_from(tail, locator)[2]
+        record = readRange(zip64Offset, zip64Offset + zip64EndStruct.size)
+        if record[:4] != zip64EndSignature:
+            raise ValueError("zip64 end of central directory record not found")
+        zip64End = zip64EndStruct.unpack(record)
+        entries, cdSize, cdOffset = zip64End[7], zip64End[8], zip64End[9]
+    return cdOffset, cdSize, entries
+
+
+def zipMembers(readRange, size):
+    """
+    The files in a zip, read from its central directory with two or three range reads whatever the size of the zip:
+    a list of {'name', 'method', 'crc', 'compressedSize', 'size', 'headerOffset'}. Names use / and folders are left
+    out; .NET on Windows may have written \\ separators.
+    """
+    cdOffset, cdSize, entries = endOfCentralDirectory(readRange, size)
+    directory = readRange(cdOffset, cdOffset + cdSize)
+    members = []
+    at = 0
+    for n in range(entries):
+        header = centralStruct.unpack_from(directory, at)
+        if header[0] != centralSignature:
+            raise ValueError("corrupt central directory (entry {0})".format(n + 1))
+        flags, method, crc, compressedSize, fileSize = header[3], header[4], header[7], header[8], header[9]
+        nameLength, extraLength, commentLength, headerOffset = header[10], header[11], header[12], header[16]
+        at += centralStruct.size
+        name = directory[at:at + nameLength].decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = directory[at + nameLength:at + nameLength + extraLength]
+        at += nameLength + extraLength + commentLength
+        # zip64 sizes and offset, in this order, for the fields that are 0xFFFFFFFF
+        fields = {'size': fileSize, 'compressedSize': compressedSize, 'headerOffset': headerOffset}
+        e = 0
+        while e + 4 <= len(extra):
+            tag, length = struct.unpack_from('<HH', extra, e)
+            if tag == zip64Extra:
+                values = struct.unpack_from('<{0}Q'.format(length // 8), extra, e + 4)
+                big = [f for f in ('size', 'compressedSize', 'headerOffset') if fields[f] == 0xFFFFFFFF]
+                fields.update(zip(big, values))
+            e += 4 + length
+        name = name.replace('\\', '/')
+        if name.endswith('/'):
+            continue
+        members.append(dict(fields, name=name, method=method, crc=crc))
+    return members
+
+
+def memberDataOffset(readRange, member):
+    """
+    Where a member's (compressed) data starts: after its local header, whose extra field may differ from the
+    central directory's
+    """
+    header = readRange(member['headerOffset'], member['headerOffset'] + localStruct.size)
+    local = localStruct.unpack(header)
+    if local[0] != localSignature:
+        raise ValueError("local file header not found in the results bundle")
+    return member['headerOffset'] + localStruct.size + local[9] + local[10]
+
+
+def inflate(source, target, member):
+    """
+    Decompress a member's data (downloaded to the source file) into the target file, checking its size and CRC-32.
+    Raises ValueError if either is wrong.
+    """
+    if member['method'] not in (stored, deflated):
+        raise ValueError("unsupported compression method {0}".format(member['method']))
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if member['method'] == deflated else None
+    crc, size = 0, 0
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        while True:
+            chunk = src.read(readSize)
+            if not chunk:
+                break
+            data = decompressor.decompress(chunk) if decompressor else chunk
+            crc, size = zlib.crc32(data, crc), size + len(data)
+            dst.write(data)
+        if decompressor:
+            data = decompressor.flush()
+            crc, size = zlib.crc32(data, crc), size + len(data)
+            dst.write(data)
+    if size != member['size'] or (crc & 0xFFFFFFFF) != member['crc']:
+        raise ValueError("CRC-32 or size does not match the zip's central directory")
+
+
+def etagMatches(path, etag, partSize=None):
+    """
+    Check a downloaded file against its S3 ETag: the MD5 of the object, or for a multipart upload the MD5 of the
+    parts' MD5s followed by -<parts>, which needs the part size. Returns None if it can't be checked.
+    """
+    etag = etag.strip('"')
+    if '-' not in etag:
+        digest = hashlib.md5()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(readSize), b''):
+                digest.update(chunk)
+        return digest.hexdigest() == etag
+    if not partSize:
+        return None
+    digests = []
+    with open(path, 'rb') as fh:
+        while True:
+            part, left = hashlib.md5(), partSize
+            while left:
+                chunk = fh.read(min(readSize, left))
+                if not chunk:
+                    break
+                part.update(chunk)
+                left -= len(chunk)
+            if left == partSize:
+                break
+            digests.append(part.digest())
+            if left:
+                break
+    return "{0}-{1}".format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests)) == etag
+
+
+class FetchJournal(object):
+    """
+    A JSON file kept in the destination folder that records, for every file being fetched, where it comes from (key,
+    ETag and zip member), the ranges that are already downloaded and whether it is complete and checked. It is saved
+    after every change; a file whose source has changed since (the results were uploaded again) starts over.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {'files': {}}
+        if os.path.isfile(path):
+            with open(path) as fh:
+                self.data.update(json.load(fh))
+
+    def save(self):
+        """
+        Atomically rewrite the journal file (the caller must hold the lock)
+        """
+        tmp = "{0}.tmp".format(self.path)
+        with open(tmp, 'w') as fh:
+            json.dump(self.data, fh, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def entry(self, name, source):
+        """
+        The journal entry of a file, started afresh unless it was for the same source
+        """
+        with self.lock:
+            entry = self.data['files'].get(name)
+            if entry is None or entry['source'] != source:
+                entry = self.data['files'][name] = {'source': source, 'ranges': [], 'done': False}
+                self.save()
+            return entry
+
+    def rangeDone(self, name, start):
+        with self.lock:
+            self.data['files'][name]['ranges'].append(start)
+            self.save()
+
+    def fileDone(self, name):
+        with self.lock:
+            entry = self.data['files'][name]
+            entry['done'], entry['ranges'] = True, []
+            self.save()
+
+    def reset(self, name):
+        with self.lock:
+            self.data['files'][name].update({'ranges': [], 'done': False})
+            self.save()
@@ -0,0 +1,151 @@
+"""
+mqmetrics.py: phase timing telemetry for MaxQuant jobs
+
+mqsubmit times each phase of a submit (config rewrite, file checks, every upload, image lookup, instance creation and
+tagging) and stores the phases as JSON in the job folder, jobCtrl/metrics/submit.json. The job servers write a list of
+timestamped marks as they go (boot, software install, download, MaxQuant run, results upload, zip), each phase
+running until the next mark, to jobCtrl/metrics/<server>.json. This module keeps the timings and merges the two sides
+into one timeline (and many timelines into per-phase statistics); it has no AWS code, mqsubmit does the rest.
+"""
+import contextlib
+import threading
+import time
+
+# S3 prefix (under the job folder) of the timelines
+metricsPrefix = "jobCtrl/metrics"
+# The submit side's timeline in it; the job servers write worker.json (and shard-N.json for the shards of a job)
+submitSide = "submit"
+# Worker marks that end the timeline rather than start a phase
+finalMarks = ['shutdown', 'failed']
+
+
+class PhaseTimer(object):
+    """
+    Thread safe record of the phases of a submit: name, start and end (seconds since the epoch) and any details
+    (file, bytes, instance...) given for the phase
+    """
+    def __init__(self, **info):
+        self.info = info
+        self.phases = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name, **details):
+        """
+        Time the body of a with statement as a phase. The details dict is yielded so that more can be added to it
+        from inside; a phase that raises is recorded as failed.
+        """
+        started = time.time()
+        try:
+            yield details
+        except BaseException:
+            details['failed'] = True
+            raise
+        finally:
+            self.record(name, started, time.time(), **details)
+
+    def record(self, name, started, ended, **details):
+        """
+        Record a phase that was timed elsewhere
+        """
+        entry = dict(details, phase=name, start=started, end=ended, seconds=ended - started)
+        with self.lock:
+            self.phases.append(entry)
+
+    def data(self):
+        """
+        The timeline as a JSON serializable dict
+        """
+        with self.lock:
+            phases = sorted(self.phases, key=lambda p: p['start'])
+        return {'side': submitSide, 'started': self.started, 'finished': time.time(), 'info': self.info, 'phases': phases}
+
+
+def markPhases(marks):
+    """
+    Turn the marks written by a job server ([{'phase': name, 'time': seconds}, ...]) into phases: each mark starts a
+    phase that ends at the next mark; a final mark (shutdown, failed) is kept as a phase of no length
+    """
+    marks = sorted(marks, key=lambda m: m['time'])
+    phases = []
+    for n, mark in enumerate(marks):
+        if n + 1 < len(marks) and mark['phase'] not in finalMarks:
+            ended = marks[n + 1]['time']
+        else:
+            ended = mark['time']
+        phases.append({'phase': mark['phase'], 'start': mark['time'], 'end': ended, 'seconds': ended - mark['time']})
+    return phases
+
+
+def sidePhases(side, data):
+    """
+    The phases of one side's timeline: the submit side's phases as they are, a job server's marks turned into phases
+    """
+    if isinstance(data, dict) and 'phases' in data:
+        return data['phases']
+    # PowerShell writes a list of one mark as just the mark
+    if isinstance(data, dict):
+        data = [data]
+    return markPhases(data)
+
+
+def timeline(sides):
+    """
+    Merge the timelines of a job ({side: submit.json dict or list of worker marks}) into one list of phases ordered by
+    start, each with its side and its offset (seconds) from the start of the earliest one. The clocks of the submit
+    host and the job servers are not synchronized, so offsets across sides are good to a few seconds.
+    """
+    merged = []
+    for side, data in sides.items():
+        for p in sidePhases(side, data):
+            merged.append(dict(p, side=side))
+    merged.sort(key=lambda p: (p['start'], p['end']))
+    if merged:
+        origin = merged[0]['start']
+        for p in merged:
+            p['offset'] = p['start'] - origin
+    return merged
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a list of numbers
+    """
+    values = sorted(values)
+    rank = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def aggregate(timelines):
+    """
+    Per-phase statistics over the merged timelines of many jobs ({job folder: timeline}). Phases that occur several
+    times in a job (one upload per file) are summed for the job first. Servers of the same kind (the shards of a job)
+    are grouped under one side. Returns a list of {'side', 'phase', 'jobs', 'mean', 'median', 'p90', 'max', 'total'}
+    ordered by side and by when the phase usually starts, with a 'total' phase per side for its wall time.
+    """
+    perJob = {}
+    firstOffset = {}
+    for job, phases in timelines.items():
+        seconds, spans = {}, {}
+        for p in phases:
+            side = p['side'].split('-')[0]
+            seconds[(side, p['phase'])] = seconds.get((side, p['phase']), 0) + p['seconds']
+            firstOffset.setdefault((side, p['phase']), []).append(p.get('offset', 0))
+            started, ended = spans.get(side, (p['start'], p['end']))
+            spans[side] = (min(started, p['start']), max(ended, p['end']))
+        for side, (started, ended) in spans.items():
+            seconds[(side, 'total')] = ended - started
+        for key, value in seconds.items():
+            perJob.setdefault(key, []).append(value)
+
+    def order(key):
+        side, phase = key
+        return (side != submitSide, side, phase == 'total', percentile(firstOffset.get(key, [0]), 0.5))
+
+    stats = []
+    for key in sorted(perJob, key=order):
+        values = perJob[key]
+        stats.append({'side': key[0], 'phase': key[1], 'jobs': len(values), 'mean': sum(values) / len(values),
+            'median': percentile(values, 0.5), 'p90': percentile(values, 0.9), 'max': max(values), 'total': sum(values)})
+    return stats
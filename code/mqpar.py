@@ -0,0 +1,221 @@
+"""
+mqpar.py: streaming reader and rewriter for MaxQuant configuration files (mqpar.xml)
+
+The configuration of a large TMT/DIA experiment lists thousands of raw files, several per-file lists of the same length,
+so it is never held in memory as a tree. readConfig makes one iterparse pass that collects the file inventory and the
+settings the instance planner needs. writeConfig streams the configuration into a new file for the job server: file
+paths pointing at the job directory, the planned number of threads and (for a shard) only some of the raw files, with
+Windows (CRLF) line endings. Both drop each element as soon as it has been dealt with; the user's file is only read.
+"""
+import os
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+
+# Where the data and FASTA file paths are, relative to the root element. Starting in MaxQuant version 1.6.10.43 (or at
+# least noticed then), the xml file contains a different structure for describing the fasta file(s).
+# In previous versions it's like:
+#
+#    <fastaFiles>
+#       <string>c:\mq-job\UP000005640_9606_human.fasta</string>
+#    </fastaFiles>
+#
+# Now it's like this:
+#
+#    <fastaFiles>
+#        <FastaFileInfo>
+#            <fastaFilePath>C:\mq-job\yeast_orf_trans_all_05-Jan-2010.fasta</fastaFilePath>
+#            <identifierParseRule>>([^\s]*)</identifierParseRule>
+#            ...
+#        </FastaFileInfo>
+#    </fastaFiles>
+dataPath = ('filePaths', 'string')
+fastaPaths = [('fastaFiles', 'string'), ('fastaFiles', 'FastaFileInfo', 'fastaFilePath')]
+fastaRulePath = ('fastaFiles', 'FastaFileInfo', 'identifierParseRule')
+threadsPath = ('numThreads',)
+# Output is written to the file in pieces of about this many characters
+writeBuffer = 64 * 1024
+
+
+def fileName(path):
+    """
+    The file name of a (Windows) path in the configuration
+    """
+    return (path or '').split('\\')[-1].strip()
+
+
+def readConfig(mqconfig):
+    """
+    Read the file inventory and the planner settings of a configuration in one pass: the data files and FASTA files
+    (file names, in order), the identifierParseRule of each FASTA file (None for the old layout, which has none), the
+    number of entries of each top-level list and the settings that drive how much CPU and memory the job needs.
+    """
+    inventory = {'path': mqconfig, 'datafiles': [], 'fastaFiles': [], 'fastaRules': {}, 'counts': {}}
+    variableMods, mbr = 0, None
+    stack, mods, fasta = [], 0, {}
+    for event, elem in ET.iterparse(mqconfig, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        tags = tuple(e.tag for e in stack[1:]) + (elem.tag,)
+        if tags == dataPath:
+            inventory['datafiles'].append(fileName(elem.text))
+        elif tags == fastaPaths[0]:
+            inventory['fastaFiles'].append(fileName(elem.text))
+        elif tags == fastaPaths[1]:
+            fasta['name'] = fileName(elem.text)
+        elif tags == fastaRulePath:
+            fasta['rule'] = elem.text or None
+        elif tags == fastaPaths[1][:2]:
+            if fasta.get('name'):
+                inventory['fastaFiles'].append(fasta['name'])
+                inventory['fastaRules'][fasta['name']] = fasta.get('rule')
+            fasta = {}
+        elif tags == ('matchBetweenRuns',):
+            mbr = elem.text
+        if elem.tag == 'string' and stack and stack[-1].tag == 'variableModifications':
+            mods += 1
+        elif elem.tag == 'variableModifications':
+            variableMods, mods = max(variableMods, mods), 0
+        if len(tags) == 2:
+            inventory['counts'][tags[0]] = inventory['counts'].get(tags[0], 0) + 1
+        if stack:
+            stack[-1].remove(elem)
+    inventory['settings'] = {
+        'variableModifications': variableMods,
+        'matchBetweenRuns': (mbr or '').strip().lower() == 'true',
+        'parameterGroups': max(inventory['counts'].get('parameterGroups', 0), 1),
+    }
+    return inventory
+
+
+class ConfigWriter(object):
+    """
+    Buffered UTF-8 output with Windows line endings (MaxQuant is a Windows program after all). The file is written
+    under a temporary name and only takes its real name once it is complete.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp = "{0}.{1}.tmp".format(path, os.getpid())
+        self.fh = open(self.tmp, 'wb')
+        self.pieces = []
+        self.size = 0
+
+    def write(self, text):
+        self.pieces.append(text)
+        self.size += len(text)
+        if self.size >= writeBuffer:
+            self.flush()
+
+    def flush(self):
+        self.fh.write(u"".join(self.pieces).replace(u"\n", u"\r\n").encode('utf-8'))
+        self.pieces, self.size = [], 0
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.tmp, self.path)
+
+    def abort(self):
+        self.fh.close()
+        os.remove(self.tmp)
+
+
+def qualifiedName(name, namespaces):
+    """
+    ElementTree's {uri}name back to prefix:name
+    """
+    if name[:1] != '{':
+        return name
+    uri, local = name[1:].split('}', 1)
+    prefix = namespaces.get(uri)
+    return "{0}:{1}".format(prefix, local) if prefix else local
+
+
+def startTag(elem, declarations, namespaces):
+    """
+    The start tag of an element, with its attributes and the namespaces declared on it
+    """
+    attributes = ["xmlns{0}={1}".format(":" + prefix if prefix else "", quoteattr(uri)) for prefix, uri in declarations]
+    for name, value in elem.attrib.items():
+        attributes.append("{0}={1}".format(qualifiedName(name, namespaces), quoteattr(value, {'\n': '&#10;', '\r': '&#13;', '\t': '&#9;'})))
+    return "<{0}>".format(" ".join([qualifiedName(elem.tag, namespaces)] + attributes))
+
+
+def text(value):
+    return escape(value or '', {'\r': '&#13;'})
+
+
+def writeConfig(mqconfig, target, mqdir, threads, keep=None, perFile=()):
+    """
+    Stream the configuration into the target file for the job server: every data and FASTA file path is changed to
+    the file in mqdir and numThreads is set to threads. With keep (a set of raw file indices) the per-file lists named
+    in perFile only keep those entries. Elements are written as soon as their content is known and then dropped, so
+    memory use does not grow with the size of the configuration.
+    """
+    rewrites = dict((path, lambda value: mqdir + fileName(value)) for path in [dataPath] + fastaPaths)
+    rewrites[threadsPath] = lambda value: str(threads)
+    out = ConfigWriter(target)
+    try:
+        out.write(u'<?xml version="1.0" encoding="utf-8"?>\n')
+        # one entry per open element: [element, tags from the root, start tag written, children seen, namespaces declared]
+        stack = []
+        declarations, namespaces = [], {}
+        pendingTail = None
+        skipping = None
+        for event, elem in ET.iterparse(mqconfig, events=('start', 'end', 'start-ns')):
+            if event == 'start-ns':
+                declarations.append(elem)
+                namespaces[elem[1]] = elem[0]
+                continue
+
+            if event == 'start':
+                parent = stack[-1] if stack else None
+                if parent is not None:
+                    parent[3] += 1
+                tags = (parent[1] + (elem.tag,)) if parent is not None else ()
+                if skipping is None and keep is not None and len(tags) == 2 and tags[0] in perFile and parent[3] - 1 not in keep:
+                    skipping = len(stack)
+                if skipping is None and parent is not None:
+                    # the parent's text and the previous sibling's tail are known once a child starts
+                    if not parent[2]:
+                        out.write(startTag(parent[0], parent[4], namespaces) + text(parent[0].text))
+                        parent[2] = True
+                    if pendingTail is not None:
+                        out.write(text(pendingTail.tail))
+                        parent[0].remove(pendingTail)
+                        pendingTail = None
+                stack.append([elem, tags, False, 0, declarations])
+                declarations = []
+                continue
+
+            entry = stack.pop()
+            parent = stack[-1][0] if stack else None
+            if skipping is not None:
+                if len(stack) == skipping:
+                    skipping = None
+                    parent.remove(elem)
+                continue
+            if pendingTail is not None:
+                out.write(text(pendingTail.tail))
+                elem.remove(pendingTail)
+                pendingTail = None
+            if entry[2]:
+                out.write(u"</{0}>".format(qualifiedName(elem.tag, namespaces)))
+            else:
+                value = elem.text
+                if entry[1] in rewrites:
+                    value = rewrites[entry[1]](value)
+                tag = startTag(elem, entry[4], namespaces)
+                if value:
+                    out.write(u"{0}{1}</{2}>".format(tag, text(value), qualifiedName(elem.tag, namespaces)))
+                else:
+                    out.write(tag[:-1] + u" />")
+            pendingTail = elem if parent is not None else None
+        out.write(u"\n")
+    except Exception:
+        out.abort()
+        raise
+    out.close()
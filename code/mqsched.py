@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+"""
+mqsched.py: packs queued MaxQuant jobs onto shared job servers
+
+Jobs submitted with 'mqsubmit --shared' are uploaded as usual and then listed under queue/ in the jobs bucket instead
+of getting a job server of their own. The scheduler packs them (first fit decreasing, by cores and memory, within
+the disk of each server's root volume) onto shared job servers, which run the assigned jobs side by side and shut
+down once the scheduler retires them.
+
+    mqsched.py run -e <email>          schedule the queue in the jobs bucket until interrupted
+    mqsched.py simulate [options]      pack a synthetic queue offline and compare it with one server per job
+
+Scheduler state lives in the jobs bucket:
+    queue/<jobFolder>.json                                  job waiting for a shared job server (written by mqsubmit)
+    scheduler/workers/<workerId>.json                       shared job server: type, capacity and assigned jobs
+    scheduler/workers/<workerId>/assignments/<jobFolder>.json   job the shared job server should run
+    scheduler/workers/<workerId>/retire.txt                 tells an idle shared job server to shut down
+"""
+
+import json
+import optparse
+import random
+import sys
+import time
+
+import mqsubmit
+
+
+# The largest shared job server the scheduler starts; each new server is then shrunk to the smallest type that fits its jobs
+defaultWorkerType = "c5.9xlarge"
+# Seconds a queued job waits for more jobs to share a new job server with
+defaultPackWait = 300
+# Seconds a shared job server sits without jobs before it is retired
+defaultIdleTimeout = 900
+# Memory (GB) kept back on each shared job server for Windows
+workerOsMemory = 2
+# Root volume (GB) of a shared job server for Windows and MaxQuant; the job directories come on top of it
+workerRootDisk = 150
+# Disk (GB) for job directories a new shared job server gets at least, so later jobs fit on it as well
+minWorkerDisk = 200
+workersPrefix = "scheduler/workers"
+# Jobs too big for the largest shared job server type get a server of their own, up to this type
+largestSpec = mqsubmit.instanceSpec("r5.24xlarge")
+
+
+class LocalStore(object):
+    """
+    An in-memory stand-in for the jobs bucket, used by the simulator
+    """
+    def __init__(self):
+        self.objects = {}
+
+    def list(self, prefix):
+        return sorted(key for key in self.objects if key.startswith(prefix))
+
+    def get(self, key):
+        return self.objects.get(key)
+
+    def put(self, key, body):
+        self.objects[key] = body
+
+    def delete(self, key):
+        self.objects.pop(key, None)
+
+
+class S3Store(object):
+    """
+    The jobs bucket
+    """
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.client = mqsubmit.awsClient('s3')
+
+    def list(self, prefix):
+        keys = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+    def get(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read().decode('utf-8')
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def put(self, key, body):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+class EC2Launcher(object):
+    """
+    Starts shared job servers in EC2
+    """
+    def __init__(self, bucket, contact, region='us-west-2', stockImage=False):
+        self.bucket = bucket
+        self.contact = contact
+        self.region = region
+        self.stockImage = stockImage
+
+    def launch(self, worker):
+        securityGroups = ['sg-a2dd8dc6']
+        password = mqsubmit.passwordGen(15)
+        image_id, baked = mqsubmit.workerImage(self.region, worker['maxquantVersion'], self.stockImage)
+        if baked:
+            install = ""
+        else:
+            install = mqsubmit.SoftwareInstallScript.format(maxquantVersion = worker['maxquantVersion'])
+        # All the job directories share the root volume
+        storage = {'volumeSize': worker['volumeSize'], 'volumeType': 'gp3', 'iops': 3000, 'throughput': 250, 'scratch': False}
+        # Jobs submitted with --compress have .gz job files
+        decompress = mqsubmit.DecompressScript.format(jobDir = '$jobDir')
+        # The transfer functions are read from S3, they don't fit in the UserData
+        transferKey = "{0}/{1}/transfer.ps1".format(workersPrefix, worker['id'])
+        mqsubmit.awsClient('s3').put_object(Bucket=self.bucket, Key=transferKey,
+            Body=mqsubmit.TransferScript.format(region = self.region, partSize = mqsubmit.workerPartSize * 1024 * 1024, workers = mqsubmit.workerTransfers, manifest = mqsubmit.manifestKey))
+        transfer = mqsubmit.TransferLoader.format(key = transferKey)
+        UserData = SharedWorkerScript.format(bucket = self.bucket, workerId = worker['id'], password = password, install = install, decompress = decompress, transfer = transfer)
+        tags = {'department': 'shared', 'jobName': worker['id'], 'contactEmail': self.contact}
+        options = mqsubmit.launchOptions(tags, worker['instanceType'], storage)
+        instanceID = mqsubmit.create_ec2worker(self.region, image_id, securityGroups, options, storage, UserData, tags)
+        print("Shared job server {0} ({1}) is instance {2}, Administrator password: {3}".format(worker['id'], worker['instanceType'], instanceID, password))
+        return instanceID
+
+
+class SimLauncher(object):
+    """
+    Pretends to start shared job servers; used by the simulator
+    """
+    def __init__(self):
+        self.launched = []
+
+    def launch(self, worker):
+        self.launched.append(worker['id'])
+        return "i-sim{0:04d}".format(len(self.launched))
+
+
+def workerCapacity(spec):
+    """
+    Cores and memory (GB) a shared job server of the given catalog type has for jobs
+    """
+    return spec['vcpu'], spec['memory'] - workerOsMemory
+
+
+def fitWorkerType(cores, memory, maxSpec):
+    """
+    The smallest catalog type without an instance store (the jobs share the root volume) that fits the given cores and
+    memory, falling back to the largest shared job server type
+    """
+    for spec in sorted(mqsubmit.instanceCatalog, key=lambda s: (s['vcpu'], s['memory'])):
+        if spec['instanceStore'] or spec['vcpu'] > maxSpec['vcpu']:
+            continue
+        vcpu, mem = workerCapacity(spec)
+        if vcpu >= cores and mem >= memory:
+            return spec
+    return maxSpec
+
+
+class Scheduler(object):
+    """
+    Packs queued jobs onto shared job servers. Each tick() frees the capacity of finished jobs, places queued jobs on
+    running servers where they fit, starts new servers for the rest (once they have waited long enough for company, or
+    there are enough of them to fill a server) and retires servers that have been idle too long. A job that needs more
+    cores or memory than the largest type has is failed instead of queued forever.
+    Jobs only share a server with jobs of the same MaxQuant version; jobs with custom databases/modifications files get
+    a server of their own, since MaxQuant reads those from its program directory.
+    """
+    def __init__(self, store, launcher, clock=time.time, workerType=defaultWorkerType, packWait=defaultPackWait, idleTimeout=defaultIdleTimeout):
+        self.store = store
+        self.launcher = launcher
+        self.clock = clock
+        self.maxSpec = mqsubmit.instanceSpec(workerType)
+        self.packWait = packWait
+        self.idleTimeout = idleTimeout
+
+    def workers(self):
+        workers = []
+        for key in self.store.list(workersPrefix + "/"):
+            if key.count('/') == 2 and key.endswith('.json'):
+                workers.append(json.loads(self.store.get(key)))
+        return workers
+
+    def saveWorker(self, worker):
+        self.store.put("{0}/{1}.json".format(workersPrefix, worker['id']), json.dumps(worker))
+
+    def queued(self):
+        return [json.loads(self.store.get(key)) for key in self.store.list(mqsubmit.queuePrefix + "/")]
+
+    def finished(self, jobFolder):
+        return any(self.store.get("{0}/jobCtrl/{1}".format(jobFolder, flag)) is not None for flag in ('done.txt', 'failed.txt'))
+
+    def free(self, worker):
+        """
+        Remaining cores, memory and disk on a shared job server
+        """
+        cores, memory, disk = worker['vcpu'], worker['memory'], worker['disk']
+        for job in worker['jobs'].values():
+            cores -= job['cores']
+            memory -= job['memory']
+            disk -= job['disk']
+        return cores, memory, disk
+
+    def fits(self, worker, job):
+        if worker['exclusive'] or job['customConf'] or worker['maxquantVersion'] != job['maxquantVersion']:
+            return False
+        cores, memory, disk = self.free(worker)
+        # The volume of a running server has the size it was launched with; one still being packed grows with its jobs
+        return cores >= job['cores'] and memory >= job['memory'] and (worker['instanceId'] is None or disk >= job['disk'])
+
+    def assign(self, worker, job):
+        worker['jobs'][job['jobFolder']] = job
+        if worker['instanceId'] is None:
+            worker['disk'] = max(worker['disk'], sum(j['disk'] for j in worker['jobs'].values()))
+        worker['idleSince'] = None
+        self.store.put("{0}/{1}/assignments/{2}.json".format(workersPrefix, worker['id'], job['jobFolder']), json.dumps(job))
+        self.store.put("{0}/jobCtrl/assigned.txt".format(job['jobFolder']), worker['id'])
+        self.store.delete("{0}/{1}.json".format(mqsubmit.queuePrefix, job['jobFolder']))
+
+    def reject(self, job, reason):
+        self.store.put("{0}/jobCtrl/failed.txt".format(job['jobFolder']), reason)
+        self.store.delete("{0}/{1}.json".format(mqsubmit.queuePrefix, job['jobFolder']))
+
+    def newWorker(self, job):
+        # A job too big for the largest shared job server gets a server sized for it
+        spec = self.maxSpec
+        vcpu, memory = workerCapacity(spec)
+        if job['cores'] > vcpu or job['memory'] > memory:
+            spec = fitWorkerType(job['cores'], job['memory'], largestSpec)
+        vcpu, memory = workerCapacity(spec)
+        return {'id': "shared-{0}-{1:04d}".format(time.strftime('%Y%m%d%H%M%S', time.gmtime(self.clock())), random.randint(0, 9999)),
+            'instanceType': spec['type'], 'vcpu': vcpu, 'memory': memory, 'disk': 0, 'maxquantVersion': job['maxquantVersion'],
+            'exclusive': job['customConf'], 'jobs': {}, 'started': self.clock(), 'idleSince': None, 'instanceId': None}
+
+    def tick(self):
+        """
+        One scheduling pass; returns a summary of what it did
+        """
+        now = self.clock()
+        summary = {'finished': 0, 'assigned': 0, 'launched': 0, 'retired': 0, 'waiting': 0, 'rejected': 0}
+        workers = self.workers()
+
+        # Free the capacity of finished jobs and retire servers that have been idle too long
+        for worker in list(workers):
+            for jobFolder in list(worker['jobs']):
+                if self.finished(jobFolder):
+                    del worker['jobs'][jobFolder]
+                    summary['finished'] += 1
+            if not worker['jobs'] and worker['idleSince'] is None:
+                worker['idleSince'] = now
+            if not worker['jobs'] and now - worker['idleSince'] >= self.idleTimeout:
+                self.store.put("{0}/{1}/retire.txt".format(workersPrefix, worker['id']), "retire")
+                self.store.delete("{0}/{1}.json".format(workersPrefix, worker['id']))
+                workers.remove(worker)
+                summary['retired'] += 1
+            else:
+                self.saveWorker(worker)
+
+        # First fit decreasing: the biggest jobs are placed first, on the first server they fit
+        pending = sorted(self.queued(), key=lambda job: (job['cores'], job['memory']), reverse=True)
+        unplaced = []
+        maxCores, maxMemory = workerCapacity(largestSpec)
+        for job in pending:
+            if job['cores'] > maxCores or job['memory'] > maxMemory:
+                self.reject(job, "the job needs {0} cores and {1:.1f}GB of memory, more than the largest job server ({2}: {3} cores, {4:.1f}GB) has".format(
+                    job['cores'], job['memory'], largestSpec['type'], maxCores, maxMemory))
+                summary['rejected'] += 1
+                continue
+            # Best fit: the server the job leaves the fewest cores free on
+            fits = sorted((w for w in workers if self.fits(w, job)), key=lambda w: self.free(w))
+            worker = fits[0] if fits else None
+            if worker is None:
+                unplaced.append(job)
+            else:
+                self.assign(worker, job)
+                self.saveWorker(worker)
+                summary['assigned'] += 1
+
+        # Pack what is left onto new servers, one group per MaxQuant version
+        groups = {}
+        for job in unplaced:
+            groups.setdefault((job['maxquantVersion'], job['customConf']), []).append(job)
+        for (version, customConf), jobs in sorted(groups.items()):
+            oldest = min(job['queued'] for job in jobs)
+            if not customConf and now - oldest < self.packWait and sum(job['cores'] for job in jobs) < self.maxSpec['vcpu']:
+                summary['waiting'] += len(jobs)
+                continue
+            bins = []
+            for job in jobs:
+                worker = next((w for w in bins if self.fits(w, job)), None)
+                if worker is None:
+                    worker = self.newWorker(job)
+                    bins.append(worker)
+                self.assign(worker, job)
+            for worker in bins:
+                # Shrink the server to the smallest type its jobs fit on
+                spec = fitWorkerType(sum(j['cores'] for j in worker['jobs'].values()), sum(j['memory'] for j in worker['jobs'].values()), mqsubmit.instanceSpec(worker['instanceType']))
+                worker['instanceType'] = spec['type']
+                worker['vcpu'], worker['memory'] = workerCapacity(spec)
+                worker['disk'] = max(worker['disk'], minWorkerDisk)
+                worker['volumeSize'] = worker['disk'] + workerRootDisk
+                worker['instanceId'] = self.launcher.launch(worker)
+                self.saveWorker(worker)
+                workers.append(worker)
+                summary['assigned'] += len(worker['jobs'])
+                summary['launched'] += 1
+        return summary
+
+
+def runCommand(argv):
+    """
+    mqsched.py run: schedule the queue in the jobs bucket until interrupted
+    """
+    p = optparse.OptionParser(usage="%prog run [options]")
+    p.add_option('-e', '--email',  action='store', type='string', dest='contact', help='[REQUIRED] Your email address; used to tag the shared job servers')
+    addSchedulerOptions(p)
+    p.add_option('--interval',  action='store', type='int', dest='interval', help='[OPTIONAL] Seconds between scheduling passes (default: 60)')
+    p.add_option('--stock-image',  action='store_true', dest='stockImage', help='[OPTIONAL] Install MaxQuant on a stock Windows image instead of using the pre-built job server image')
+    p.set_defaults(interval=60, stockImage=False)
+    parms, args = p.parse_args(argv)
+    mqsubmit.checkRequiredArguments(parms, p)
+    store = S3Store(mqsubmit.jobsBucket)
+    scheduler = Scheduler(store, EC2Launcher(mqsubmit.jobsBucket, parms.contact.strip(), stockImage=parms.stockImage),
+        workerType=parms.workerType, packWait=parms.packWait, idleTimeout=parms.idleTimeout)
+    print("Scheduling shared MaxQuant jobs in {0} every {1} seconds (Ctrl-C to stop)".format(mqsubmit.jobsBucket, parms.interval))
+    while True:
+        summary = scheduler.tick()
+        if any(summary.values()):
+            print("{0}: {1} finished, {2} assigned, {3} server(s) started, {4} retired, {5} waiting, {6} rejected".format(time.strftime('%Y-%m-%d %H:%M:%S'),
+                summary['finished'], summary['assigned'], summary['launched'], summary['retired'], summary['waiting'], summary['rejected']))
+        time.sleep(parms.interval)
+
+
+def syntheticJobs(count, hours, seed):
+    """
+    A synthetic queue: mostly small jobs, a few big ones (run time growing with size), arriving at random over the given number of hours
+    """
+    rng = random.Random(seed)
+    jobs = []
+    for n in range(count):
+        cores = rng.choice([1, 1, 2, 2, 2, 4, 4, 4, 8, 16])
+        jobs.append({'jobFolder': "sim-job{0:03d}".format(n), 'cores': cores, 'memory': 1.5 + 0.75 * cores, 'disk': 5 * cores,
+            'customConf': rng.random() < 0.05, 'maxquantVersion': mqsubmit.maxquant_ver, 'contactEmail': 'sim@example.org',
+            'queued': rng.uniform(0, hours * 3600), 'runtime': rng.uniform(0.25, 0.5) * cores * 3600})
+    return sorted(jobs, key=lambda job: job['queued'])
+
+
+def simulateCommand(argv):
+    """
+    mqsched.py simulate: pack a synthetic queue offline and compare the vCPU-hours with one job server per job
+    """
+    p = optparse.OptionParser(usage="%prog simulate [options]")
+    p.add_option('--jobs',  action='store', type='int', dest='jobs', help='[OPTIONAL] Number of synthetic jobs (default: 50)')
+    p.add_option('--hours',  action='store', type='float', dest='hours', help='[OPTIONAL] Hours over which the jobs arrive (default: 8)')
+    p.add_option('--boot',  action='store', type='int', dest='boot', help='[OPTIONAL] Seconds a job server takes to start (default: 900)')
+    p.add_option('--seed',  action='store', type='int', dest='seed', help='[OPTIONAL] Random seed (default: 1)')
+    addSchedulerOptions(p)
+    p.set_defaults(jobs=50, hours=8, boot=900, seed=1)
+    parms, args = p.parse_args(argv)
+
+    now = [0.0]
+    store = LocalStore()
+    launcher = SimLauncher()
+    scheduler = Scheduler(store, launcher, clock=lambda: now[0], workerType=parms.workerType, packWait=parms.packWait, idleTimeout=parms.idleTimeout)
+    jobs = syntheticJobs(parms.jobs, parms.hours, parms.seed)
+    arrivals = list(jobs)
+    byFolder = dict((job['jobFolder'], job) for job in jobs)
+    booted = {}     # worker id -> time it is ready to run jobs
+    running = {}    # job folder -> time it finishes
+    waits = []      # seconds each job waited to start
+    servers = {}    # worker id -> [vcpu, launched, retired]
+    step = 60
+    while arrivals or byFolder:
+        while arrivals and arrivals[0]['queued'] <= now[0]:
+            job = arrivals.pop(0)
+            store.put("{0}/{1}.json".format(mqsubmit.queuePrefix, job['jobFolder']), json.dumps(dict((k, v) for k, v in job.items() if k != 'runtime')))
+        for jobFolder, done in list(running.items()):
+            if done <= now[0]:
+                store.put("{0}/jobCtrl/done.txt".format(jobFolder), "done")
+                del running[jobFolder]
+                del byFolder[jobFolder]
+        scheduler.tick()
+        for jobFolder in list(byFolder):
+            if store.get("{0}/jobCtrl/failed.txt".format(jobFolder)) is not None:
+                del byFolder[jobFolder]
+        for worker in scheduler.workers():
+            if worker['id'] not in servers:
+                servers[worker['id']] = [worker['vcpu'], now[0], None]
+                booted[worker['id']] = now[0] + parms.boot
+            for jobFolder in worker['jobs']:
+                if jobFolder not in running and store.get("{0}/jobCtrl/done.txt".format(jobFolder)) is None:
+                    start = max(now[0], booted[worker['id']])
+                    running[jobFolder] = start + byFolder[jobFolder]['runtime']
+                    waits.append(start - byFolder[jobFolder]['queued'])
+        for key in store.list(workersPrefix + "/"):
+            if key.endswith('/retire.txt'):
+                workerId = key.split('/')[2]
+                if servers[workerId][2] is None:
+                    servers[workerId][2] = now[0]
+        now[0] += step
+    for server in servers.values():
+        if server[2] is None:
+            server[2] = now[0]
+
+    shared = sum(vcpu * (retired - launched) for vcpu, launched, retired in servers.values()) / 3600
+    # One server per job: the smallest catalog type with the job's cores and memory, up from boot to the end of the job
+    single = sum(fitWorkerType(job['cores'], job['memory'], largestSpec)['vcpu'] * (parms.boot + job['runtime']) for job in jobs) / 3600
+    print("Simulated {0} job(s) arriving over {1} hours".format(len(jobs), parms.hours))
+    print("\tJob servers started: {0} shared, {1} with one server per job".format(len(launcher.launched), len(jobs)))
+    print("\tvCPU-hours: {0:.1f} shared, {1:.1f} with one server per job ({2:+.0f}%)".format(shared, single, 100 * (shared / single - 1)))
+    print("\tMean wait to start: {0} shared, {1} with one server per job".format(mqsubmit.formatDuration(sum(waits) / len(waits)), mqsubmit.formatDuration(parms.boot)))
+
+
+def addSchedulerOptions(p):
+    """
+    Add the packing options shared by run and simulate
+    """
+    p.add_option('--worker-type',  action='store', type='string', dest='workerType', help='[OPTIONAL] Largest shared job server instance type (default: {0})'.format(defaultWorkerType))
+    p.add_option('--pack-wait',  action='store', type='int', dest='packWait', help='[OPTIONAL] Seconds a queued job waits for others to share a new server with (default: {0})'.format(defaultPackWait))
+    p.add_option('--idle-timeout',  action='store', type='int', dest='idleTimeout', help='[OPTIONAL] Seconds an idle shared job server is kept before it is retired (default: {0})'.format(defaultIdleTimeout))
+    p.set_defaults(workerType=defaultWorkerType, packWait=defaultPackWait, idleTimeout=defaultIdleTimeout)
+
+
+"""
+SharedWorkerScript: The PowerShell script run by a shared job server. It polls its assignments in S3, runs each assigned
+job in its own directory under C:/mq-jobs side by side with the others (a job whose files don't match the checksums
+they were uploaded with is flagged as failed instead), publishes each job's results (and emails its
+owner) as it finishes, and shuts down once it has no running jobs and the scheduler has retired it.
+"""
+SharedWorkerScript = """<powershell>
+$bucket = '{bucket}'
+$workerId = '{workerId}'
+$workerPrefix = "scheduler/workers/$workerId"
+# Set the local Administrator password
+$ComputerName = $env:COMPUTERNAME
+$user = [adsi]"WinNT://$ComputerName/Administrator,user"
+$user.setpassword("{password}")
+# Disable the Windows Firewall
+Get-NetFirewallProfile | Set-NetFirewallProfile Enabled False -Confirm:$false
+Rename-Computer -NewName "maxquant-$workerId" -Force
+Import-Module AwsPowerShell
+{install}{transfer}New-Item -ItemType Directory -Path 'C:/mq-jobs' -Force | Out-Null
+$running = @{{}}
+$contacts = @{{}}
+$unzipped = @{{}}
+while ($true) {{
+foreach ($assignment in Get-S3Object -BucketName $bucket -KeyPrefix "$workerPrefix/assignments/") {{
+$jobFolder = [IO.Path]::GetFileNameWithoutExtension($assignment.Key)
+if ($running.ContainsKey($jobFolder)) {{continue}}
+$jobDir = "C:/mq-jobs/$jobFolder"
+Read-S3Object -BucketName $bucket -Key $assignment.Key -File "$env:TEMP/$jobFolder.json" | Out-Null
+$assigned = Get-Content "$env:TEMP/$jobFolder.json" | ConvertFrom-Json
+$contacts[$jobFolder] = $assigned.contactEmail
+$unzipped[$jobFolder] = @($assigned.unzipped | Where-Object {{$_}})
+Write-Host "Removing ready flag: $jobFolder/jobCtrl/ready.txt"
+Remove-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/ready.txt" -Force
+Write-Host "Adding running flag: $jobFolder/jobCtrl/running.txt"
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/running.txt" -Content "running"
+Write-Host "Downloading job data and configuration from S3: $bucket/$jobFolder"
+if (-not (Receive-S3Prefix $jobFolder $jobDir)) {{
+Write-Host -ForegroundColor Red "Some of the job files of $jobFolder could not be downloaded"
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/failed.txt" -Content "some of the job files could not be downloaded"
+Remove-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/running.txt" -Force
+Remove-S3Object -BucketName $bucket -Key $assignment.Key -Force
+Remove-Item $jobDir -Recurse -Force
+continue
+}}
+{decompress}$badFiles = @(Test-JobFiles $jobDir)
+if ($badFiles.Count -gt 0) {{
+Write-Host -ForegroundColor Red "Job files of $jobFolder do not match what was uploaded: $($badFiles -join ', ')"
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/failed.txt" -Content "the checksums of $($badFiles.Count) job file(s) do not match what was uploaded: $($badFiles -join ', ')"
+Remove-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/running.txt" -Force
+Remove-S3Object -BucketName $bucket -Key $assignment.Key -Force
+Remove-Item $jobDir -Recurse -Force
+continue
+}}
+if (Test-Path "$jobDir/databases.xml") {{Copy-Item "$jobDir/databases.xml" -Destination 'C:/MaxQuant/bin/conf/'}}
+if (Test-Path "$jobDir/modifications.xml") {{Copy-Item "$jobDir/modifications.xml" -Destination 'C:/MaxQuant/bin/conf/'}}
+Write-Host "Starting MaxQuant Job $jobFolder"
+$running[$jobFolder] = Start-Process -FilePath 'C:/MaxQuant/bin/MaxQuantCmd.exe' -ArgumentList "$jobDir/mqpar.xml" -PassThru -NoNewWindow
+}}
+foreach ($jobFolder in @($running.Keys)) {{
+if (-not $running[$jobFolder].HasExited) {{continue}}
+$jobDir = "C:/mq-jobs/$jobFolder"
+$resultsBundleFile = "maxquant-$jobFolder-results-combined.zip"
+Write-Host "Job $jobFolder complete, uploading job results to S3 and zipping them into the results bundle on the way: $jobFolder/$resultsBundleFile"
+if (-not (Send-Results "$jobDir/combined" "$jobFolder/combined" "$jobFolder/$resultsBundleFile" $unzipped[$jobFolder])) {{
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/failed.txt" -Content "the results bundle could not be uploaded"
+}}
+Write-Host "Removing running flag: $jobFolder/jobCtrl/running.txt"
+Remove-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/running.txt" -Force
+Write-Host "Adding done flag: $jobFolder/jobCtrl/done.txt"
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/done.txt" -Content "done"
+Write-Host "Sending $($contacts[$jobFolder]) a link to download the results from S3"
+$resultsURL = Get-Content -path "$jobDir/jobCtrl/resultsUrl.txt"
+$ExpirationDate = (Get-Date).AddDays(30)
+Send-MailMessage -SmtpServer "smtp.fhcrc.org" -From "maxquant-do-not-reply@fredhutch.org" -Body "Your MaxQuant job results are available for download:`n`n$resultsURL`n`nThis link will expire on $ExpirationDate" -Subject "Maxquant Job Results for job: $jobFolder (30 day download link)" -To $contacts[$jobFolder]
+Remove-S3Object -BucketName $bucket -Key "$workerPrefix/assignments/$jobFolder.json" -Force
+Remove-Item $jobDir -Recurse -Force
+$running.Remove($jobFolder)
+$unzipped.Remove($jobFolder)
+}}
+if ($running.Count -eq 0 -and (Get-S3Object -BucketName $bucket -Key "$workerPrefix/retire.txt")) {{break}}
+Start-Sleep -Seconds 30
+}}
+Remove-S3Object -BucketName $bucket -Key "$workerPrefix/retire.txt" -Force
+Write-Host "All Done! Shutting down server..."
+Stop-Computer -Force -Confirm:$false
+</powershell>
+"""
+
+
+if __name__ == "__main__":
+
+    subcommands = {'run': runCommand, 'simulate': simulateCommand}
+    if len(sys.argv) < 2 or sys.argv[1] not in subcommands:
+        print("usage: mqsched.py run [options]\n       mqsched.py simulate [options]")
+        sys.exit(1)
+    subcommands[sys.argv[1]](sys.argv[2:])
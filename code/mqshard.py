@@ -0,0 +1,70 @@
+"""
+mqshard.py: splits a MaxQuant configuration into shards for scatter-gather runs
+
+A sharded job runs the per-file processing steps (feature detection through the first search and mass recalibration)
+on several job servers at once, each with an mqpar.xml listing only its share of the raw files. The per-file output
+folders (next to each raw file, named after it) are gathered on one job server, which runs the remaining steps of the
+full configuration. This module only plans the shards (the configurations are written by mqpar.py, no AWS here),
+mqsubmit does the rest.
+"""
+
+# The mqpar.xml elements holding one entry per raw file, in the same order as filePaths
+perFileElements = ['filePaths', 'experiments', 'fractions', 'ptms', 'paramGroupIndices', 'referenceChannel']
+# The last MaxQuant processing step run by the shards; the job server that gathers them starts with the step after it.
+# Step numbers depend on the configuration, the job servers look the name up with MaxQuantCmd --dryrun
+shardLastStep = "Mass recalibration"
+# S3 prefix (under the job folder) of each shard's per-file output folders
+shardPrefix = "shards"
+
+
+def outputFolder(datafile):
+    """
+    The folder MaxQuant writes a raw file's per-file results to (named after the file, without its extension)
+    """
+    return datafile.rsplit('.', 1)[0]
+
+
+def splitFiles(sizes, shards):
+    """
+    Split the raw files (given by size, in filePaths order) into at most the given number of shards of about the
+    same total size: biggest file first onto the lightest shard (the one with the fewest files on a tie).
+    Returns the file indices of each shard, in order.
+    """
+    shards = max(min(shards, len(sizes)), 1)
+    loads = [0] * shards
+    members = [[] for n in range(shards)]
+    for index in sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True):
+        lightest = min(range(shards), key=lambda n: (loads[n], len(members[n])))
+        loads[lightest] += sizes[index]
+        members[lightest].append(index)
+    return [sorted(m) for m in members if m]
+
+
+def planShards(datafiles, counts, sizes, shards):
+    """
+    Plan a sharded run from the configuration's inventory (see mqpar.readConfig: the raw files in filePaths order and
+    the number of entries of each list): which raw files each shard processes, the name of each shard's configuration
+    and the per-file output folders the gathering job server collects from it. Raises ValueError if the job can't be
+    sharded.
+    """
+    if len(datafiles) != len(sizes):
+        raise ValueError("{0} raw files in the configuration but {1} file sizes".format(len(datafiles), len(sizes)))
+    folders = [outputFolder(f).lower() for f in datafiles]
+    if len(set(folders)) != len(folders):
+        raise ValueError("raw files with the same name (but a different extension) would share a per-file output folder")
+    for name in perFileElements:
+        if counts.get(name, 0) not in (0, len(datafiles)):
+            raise ValueError("<{0}> has {1} entries for {2} raw files".format(name, counts[name], len(datafiles)))
+
+    plan = []
+    for number, indices in enumerate(splitFiles(sizes, shards), 1):
+        files = [datafiles[i] for i in indices]
+        plan.append({
+            'shard': number,
+            'files': files,
+            'indices': indices,
+            'size': sum(sizes[i] for i in indices),
+            'outputs': [outputFolder(f) for f in files],
+            'config': "mqpar-shard{0}.xml".format(number),
+        })
+    return plan
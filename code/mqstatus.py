@@ -0,0 +1,183 @@
+"""
+mqstatus.py: job state for 'mqsubmit status'
+
+The state of a job comes from its jobCtrl/ folder: the ready, running, done and failed flags written by the submit and
+the job server (one listing per job gives all of them, with the time each was written) and the job server's metrics
+marks for the phase it is in. It is joined with the shared job server queue and the EC2 instances of the jobs. This
+module turns those into one status per job and refreshes them on an asyncio loop: often while jobs change, less and
+less often while they don't, and without going back to S3 for jobs that have finished. It has no AWS code, mqsubmit
+passes in the functions that read S3 and EC2.
+
+Requires Python 3 (asyncio); mqsubmit only imports it for 'mqsubmit status'.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mqmetrics
+
+# Job states, in the order a job goes through them
+states = ['uploading', 'queued', 'ready', 'running', 'done', 'failed']
+finalStates = ('done', 'failed')
+# The job server's marks, under jobCtrl/
+workerMarks = "{0}/worker.json".format(mqmetrics.metricsPrefix.split('/', 1)[1])
+# Watch: refresh after this many seconds while jobs change, up to this many (growing by this factor) while they don't
+minInterval = 15
+maxInterval = 300
+backoff = 1.5
+
+
+def jobState(flags, shared):
+    """
+    The state of a job and since when (seconds since the epoch) from its flags ({name under jobCtrl/: time written})
+    and its place on the shared job server queue ({'queued': True} or {'worker': id}, empty if it isn't shared)
+    """
+    for flag, state in (('failed.txt', 'failed'), ('done.txt', 'done'), ('running.txt', 'running')):
+        if flag in flags:
+            return state, flags[flag]
+    if 'ready.txt' in flags:
+        return ('queued' if shared.get('queued') else 'ready'), flags.get('jobinfo.txt', flags['ready.txt'])
+    return 'uploading', min(flags.values()) if flags else None
+
+
+def jobPhases(state, flags, marks, now):
+    """
+    The phases of a job, [{'phase', 'start', 'seconds'}]: the job server's marks when it has written any (the phase it
+    is in runs until now), otherwise what the flags tell (waiting for a job server, running, total)
+    """
+    if marks:
+        phases = mqmetrics.sidePhases('worker', marks)
+        last = phases[-1]
+        phases = [{'phase': p['phase'], 'start': p['start'], 'seconds': p['seconds']} for p in phases if p['phase'] not in mqmetrics.finalMarks]
+        if state not in finalStates and last['phase'] not in mqmetrics.finalMarks:
+            phases[-1]['seconds'] = max(now - last['start'], 0)
+        return phases
+    submitted = flags.get('jobinfo.txt', flags.get('ready.txt'))
+    if submitted is None:
+        return []
+    if state in ('queued', 'ready'):
+        return [{'phase': 'waiting', 'start': submitted, 'seconds': now - submitted}]
+    if state == 'running':
+        started = flags['running.txt']
+        return [{'phase': 'waiting', 'start': submitted, 'seconds': started - submitted},
+            {'phase': 'running', 'start': started, 'seconds': now - started}]
+    ended = flags.get('done.txt', flags.get('failed.txt', now))
+    return [{'phase': 'total', 'start': submitted, 'seconds': ended - submitted}]
+
+
+def jobInstances(jobFolder, shared, instances):
+    """
+    The EC2 instances of a job (its own job server and shards, or the shared job server it was assigned to),
+    newest first
+    """
+    names = ["maxquant-{0}".format(jobFolder)]
+    if shared.get('worker'):
+        names.append("maxquant-shared-{0}".format(shared['worker']))
+    mine = [i for i in instances if i['name'] in names]
+    return sorted(mine, key=lambda i: i['launchTime'], reverse=True)
+
+
+def jobStatus(jobFolder, flags, marks, shared, instances, now=None):
+    """
+    Everything 'mqsubmit status' shows for a job, as a JSON serializable dict
+    """
+    now = now or time.time()
+    state, since = jobState(flags, shared)
+    phases = jobPhases(state, flags, marks, now)
+    ended = flags.get('done.txt', flags.get('failed.txt')) if state in finalStates else now
+    starts = [t for t in [flags.get('jobinfo.txt', flags.get('ready.txt', since))] + [p['start'] for p in phases[:1]] if t is not None]
+    return {
+        'jobFolder': jobFolder,
+        'state': state,
+        'since': since,
+        'phase': phases[-1]['phase'] if phases else None,
+        'phaseSeconds': phases[-1]['seconds'] if phases else None,
+        'totalSeconds': (ended - min(starts)) if starts and ended is not None else None,
+        'phases': phases,
+        'worker': shared.get('worker'),
+        'instances': jobInstances(jobFolder, shared, instances),
+    }
+
+
+class StatusMonitor(object):
+    """
+    Collects the status of the jobs. The functions that read S3 and EC2 are run on a thread pool from the asyncio
+    loop, the jobCtrl/ listings of all jobs at once:
+        listJobs() -> [job folder]
+        listFlags(jobFolder) -> {name under jobCtrl/: (time written, etag)}
+        loadMarks(jobFolder) -> the job server's marks (None if it hasn't written any)
+        listShared() -> {job folder: {'queued': True} or {'worker': id}}
+        listInstances() -> [{'name', 'instanceId', 'state', 'instanceType', 'market', 'launchTime'}]
+    Jobs that have finished are not listed again, and marks are only read again when they have changed.
+    """
+    def __init__(self, listJobs, listFlags, loadMarks, listShared, listInstances, workers=16):
+        self.listJobs = listJobs
+        self.listFlags = listFlags
+        self.loadMarks = loadMarks
+        self.listShared = listShared
+        self.listInstances = listInstances
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.flags = {}
+        self.marks = {}
+
+    def call(self, function, *args):
+        return asyncio.get_event_loop().run_in_executor(self.pool, function, *args)
+
+    async def readJob(self, jobFolder):
+        """
+        Read the flags of a job, and its marks if they changed since the last read
+        """
+        if jobFolder in self.flags and jobState(self.times(jobFolder), {})[0] in finalStates:
+            return
+        self.flags[jobFolder] = flags = await self.call(self.listFlags, jobFolder)
+        if workerMarks in flags and self.marks.get(jobFolder, (None, None))[0] != flags[workerMarks][1]:
+            self.marks[jobFolder] = (flags[workerMarks][1], await self.call(self.loadMarks, jobFolder))
+
+    def times(self, jobFolder):
+        return dict((name, written) for name, (written, etag) in self.flags[jobFolder].items())
+
+    async def refresh(self):
+        """
+        The status of every job, ordered by job folder
+        """
+        jobs, shared, instances = await asyncio.gather(self.call(self.listJobs), self.call(self.listShared), self.call(self.listInstances))
+        await asyncio.gather(*[self.readJob(job) for job in jobs])
+        now = time.time()
+        return [jobStatus(job, self.times(job), self.marks.get(job, (None, None))[1], shared.get(job, {}), instances, now)
+            for job in sorted(jobs)]
+
+
+def fingerprint(statuses):
+    """
+    What a refresh is compared by to tell if anything changed
+    """
+    return [(s['jobFolder'], s['state'], s['phase'], [i['state'] for i in s['instances']]) for s in statuses]
+
+
+async def watch(monitor, show, interval=minInterval, longest=maxInterval):
+    """
+    Refresh and show the statuses until every job has finished: again after interval seconds when something changed,
+    the wait growing up to the longest interval while nothing does
+    """
+    wait, previous = interval, None
+    while True:
+        statuses = await monitor.refresh()
+        current = fingerprint(statuses)
+        wait = interval if current != previous else min(wait * backoff, longest)
+        previous = current
+        finished = all(s['state'] in finalStates for s in statuses)
+        show(statuses, None if finished else wait)
+        if finished:
+            return statuses
+        await asyncio.sleep(wait)
+
+
+def run(coroutine):
+    """
+    Run a coroutine on a new event loop
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
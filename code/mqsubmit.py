@@ -2,87 +2,116 @@
 """
 mqsubmit.py: submits a maxquant job to the cloud based automation pipeline
 """
+import base64
+import calendar
+import csv
+import hashlib
+import json
 import os
 import optparse
 import random
 import re
 import sys
+import threading
 import time
-import boto3
-import botocore
-import xml.etree.ElementTree as ET
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import mqcheck
+import mqfetch
+import mqmetrics
+import mqpar
+import mqshard
+
+# The MaxQuant version the job servers run
+maxquant_ver = "1.6.11.0"
+# This is the top-level S3 bucket that all job folders will live under
+jobsBucket = "fredhutch-maxquant-jobs"
+# The job files will be uploaded and run in this directory on the job server
+jobServerDir = "c:\\mq-job\\"
+# On a shared job server (see mqsched.py) each job runs in its own directory under this one
+sharedJobServerDir = "c:\\mq-jobs\\"
+# Jobs waiting for a shared job server are listed under this prefix of the jobs bucket
+queuePrefix = "queue"
+# Job servers download the job files and upload the results bundle in parts of this many MB, this many at a time
+workerPartSize = 32
+workerTransfers = 16
+# The job server's transfer functions (TransferScript) are stored under this key of the job folder
+transferScriptKey = "jobCtrl/transfer.ps1"
+# The SHA-256 checksums of the job files, which the job server checks its downloads against, are stored under this key
+manifestKey = "jobCtrl/manifest.json"
+# The folders of combined/ a job server stores unzipped as well as in the results bundle, unless --unzipped says otherwise
+defaultUnzipped = "txt"
+
+def adjustConfig(mqconfig, mqdir, mqparams, write=True):
+    """
+    Takes the MaxQuant GUI generated XML configuration file and writes the job's copy of it to the staging directory
+    (see stagingDir), with the data and fasta file paths changed from where they where when created, to where they
+    are going to be on the Cloud server. It also plans the instance for the job and sets the mumber threads that will
+    be used on the cloud server to run the job. The user's file is left as it is; the copy is streamed (see mqpar.py).
+    It returns a list of the datafiles and a list of the fasta files for the purpose of the S3 uploads
+    """
+    inventory = configInventory(mqconfig, mqparams)
+    datafiles = list(inventory['datafiles'])
+    fastas = list(inventory['fastaFiles'])
+
+    # Plan the instance type and how many threads the job should use from the data, FASTA and search settings
+    mqparams['mzxmlFiles'] = datafiles
+    mqparams['fastaFiles'] = fastas
+    mqparams['settings'] = inventory['settings']
+    mqparams['plan'] = instancePlanners[mqparams.get('planner', 'workload')](mqparams)
+    mqparams['instanceType'] = mqparams['plan']['instanceType']
+    mqparams['storage'] = planStorage(mqparams)
+    # A sharded job also gets a configuration for each shard, written next to the job's copy of the configuration
+    if mqparams.get('shards', 1) > 1:
+        mqparams['shardPlan'] = planShardRuns(inventory, mqparams)
+    else:
+        mqparams.pop('shardPlan', None)
+
+    if not write:
+        return datafiles, fastas
+
+    # write the job's configuration (and the shards') with the updated path and thread changes
+    staging = stagingDir(mqparams)
+    if not os.path.isdir(staging):
+        os.makedirs(staging)
+    mqparams['stagedConfig'] = os.path.join(staging, "mqpar.xml")
+    mqpar.writeConfig(mqconfig, mqparams['stagedConfig'], mqdir, mqparams['plan']['threads'])
+    for shard in mqparams.get('shardPlan', []):
+        shard['path'] = os.path.join(staging, shard['config'])
+        mqpar.writeConfig(mqconfig, shard['path'], mqdir, shard['plan']['threads'],
+            keep=set(shard['indices']), perFile=mqshard.perFileElements)
+
+    return datafiles, fastas
 
 
-def adjustConfig(mqconfig, mqdir, mqparams):
+def configInventory(mqconfig, mqparams):
     """
-    Takes the MaxQuant GUI generated XML configuration file and updates the data and fasta file paths so they
-    are changed from where they where when created, to where they are going to be on the Cloud server. It also
-    sets the mumber threads that will be used on the cloud server to run the job.
-    It returns a list of the datafiles and a list of the fasta files for the purpose of the S3 uploads
+    The file inventory and planner settings of the job's configuration (see mqpar.readConfig), read once per submit
+    and kept in mqparams['inventory']
     """
-    tree = ET.parse(mqconfig)
-    root = tree.getroot()
-
-    # Get list of datafiles (mzXML and RAW) and fix the file paths
-    datafiles = []
-    for filePaths in root.findall('filePaths'):
-        files = filePaths.findall('string')
-        for d in files:
-            dfile = (d.text).split('\\')[-1]
-            datafiles.append(dfile)
-            dpath = mqdir + dfile
-            d.text = dpath 
-
-    # Get list of fasta files and fix the file paths
-    fastas = []
-    for fastaFiles in root.findall('fastaFiles'):
-        fasta = fastaFiles.findall('string')
-        # Starting in MaxQuant version 1.6.10.43 (or at least noticed then),
-        # the xml file contains a different structure for describing the fasta file(s).
-        # In previous versions it's like:
-
-        #    <fastaFiles>
-        #       <string>c:\mq-job\UP000005640_9606_human.fasta</string>
-        #    </fastaFiles>
-
-        # Now it's like this:
-
-        # <fastaFiles>
-        #     <FastaFileInfo>
-        #         <fastaFilePath>C:\mq-job\yeast_orf_trans_all_05-Jan-2010.fasta</fastaFilePath>
-        #         <identifierParseRule>>([^\s]*)</identifierParseRule>
-        #         <descriptionParseRule>>(.*)</descriptionParseRule>
-        #         <taxonomyParseRule></taxonomyParseRule>
-        #         <variationParseRule></variationParseRule>
-        #         <modificationParseRule></modificationParseRule>
-        #         <taxonomyId></taxonomyId>
-        #     </FastaFileInfo>
-        # </fastaFiles>
-
-        # Not sure if we care about anything except `fastaFilePath`.
-
-        if not fasta: # old format wasn't found, look for new
-            tmp = fastaFiles.findall('FastaFileInfo')
-            for i in tmp:
-                fasta = i.findall("fastaFilePath") 
-        for f in fasta:
-            ffile = (f.text).split('\\')[-1]
-            fastas.append(ffile) 
-            fpath = mqdir + ffile
-            f.text = fpath 
-    
-    # how many threads should the job use
-    threads = pickInstanceType(filePaths, mqparams)[1]
-    cthreads = root.find('numThreads')
-    cthreads.text = threads 
+    inventory = mqparams.get('inventory')
+    if inventory is None or inventory['path'] != mqconfig:
+        inventory = mqparams['inventory'] = mqpar.readConfig(mqconfig)
+    return inventory
 
-    # re-write the updated configuration with the updated path and thread changes
-    tree.write(mqconfig)
 
-    # MaxQuant is a Windows program after all
-    os.popen("/usr/bin/unix2dos %s >> /dev/null 2>&1" % mqconfig)
-    
-    return datafiles, fastas
+def planShardRuns(inventory, mqparams):
+    """
+    Plan the shards of a sharded job (mqsubmit --shards): the raw files, configuration, instance type and storage of
+    each shard's job server. The job's own plan is used for the job server that gathers the shards and finishes the job.
+    """
+    sizes = [os.path.getsize(jobPath(mqparams, f)) if os.path.isfile(jobPath(mqparams, f)) else 0 for f in mqparams['mzxmlFiles']]
+    try:
+        plan = mqshard.planShards(inventory['datafiles'], inventory['counts'], sizes, mqparams['shards'])
+    except ValueError as e:
+        print("\nThis job can't be sharded: {0}".format(e))
+        sys.exit(1)
+    for shard in plan:
+        shardParams = dict(mqparams, mzxmlFiles=shard['files'], market='on-demand', instanceTypes=None)
+        shard['plan'] = instancePlanners[mqparams.get('planner', 'workload')](shardParams)
+        shard['instanceType'] = shard['plan']['instanceType']
+        shard['storage'] = planStorage(shardParams)
+    return plan
 
 
 def pickInstanceType(fileList, mqparams):
@@ -113,6 +142,14 @@ def pickInstanceType(fileList, mqparams):
     return instanceType, threads
 
 
+def jobPath(mqparams, f):
+    """
+    Local path of a job file; the file names in mqparams are relative to the job directory (the current directory
+    unless the job came from a batch manifest)
+    """
+    return os.path.join(mqparams.get('jobDir', ''), f)
+
+
 def getDataSize(datafiles):
     """
     Determine the total size of the data files in this job. This information is used to
@@ -126,6 +163,345 @@ def getDataSize(datafiles):
     return int(round(total))
 
 
+"""
+Instance catalog: the EC2 instance types the planner can choose from, in order of preference within each vCPU count
+(compute optimized first, then more memory per core). 'network' is the bandwidth in Gbps (burst for the smaller sizes)
+and 'instanceStore' the size in GB of the local NVMe SSD, if the type has one.
+"""
+instanceCatalog = [
+    {'type': 'c5.large', 'vcpu': 2, 'memory': 4, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5d.large', 'vcpu': 2, 'memory': 4, 'network': 10, 'instanceStore': 50},
+    {'type': 'm5.large', 'vcpu': 2, 'memory': 8, 'network': 10, 'instanceStore': 0},
+    {'type': 'r5.large', 'vcpu': 2, 'memory': 16, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5.xlarge', 'vcpu': 4, 'memory': 8, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5d.xlarge', 'vcpu': 4, 'memory': 8, 'network': 10, 'instanceStore': 100},
+    {'type': 'm5.xlarge', 'vcpu': 4, 'memory': 16, 'network': 10, 'instanceStore': 0},
+    {'type': 'r5.xlarge', 'vcpu': 4, 'memory': 32, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5.2xlarge', 'vcpu': 8, 'memory': 16, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5d.2xlarge', 'vcpu': 8, 'memory': 16, 'network': 10, 'instanceStore': 200},
+    {'type': 'm5.2xlarge', 'vcpu': 8, 'memory': 32, 'network': 10, 'instanceStore': 0},
+    {'type': 'r5.2xlarge', 'vcpu': 8, 'memory': 64, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5.4xlarge', 'vcpu': 16, 'memory': 32, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5d.4xlarge', 'vcpu': 16, 'memory': 32, 'network': 10, 'instanceStore': 400},
+    {'type': 'm5.4xlarge', 'vcpu': 16, 'memory': 64, 'network': 10, 'instanceStore': 0},
+    {'type': 'r5.4xlarge', 'vcpu': 16, 'memory': 128, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5.9xlarge', 'vcpu': 36, 'memory': 72, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5d.9xlarge', 'vcpu': 36, 'memory': 72, 'network': 10, 'instanceStore': 900},
+    {'type': 'm5.12xlarge', 'vcpu': 48, 'memory': 192, 'network': 10, 'instanceStore': 0},
+    {'type': 'r5.12xlarge', 'vcpu': 48, 'memory': 384, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5.18xlarge', 'vcpu': 72, 'memory': 144, 'network': 25, 'instanceStore': 0},
+    {'type': 'c5d.18xlarge', 'vcpu': 72, 'memory': 144, 'network': 25, 'instanceStore': 1800},
+    {'type': 'm5.24xlarge', 'vcpu': 96, 'memory': 384, 'network': 25, 'instanceStore': 0},
+    {'type': 'r5.24xlarge', 'vcpu': 96, 'memory': 768, 'network': 25, 'instanceStore': 0},
+]
+
+
+"""
+Alternative instance types: other families (and the c4 types of the filecount planner) a job server can be launched as
+when EC2 is short of the planned type (see equivalentTypes). The planners only choose from the catalog above.
+"""
+alternativeCatalog = [
+    {'type': 'c4.large', 'vcpu': 2, 'memory': 3.75, 'network': 1, 'instanceStore': 0},
+    {'type': 'c4.xlarge', 'vcpu': 4, 'memory': 7.5, 'network': 1, 'instanceStore': 0},
+    {'type': 'c4.2xlarge', 'vcpu': 8, 'memory': 15, 'network': 1, 'instanceStore': 0},
+    {'type': 'c4.4xlarge', 'vcpu': 16, 'memory': 30, 'network': 1, 'instanceStore': 0},
+    {'type': 'c4.8xlarge', 'vcpu': 36, 'memory': 60, 'network': 10, 'instanceStore': 0},
+    {'type': 'c6i.large', 'vcpu': 2, 'memory': 4, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'c6i.xlarge', 'vcpu': 4, 'memory': 8, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'c6i.2xlarge', 'vcpu': 8, 'memory': 16, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'c6i.4xlarge', 'vcpu': 16, 'memory': 32, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'c6i.8xlarge', 'vcpu': 32, 'memory': 64, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'c6i.12xlarge', 'vcpu': 48, 'memory': 96, 'network': 18.75, 'instanceStore': 0},
+    {'type': 'c6i.16xlarge', 'vcpu': 64, 'memory': 128, 'network': 25, 'instanceStore': 0},
+    {'type': 'c6i.24xlarge', 'vcpu': 96, 'memory': 192, 'network': 37.5, 'instanceStore': 0},
+    {'type': 'c6id.large', 'vcpu': 2, 'memory': 4, 'network': 12.5, 'instanceStore': 118},
+    {'type': 'c6id.xlarge', 'vcpu': 4, 'memory': 8, 'network': 12.5, 'instanceStore': 237},
+    {'type': 'c6id.2xlarge', 'vcpu': 8, 'memory': 16, 'network': 12.5, 'instanceStore': 474},
+    {'type': 'c6id.4xlarge', 'vcpu': 16, 'memory': 32, 'network': 12.5, 'instanceStore': 950},
+    {'type': 'c6id.8xlarge', 'vcpu': 32, 'memory': 64, 'network': 12.5, 'instanceStore': 1900},
+    {'type': 'c6id.12xlarge', 'vcpu': 48, 'memory': 96, 'network': 18.75, 'instanceStore': 2850},
+    {'type': 'c5a.large', 'vcpu': 2, 'memory': 4, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5a.xlarge', 'vcpu': 4, 'memory': 8, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5a.2xlarge', 'vcpu': 8, 'memory': 16, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5a.4xlarge', 'vcpu': 16, 'memory': 32, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5a.8xlarge', 'vcpu': 32, 'memory': 64, 'network': 10, 'instanceStore': 0},
+    {'type': 'c5a.12xlarge', 'vcpu': 48, 'memory': 96, 'network': 12, 'instanceStore': 0},
+    {'type': 'c5a.16xlarge', 'vcpu': 64, 'memory': 128, 'network': 20, 'instanceStore': 0},
+    {'type': 'c5a.24xlarge', 'vcpu': 96, 'memory': 192, 'network': 20, 'instanceStore': 0},
+    {'type': 'm6i.large', 'vcpu': 2, 'memory': 8, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'm6i.xlarge', 'vcpu': 4, 'memory': 16, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'm6i.2xlarge', 'vcpu': 8, 'memory': 32, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'm6i.4xlarge', 'vcpu': 16, 'memory': 64, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'm6i.8xlarge', 'vcpu': 32, 'memory': 128, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'm6i.12xlarge', 'vcpu': 48, 'memory': 192, 'network': 18.75, 'instanceStore': 0},
+    {'type': 'm6i.16xlarge', 'vcpu': 64, 'memory': 256, 'network': 25, 'instanceStore': 0},
+    {'type': 'm6i.24xlarge', 'vcpu': 96, 'memory': 384, 'network': 37.5, 'instanceStore': 0},
+    {'type': 'm5a.large', 'vcpu': 2, 'memory': 8, 'network': 10, 'instanceStore': 0},
+    {'type': 'm5a.xlarge', 'vcpu': 4, 'memory': 16, 'network': 10, 'instanceStore': 0},
+    {'type': 'm5a.2xlarge', 'vcpu': 8, 'memory': 32, 'network': 10, 'instanceStore': 0},
+    {'type': 'm5a.4xlarge', 'vcpu': 16, 'memory': 64, 'network': 10, 'instanceStore': 0},
+    {'type': 'm5a.12xlarge', 'vcpu': 48, 'memory': 192, 'network': 10, 'instanceStore': 0},
+    {'type': 'm5a.24xlarge', 'vcpu': 96, 'memory': 384, 'network': 20, 'instanceStore': 0},
+    {'type': 'r6i.large', 'vcpu': 2, 'memory': 16, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'r6i.xlarge', 'vcpu': 4, 'memory': 32, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'r6i.2xlarge', 'vcpu': 8, 'memory': 64, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'r6i.4xlarge', 'vcpu': 16, 'memory': 128, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'r6i.8xlarge', 'vcpu': 32, 'memory': 256, 'network': 12.5, 'instanceStore': 0},
+    {'type': 'r6i.12xlarge', 'vcpu': 48, 'memory': 384, 'network': 18.75, 'instanceStore': 0},
+    {'type': 'r6i.16xlarge', 'vcpu': 64, 'memory': 512, 'network': 25, 'instanceStore': 0},
+    {'type': 'r6i.24xlarge', 'vcpu': 96, 'memory': 768, 'network': 37.5, 'instanceStore': 0},
+    {'type': 'r5a.large', 'vcpu': 2, 'memory': 16, 'network': 10, 'instanceStore': 0},
+    {'type': 'r5a.xlarge', 'vcpu': 4, 'memory': 32, 'network': 10, 'instanceStore': 0},
+    {'type': 'r5a.2xlarge', 'vcpu': 8, 'memory': 64, 'network': 10, 'instanceStore': 0},
+    {'type': 'r5a.4xlarge', 'vcpu': 16, 'memory': 128, 'network': 10, 'instanceStore': 0},
+    {'type': 'r5a.12xlarge', 'vcpu': 48, 'memory': 384, 'network': 10, 'instanceStore': 0},
+    {'type': 'r5a.24xlarge', 'vcpu': 96, 'memory': 768, 'network': 20, 'instanceStore': 0},
+]
+
+
+def instanceSpec(instanceType):
+    """
+    Look up an instance type in the catalogs; types that aren't in them get what little we know
+    """
+    for spec in instanceCatalog + alternativeCatalog:
+        if spec['type'] == instanceType:
+            return spec
+    return {'type': instanceType, 'vcpu': 0, 'memory': 0, 'network': 0, 'instanceStore': 0}
+
+
+# Memory (GB) MaxQuant holds per scan of a raw file, for files whose scan count the pre-flight scan knows
+scanMemory = 20e-6
+
+
+def estimateMemory(mqparams, threads):
+    """
+    Rough MaxQuant memory need in GB: every thread holds one raw file's spectra plus the search space (which grows with
+    the FASTA size and the number of variable modifications); match between runs needs extra room in the combined stages.
+    Returns the estimate and the reasoning behind it.
+    """
+    fastas = [jobPath(mqparams, f) for f in mqparams['fastaFiles']]
+    # The pre-flight scan counts the spectra of mzXML/mzML files; a file with many small scans needs more than its size
+    fileStats = mqparams.get('fileStats', {})
+    sizes = [max(os.path.getsize(jobPath(mqparams, f)) / 1e9, fileStats.get(f, {}).get('scans', 0) * scanMemory)
+        for f in mqparams['mzxmlFiles'] if os.path.isfile(jobPath(mqparams, f))] or [0]
+    fastaGB = sum(os.path.getsize(f) for f in fastas if os.path.isfile(f)) / 1e9
+    settings = mqparams.get('settings', {})
+    mods = settings.get('variableModifications', 0)
+    modFactor = 1 + 0.25 * max(mods - 2, 0)
+    perThread = (0.75 + 0.5 * max(sizes) + 2.0 * fastaGB) * modFactor
+    combined = 0.05 * sum(sizes)
+    if settings.get('matchBetweenRuns'):
+        combined *= 2
+    need = (threads * perThread + combined + 1.5) * 1.2
+    reasons = [
+        "largest data file {0:.2f}GB (by size, or by scan count when known), FASTA {1:.3f}GB, {2} variable modification(s): ~{3:.1f}GB per thread".format(max(sizes), fastaGB, mods, perThread),
+        "combined stages{0}: ~{1:.1f}GB; plus 1.5GB for Windows and 20% headroom".format(" with match between runs" if settings.get('matchBetweenRuns') else "", combined),
+    ]
+    return need, reasons
+
+
+def planWorkload(mqparams):
+    """
+    Size- and workload-aware planner: one thread per data file (up to the largest instance in the catalog), then the
+    first catalog instance with enough cores and enough memory for that many threads. If no instance has enough memory
+    the thread count is lowered until the job fits.
+    """
+    files = mqparams['mzxmlFiles']
+    totalGB = getDataSize([jobPath(mqparams, f) for f in files])
+    maxCpu = max(spec['vcpu'] for spec in instanceCatalog)
+    threads = max(min(len(files), maxCpu), 1)
+    reasons = ["{0} data file(s), {1}GB total: {2} thread(s) wanted".format(len(files), totalGB, threads)]
+    # large jobs are dominated by the download to the job server; stay on the faster network types
+    minNetwork = 25 if totalGB > 500 else 0
+    if minNetwork:
+        reasons.append("more than 500GB of data: {0}Gbps network or better".format(minNetwork))
+    # jobs with a fair amount of data get a type whose NVMe instance store can hold the job directory, if there is one
+    scratchGB = scratchSize(mqparams)
+    minStore = scratchGB if totalGB >= 20 and not spotMarket(mqparams) else 0
+    if minStore:
+        reasons.append("{0}GB of scratch space needed: prefer types with that much NVMe instance store".format(scratchGB))
+    while threads >= 1:
+        need, memReasons = estimateMemory(mqparams, threads)
+        fits = [spec for spec in instanceCatalog if spec['vcpu'] >= threads and spec['memory'] >= need and spec['network'] >= minNetwork]
+        # an instance store type is only preferred if it doesn't take more cores than the best plain fit
+        stores = [spec for spec in fits if spec['instanceStore'] >= minStore and spec['vcpu'] <= fits[0]['vcpu']]
+        candidates = stores or fits
+        if candidates:
+            spec = candidates[0]
+            reasons.extend(memReasons)
+            reasons.append("{0} ({1} vCPU, {2}GB) is the first type with {3} vCPU(s) and {4:.1f}GB".format(spec['type'], spec['vcpu'], spec['memory'], threads, need))
+            return {'instanceType': spec['type'], 'threads': str(threads), 'memory': need, 'planner': 'workload', 'reasons': reasons}
+        reasons.append("no instance has {0:.1f}GB of memory for {1} threads, trying fewer".format(need, threads))
+        threads -= max(threads // 4, 1)
+    spec = instanceCatalog[-1]
+    reasons.append("nothing fits; using the largest instance ({0}) with one thread".format(spec['type']))
+    return {'instanceType': spec['type'], 'threads': '1', 'memory': spec['memory'], 'planner': 'workload', 'reasons': reasons}
+
+
+def planFileCount(mqparams):
+    """
+    The original planner: a c4 instance and one thread per data file, chosen from the number of data files only
+    """
+    instanceType, threads = pickInstanceType(mqparams['mzxmlFiles'], mqparams)
+    return {'instanceType': instanceType, 'threads': threads, 'memory': None, 'planner': 'filecount',
+        'reasons': ["{0} data file(s): {1} with {2} thread(s)".format(len(mqparams['mzxmlFiles']), instanceType, threads)]}
+
+
+"""
+Instance planners: each takes the mqparams of a job (file inventory and mqpar settings) and returns a plan dict with
+the 'instanceType', the 'threads' (string, for numThreads), the estimated 'memory' (GB) and the 'reasons' for its choice.
+"""
+instancePlanners = {
+    'workload': planWorkload,
+    'filecount': planFileCount,
+}
+
+
+def printPlan(mqparams):
+    """
+    Print the planners decision and its reasoning (mqsubmit --plan)
+    """
+    plan = mqparams['plan']
+    print("\nJob plan ({0} planner):".format(plan['planner']))
+    print("\tInstance type: {0}".format(plan['instanceType']))
+    print("\tThreads (numThreads): {0}".format(plan['threads']))
+    if plan['memory'] is not None:
+        print("\tEstimated memory: {0:.1f}GB".format(plan['memory']))
+    print("\tReasoning:")
+    for reason in plan['reasons']:
+        print("\t  - {0}".format(reason))
+    storage = mqparams['storage']
+    print("\nStorage plan:")
+    print("\tRoot volume: {0}GB {1}, {2} IOPS, {3}MB/s".format(storage['volumeSize'], storage['volumeType'], storage['iops'], storage['throughput']))
+    print("\tJob directory: {0}".format("NVMe instance store" if storage['scratch'] else "root volume"))
+    print("\tReasoning:")
+    for reason in storage['reasons']:
+        print("\t  - {0}".format(reason))
+    options = launchOptions(mqparams, mqparams['instanceType'], storage, plan['memory'])
+    types = []
+    for option in options:
+        if option['instanceType'] not in types:
+            types.append(option['instanceType'])
+    print("\nLaunch options ({0} in order, until EC2 has one):".format(len(options)))
+    print("\tInstance types: {0}".format(", ".join(types)))
+    print("\tSubnets: {0}".format(", ".join(mqparams.get('subnets') or jobSubnets)))
+    print("\tMarket: {0}".format(", then ".join(launchMarkets[mqparams.get('market', 'on-demand')])))
+    if mqparams.get('shardPlan'):
+        print("\nShards (per-file steps up to '{0}', then the job server above finishes the job):".format(mqshard.shardLastStep))
+        for shard in mqparams['shardPlan']:
+            print("\tShard {0}: {1} file(s) ({2}) on {3} with {4} thread(s)".format(shard['shard'], len(shard['files']),
+                formatBytes(shard['size']), shard['instanceType'], shard['plan']['threads']))
+
+
+def scratchSize(mqparams):
+    """
+    Space in GB the job directory needs on the job server: the data files plus room for the results and temp files
+    """
+    return getDataSize([jobPath(mqparams, f) for f in mqparams['mzxmlFiles']]) * 4
+
+
+def planStorage(mqparams):
+    """
+    Plan the job server's storage. The root volume is gp3 with IOPS and throughput provisioned in proportion to the data
+    (gp2 only gets fast as it gets big, which starved small jobs). When the instance type has an NVMe instance store
+    big enough for the job directory, C:/mq-job (and the temp folder) are put on it and the root volume only needs
+    room for Windows and MaxQuant; with --instance-types every one of the types needs one. A job server that may be a
+    spot instance keeps the job directory on the root volume, which outlasts an interruption.
+    """
+    dataGB = getDataSize([jobPath(mqparams, f) for f in mqparams['mzxmlFiles']])
+    spec = min([instanceSpec(t) for t in mqparams.get('instanceTypes') or [mqparams['instanceType']]], key=lambda s: s['instanceStore'])
+    reasons = []
+    scratch = spec['instanceStore'] >= scratchSize(mqparams) and spec['instanceStore'] > 0 and not spotMarket(mqparams)
+    if spotMarket(mqparams):
+        reasons.append("a spot job server keeps the job directory on the root volume, which an interruption doesn't wipe")
+    if scratch:
+        volumeSize = 150
+        reasons.append("{0} has {1}GB of NVMe instance store for the {2}GB job directory".format(spec['type'], spec['instanceStore'], scratchSize(mqparams)))
+    else:
+        # The volume should be four times the size of the datafiles (room for resutls) and padded 150GB.
+        volumeSize = scratchSize(mqparams) + 150
+        reasons.append("job directory on the root volume: {0}GB of data x 4 + 150GB".format(dataGB))
+    if scratch:
+        # the data never touches the root volume; the gp3 baseline is plenty
+        throughput, iops = 125, 3000
+        reasons.append("gp3 baseline ({0}MB/s, {1} IOPS) for Windows and MaxQuant only".format(throughput, iops))
+    else:
+        # gp3 limits: 125-1000MB/s, 3000-16000 IOPS, at least 4 IOPS per MB/s
+        throughput = min(max(125 + 4 * dataGB, 125), 1000)
+        iops = min(max(3000, 4 * throughput, 3000 + 50 * dataGB), 16000)
+        reasons.append("gp3 at {0}MB/s and {1} IOPS for {2}GB of data".format(throughput, iops, dataGB))
+    return {'volumeSize': volumeSize, 'volumeType': 'gp3', 'iops': iops, 'throughput': throughput, 'scratch': scratch, 'reasons': reasons}
+
+
+def blockDeviceMappings(storage):
+    """
+    The EC2 BlockDeviceMappings for a storage plan
+    """
+    ebs = {'VolumeSize': storage['volumeSize'], 'DeleteOnTermination': True, 'VolumeType': storage['volumeType']}
+    if storage['volumeType'] == 'gp3':
+        ebs['Iops'] = storage['iops']
+        ebs['Throughput'] = storage['throughput']
+    return [{'DeviceName': '/dev/sda1', 'Ebs': ebs}]
+
+
+"""
+Launch options: EC2 is at times short of an instance type in an availability zone, and spot capacity comes and goes.
+Rather than fail, a job server is launched from a ranked list of options (instance type, subnet, spot or on-demand)
+that create_ec2worker tries in order until EC2 has one.
+"""
+# The job servers' subnets, in order of preference; --subnets gives others (in other availability zones)
+jobSubnets = ['subnet-a95a0ede']
+# How many instance types a job server may be launched as: the planned type and the closest equivalents
+launchTypes = 4
+# The markets a job server is launched on for each --market policy, in order
+launchMarkets = {'on-demand': ['on-demand'], 'spot': ['spot'], 'spot-first': ['spot', 'on-demand']}
+# run_instances errors that mean this option can't be had right now; the next one is tried straight away
+capacityErrors = ['InsufficientInstanceCapacity', 'InsufficientHostCapacity', 'InsufficientCapacity', 'UnfulfillableCapacity',
+    'Unsupported', 'InstanceLimitExceeded', 'VcpuLimitExceeded', 'MaxSpotInstanceCountExceeded', 'SpotMaxPriceTooLow',
+    'InsufficientFreeAddressesInSubnet']
+# A spot job server's request is persistent and EC2 stops the instance when it takes the capacity back, so the root
+# volume (and the job directory on it) is kept; EC2 starts it again when there is capacity and the job continues from
+# the last MaxQuant step it finished (see SpotScript)
+spotMarketOptions = {'MarketType': 'spot', 'SpotOptions': {'SpotInstanceType': 'persistent', 'InstanceInterruptionBehavior': 'stop'}}
+
+
+def spotMarket(mqparams):
+    """
+    Can the job server be a spot instance (--market)
+    """
+    return 'spot' in launchMarkets[mqparams.get('market', 'on-demand')]
+
+
+def equivalentTypes(instanceType, memory=None, instanceStore=0, count=launchTypes):
+    """
+    The planned instance type and the types that can stand in for it: at least as many vCPUs (at most twice as many),
+    the memory the plan needs (what the planned type has if the plan has no estimate), as fast a network and, for a
+    job directory planned on the instance store, a big enough one. Closest first: fewest vCPUs, then least memory,
+    then in the order of the catalogs. A type the catalogs don't know has no equivalents.
+    """
+    spec = instanceSpec(instanceType)
+    if not spec['vcpu']:
+        return [instanceType]
+    memory = memory or spec['memory']
+    catalog = instanceCatalog + alternativeCatalog
+    fits = [s for s in catalog if s['type'] != instanceType and spec['vcpu'] <= s['vcpu'] <= 2 * spec['vcpu']
+        and s['memory'] >= memory and s['network'] >= spec['network'] and s['instanceStore'] >= instanceStore]
+    fits.sort(key=lambda s: (s['vcpu'], s['memory'], catalog.index(s)))
+    return [instanceType] + [s['type'] for s in fits][:count - 1]
+
+
+def launchOptions(mqparams, instanceType, storage, memory=None):
+    """
+    The launch options of a job server, [{'instanceType', 'subnetId', 'market'}] in the order they are tried: each of
+    the instance types (--instance-types, or the planned type and its equivalents) in each of the subnets, on each
+    market of the --market policy in turn
+    """
+    types = mqparams.get('instanceTypes') or equivalentTypes(instanceType, memory, scratchSize(mqparams) if storage.get('scratch') else 0)
+    subnets = mqparams.get('subnets') or jobSubnets
+    return [{'instanceType': t, 'subnetId': subnet, 'market': market}
+        for market in launchMarkets[mqparams.get('market', 'on-demand')] for t in types for subnet in subnets]
+
+
 def passwordGen(plength):
     """
     Generate a random string suitable for use as a password. This is used later to generate a password for the
@@ -138,16 +514,66 @@ def passwordGen(plength):
     return(''.join(p))
 
 
+"""
+Shared AWS clients: every part of a submission (and every job of a batch) uses the same boto3 session and one client per
+service and region, whose connection pool is big enough for all the concurrent transfers. boto3 clients, unlike
+resources, are thread safe.
+"""
+awsPoolSize = 50
+awsSession = None
+awsClients = {}
+awsLock = threading.Lock()
+# boto3 and botocore take most of mqsubmit's start-up time, so they are only imported (by loadAws) once a command talks
+# to AWS: --help, argument errors, --plan and the local checks don't wait for them
+boto3 = None
+botocore = None
+
+
+def loadAws():
+    """
+    Import boto3 and botocore, the first time only
+    """
+    global boto3, botocore
+    if botocore is None:
+        import boto3.session
+        import boto3.s3.transfer
+        import botocore.config
+        import botocore.exceptions
+
+
+def configureAws(poolSize):
+    """
+    Set the connection pool size of the shared clients; must be called before the first client is created
+    """
+    global awsPoolSize
+    awsPoolSize = max(poolSize, awsPoolSize)
+
+
+def awsClient(service, region='us-west-2'):
+    """
+    Return the shared client for an AWS service/region, creating it on first use
+    """
+    global awsSession
+    loadAws()
+    with awsLock:
+        if (service, region) not in awsClients:
+            if awsSession is None:
+                awsSession = boto3.session.Session()
+            awsClients[(service, region)] = awsSession.client(service, region_name = region,
+                config = botocore.config.Config(max_pool_connections = awsPoolSize))
+        return awsClients[(service, region)]
+
+
 def checkJobAlreadyExists(mqBucket, jobFolder):
     """
     Check to see if the job already exists to avoid overwritting it
     """
-    s3 = boto3.resource('s3', 'us-west-2')
+    client = awsClient('s3')
     exists = False
     try:
-        s3.Object(mqBucket, "{0}/mqpar.xml".format(jobFolder)).load()
+        client.head_object(Bucket=mqBucket, Key="{0}/mqpar.xml".format(jobFolder))
     except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == "404":
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
             exists = False
         else:
             raise e
@@ -156,77 +582,930 @@ def checkJobAlreadyExists(mqBucket, jobFolder):
     return exists
 
 
-def uploadS3(mqBucket, jobFolder, mqparams, mqconfig):
+class TransferProgress(object):
+    """
+    Keeps a running, thread safe count of the bytes sent for every file in an upload batch so that a single
+    progress line (aggregate rate and ETA) can be displayed while several files are being uploaded at once.
+    """
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.total = sum(sizes.values())
+        self.sent = dict((f, 0) for f in sizes)
+        self.started = {}
+        self.finished = {}
+        self.wire = {}
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+
+    def callback(self, name):
+        """
+        Returns an S3Transfer progress callback that credits the bytes to the named file
+        """
+        def update(bytesAmount):
+            with self.lock:
+                self.sent[name] += bytesAmount
+        return update
+
+    def start(self, name):
+        with self.lock:
+            self.started[name] = time.time()
+
+    def finish(self, name):
+        with self.lock:
+            self.finished[name] = time.time()
+
+    def compressed(self, name, wireBytes):
+        """
+        Record the bytes actually sent for a file that was compressed on the way up
+        """
+        with self.lock:
+            self.wire[name] = wireBytes
+
+    def line(self):
+        """
+        One line status: bytes sent, aggregate bytes/sec, ETA and number of finished files
+        """
+        with self.lock:
+            sent = sum(self.sent.values())
+            done = len(self.finished)
+        elapsed = max(time.time() - self.startTime, 0.001)
+        rate = sent / elapsed
+        if rate > 0:
+            eta = formatDuration((self.total - sent) / rate)
+        else:
+            eta = "--:--"
+        return "\t{0} / {1} ({2}/s) ETA {3} [{4}/{5} files]".format(formatBytes(sent), formatBytes(self.total),
+            formatBytes(rate), eta, done, len(self.sizes))
+
+    def display(self, stop, interval=1.0):
+        """
+        Redraw the status line until the stop event is set (only when attached to a terminal)
+        """
+        if not sys.stdout.isatty():
+            stop.wait()
+            return
+        while not stop.wait(interval):
+            sys.stdout.write("\r{0}   ".format(self.line()))
+            sys.stdout.flush()
+        sys.stdout.write("\r{0}   \n".format(self.line()))
+
+    def summary(self, title="Upload summary"):
+        """
+        Print the per-file throughput once all transfers have completed
+        """
+        print("\n{0}:".format(title))
+        for name in sorted(self.finished, key=lambda n: self.started[n]):
+            seconds = max(self.finished[name] - self.started[name], 0.001)
+            print("\t{0}: {1} in {2} ({3}/s)".format(name, formatBytes(self.sizes[name]), formatDuration(seconds),
+                formatBytes(self.sizes[name] / seconds)))
+        elapsed = max(time.time() - self.startTime, 0.001)
+        print("\tTotal: {0} in {1} ({2}/s)".format(formatBytes(self.total), formatDuration(elapsed),
+            formatBytes(self.total / elapsed)))
+        if self.wire:
+            raw = sum(self.sizes[name] for name in self.wire)
+            sent = sum(self.wire.values())
+            print("\tCompressed: {0} file(s), {1} sent for {2} (saved {3}, {4:.0f}%), {5}/s effective".format(len(self.wire),
+                formatBytes(sent), formatBytes(raw), formatBytes(raw - sent), 100.0 * (raw - sent) / max(raw, 1), formatBytes(self.total / elapsed)))
+
+
+def formatBytes(n):
+    """
+    Human readable byte count (decimal units, to match getDataSize)
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1000:
+            return "{0:.1f}{1}".format(n, unit)
+        n = n / 1000.0
+    return "{0:.1f}TB".format(n)
+
+
+def formatDuration(seconds):
+    """
+    Format a number of seconds as [h:]mm:ss
+    """
+    seconds = int(round(seconds))
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    if h:
+        return "{0}:{1:02d}:{2:02d}".format(h, m, s)
+    return "{0:02d}:{1:02d}".format(m, s)
+
+
+def transferConfig(mqparams):
+    """
+    The multipart settings used for every upload and server-side copy of the job
+    """
+    loadAws()
+    partSize = mqparams.get('partSize', 64) * 1024 * 1024
+    return boto3.s3.transfer.TransferConfig(multipart_threshold=partSize, multipart_chunksize=partSize,
+        max_concurrency=mqparams.get('partWorkers', 4), use_threads=True)
+
+
+class TransferJournal(object):
+    """
+    A JSON file kept in the job directory that records every object that has been completely uploaded, every
+    multipart upload that is still in flight (upload ID and finished parts) and the submission stages that have
+    been completed. It is saved after every change so an interrupted submit can be picked up with --resume.
+    A journal without a path is kept in memory only.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {'objects': {}, 'multipart': {}, 'stages': {}}
+        if path and os.path.isfile(path):
+            with open(path) as fh:
+                self.data.update(json.load(fh))
+
+    def save(self):
+        """
+        Atomically rewrite the journal file (the caller must hold the lock)
+        """
+        if not self.path:
+            return
+        tmp = "{0}.tmp".format(self.path)
+        with open(tmp, 'w') as fh:
+            json.dump(self.data, fh, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    @staticmethod
+    def fileStamp(f):
+        st = os.stat(f)
+        return {'file': f, 'size': st.st_size, 'mtime': st.st_mtime}
+
+    def completed(self, key, f):
+        """
+        True if the journal says this file was uploaded to this key and the file has not changed since
+        """
+        with self.lock:
+            entry = self.data['objects'].get(key)
+        return entry is not None and all(entry.get(k) == v for k, v in self.fileStamp(f).items())
+
+    def objectDone(self, key, f, checksum=None):
+        with self.lock:
+            self.data['objects'][key] = self.fileStamp(f)
+            if checksum is not None:
+                self.data['objects'][key]['checksum'] = checksum
+            self.data['multipart'].pop(key, None)
+            self.save()
+
+    def checksum(self, key):
+        """
+        The checksum record (see UploadChecksum) of the file uploaded to this key, None if the journal has none
+        """
+        with self.lock:
+            return self.data['objects'].get(key, {}).get('checksum')
+
+    def multipart(self, key, f, partSize):
+        """
+        Return the in-flight multipart upload for this key if it was started for the same (unchanged) file
+        with the same part size, otherwise None
+        """
+        with self.lock:
+            entry = self.data['multipart'].get(key)
+        if entry is None:
+            return None
+        stamp = self.fileStamp(f)
+        if any(entry[k] != stamp[k] for k in stamp) or entry['partSize'] != partSize:
+            return None
+        return entry
+
+    def startMultipart(self, key, f, partSize, uploadId):
+        with self.lock:
+            entry = self.fileStamp(f)
+            entry.update({'partSize': partSize, 'uploadId': uploadId, 'parts': {}})
+            self.data['multipart'][key] = entry
+            self.save()
+            return entry
+
+    def partDone(self, key, partNumber, etag):
+        with self.lock:
+            self.data['multipart'][key]['parts'][str(partNumber)] = etag
+            self.save()
+
+    def stage(self, name, value=True):
+        with self.lock:
+            self.data['stages'][name] = value
+            self.save()
+
+    def get(self, name):
+        with self.lock:
+            return self.data['stages'].get(name)
+
+
+def journalPath(mqparams, jobFolder):
+    """
+    The transfer journal for a job lives in the job directory the job is submitted from
+    """
+    return jobPath(mqparams, ".mqsubmit-{0}.journal".format(jobFolder))
+
+
+def stagingDir(mqparams):
+    """
+    The job's copy of its configuration (and the shards' configurations) is written to this directory, next to the
+    transfer journal in the job directory
+    """
+    return jobPath(mqparams, ".mqsubmit-{0}-{1}".format(mqparams['department'], mqparams['jobName']))
+
+
+def abortStaleUploads(client, mqBucket, journal):
+    """
+    Abort the multipart uploads left in flight by a previous, abandoned submission so their parts are not kept
+    (and billed) by S3 forever
+    """
+    for key, entry in journal.data['multipart'].items():
+        try:
+            client.abort_multipart_upload(Bucket=mqBucket, Key=key, UploadId=entry['uploadId'])
+        except botocore.exceptions.ClientError:
+            pass
+
+
+def uploadedParts(client, mqBucket, key, uploadId):
+    """
+    Ask S3 which parts of a multipart upload it already has; returns {part number: etag}, or None if the
+    upload no longer exists (completed, aborted or expired)
+    """
+    parts = {}
+    try:
+        paginator = client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=mqBucket, Key=key, UploadId=uploadId):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = part['ETag']
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == "NoSuchUpload":
+            return None
+        raise e
+    return parts
+
+
+class UploadChecksum(object):
+    """
+    The checksums of a file computed from the bytes read to upload it, so it is never read just for them: the SHA-256
+    of the whole file, which goes in the job's manifest for the job server to check its download against, and the MD5
+    of every request body (Content-MD5), which S3 checks before it stores a part. A SHA-256 known before the upload
+    (from the blob store's hash or the hash cache) is checked before the object is completed.
+    """
+    def __init__(self, f, expected=None):
+        self.f = f
+        self.expected = expected
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def check(self):
+        """
+        Raise if the file is not what it was when its SHA-256 was computed before the upload
+        """
+        if self.expected is not None and self.sha256.hexdigest() != self.expected:
+            raise ValueError("{0} changed while it was being uploaded, submit the job again".format(self.f))
+
+    def record(self, **details):
+        """
+        What the journal and the job's manifest keep for the file: {'sha256', 'size'} and the details given
+        """
+        return dict(details, sha256=self.sha256.hexdigest(), size=self.size)
+
+
+def contentMd5(body):
+    """
+    The Content-MD5 header of a request body
+    """
+    return base64.b64encode(hashlib.md5(body).digest()).decode('ascii')
+
+
+def addChecksumMetadata(client, mqBucket, key, mqparams, metadata, record, contentType=None):
+    """
+    A multipart upload's metadata is set when it starts, so an object whose SHA-256 was only known once it was read
+    gets it afterwards: the object is copied onto itself with the metadata replaced (a multipart copy above 5GB).
+    """
+    if 'sha256' in metadata:
+        return
+    extraArgs = {'Metadata': dict(metadata, sha256=record['sha256']), 'MetadataDirective': 'REPLACE'}
+    if contentType is not None:
+        extraArgs['ContentType'] = contentType
+    client.copy({'Bucket': mqBucket, 'Key': key}, mqBucket, key, ExtraArgs=extraArgs, Config=transferConfig(mqparams))
+
+
+def putFile(client, mqBucket, f, key, mqparams, journal, callback, metadata=None):
+    """
+    Upload a single file, reading it once and computing its checksums (see UploadChecksum) on the way. Files smaller
+    than a part are sent with one PUT. Larger files are sent as a multipart upload: the parts are read in order, at
+    most 'partWorkers' of them ahead of the uploads, sent 'partWorkers' at a time and recorded in the journal as they
+    finish. If the journal has an upload in flight for this file, the parts S3 already has are read (for the checksum)
+    but not sent again. The object metadata has the file's SHA-256, added once the upload is complete if it was not
+    known before (see addChecksumMetadata).
+    Returns the file's checksum record.
+    """
+    if key.endswith(compressSuffix) and not f.endswith(compressSuffix):
+        return putCompressed(client, mqBucket, f, key, mqparams, journal, callback, metadata)
+
+    partSize = mqparams.get('partSize', 64) * 1024 * 1024
+    size = os.path.getsize(f)
+    metadata = dict(metadata or {})
+    checksum = UploadChecksum(f, metadata.get('sha256'))
+
+    if size <= partSize:
+        with open(f, 'rb') as fh:
+            body = fh.read()
+        checksum.update(body)
+        checksum.check()
+        metadata['sha256'] = checksum.sha256.hexdigest()
+        client.put_object(Bucket=mqBucket, Key=key, Body=body, ContentMD5=contentMd5(body), Metadata=metadata)
+        callback(size)
+        record = checksum.record()
+        journal.objectDone(key, f, record)
+        return record
+
+    done = {}
+    entry = journal.multipart(key, f, partSize)
+    if entry is not None:
+        done = uploadedParts(client, mqBucket, key, entry['uploadId'])
+    if entry is None or done is None:
+        res = client.create_multipart_upload(Bucket=mqBucket, Key=key, Metadata=metadata)
+        entry = journal.startMultipart(key, f, partSize, res['UploadId'])
+        done = {}
+    uploadId = entry['uploadId']
+
+    partCount = (size + partSize - 1) // partSize
+    etags = dict(done)
+    callback(sum(min(partSize, size - (n - 1) * partSize) for n in done))
+    slots = threading.BoundedSemaphore(mqparams.get('partWorkers', 4))
+    failed = threading.Event()
+
+    def sendPart(partNumber, body):
+        try:
+            res = client.upload_part(Bucket=mqBucket, Key=key, UploadId=uploadId, PartNumber=partNumber, Body=body,
+                ContentMD5=contentMd5(body))
+            journal.partDone(key, partNumber, res['ETag'])
+            callback(len(body))
+            return partNumber, res['ETag']
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            slots.release()
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=mqparams.get('partWorkers', 4)) as pool, open(f, 'rb') as fh:
+        for partNumber in range(1, partCount + 1):
+            body = fh.read(partSize)
+            checksum.update(body)
+            if partNumber in done:
+                continue
+            # wait for a free slot so the reader stays at most 'partWorkers' parts ahead of the uploads
+            slots.acquire()
+            if failed.is_set():
+                slots.release()
+                break
+            futures.append(pool.submit(sendPart, partNumber, body))
+        for future in as_completed(futures):
+            partNumber, etag = future.result()
+            etags[partNumber] = etag
+
+    # the parts stay in flight (and in the journal) if the file changed, a resubmit sends it again
+    checksum.check()
+    client.complete_multipart_upload(Bucket=mqBucket, Key=key, UploadId=uploadId,
+        MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etags[n]} for n in sorted(etags)]})
+    record = checksum.record()
+    addChecksumMetadata(client, mqBucket, key, mqparams, metadata, record)
+    journal.objectDone(key, f, record)
+    return record
+
+
+"""
+Compressed transport (mqsubmit --compress): text inputs (mzXML, mzML, FASTA) compress several fold, so they are gzip
+compressed on the fly as they are uploaded and stored as <name>.gz; the job server decompresses them after download.
+Vendor RAW files are already compressed and are sent as they are.
+"""
+compressExtensions = ['.mzxml', '.mzml', '.fasta', '.fa', '.faa']
+compressSuffix = ".gz"
+# Bytes of the local file compressed at a time
+compressChunk = 1024 * 1024
+
+
+def compressible(f):
+    """
+    Is the file a text input that is worth compressing for the upload
+    """
+    return os.path.splitext(f)[1].lower() in compressExtensions
+
+
+def uploadName(mqparams, f):
+    """
+    The name a job file is uploaded to the job folder under (with .gz added when it is sent compressed)
+    """
+    if mqparams.get('compress') and compressible(f):
+        return f + compressSuffix
+    return f
+
+
+def putCompressed(client, mqBucket, f, key, mqparams, journal, callback, metadata=None):
+    """
+    Upload a file gzip compressed on the fly. The file is read and compressed a chunk at a time and the compressed
+    stream is cut into multipart parts as they fill up, so no compressed copy is written and at most 'partWorkers'
+    parts are held in memory. The checksums (see UploadChecksum) are of the file as it is, before compression. The
+    object metadata records the encoding and the original size.
+    An interrupted compressed upload starts over rather than resuming part by part. Returns the file's checksum
+    record, with the bytes sent.
+    """
+    partSize = mqparams.get('partSize', 64) * 1024 * 1024
+    size = os.path.getsize(f)
+    metadata = dict(metadata or {}, encoding='gzip', size=str(size))
+    checksum = UploadChecksum(f, metadata.get('sha256'))
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    if size <= partSize:
+        with open(f, 'rb') as fh:
+            raw = fh.read()
+        checksum.update(raw)
+        checksum.check()
+        metadata['sha256'] = checksum.sha256.hexdigest()
+        body = compressor.compress(raw) + compressor.flush()
+        client.put_object(Bucket=mqBucket, Key=key, Body=body, ContentMD5=contentMd5(body), ContentType='application/gzip',
+            Metadata=metadata)
+        callback(size)
+        record = checksum.record(compressed=True, sent=len(body))
+        journal.objectDone(key, f, record)
+        return record
+
+    uploadId = client.create_multipart_upload(Bucket=mqBucket, Key=key, ContentType='application/gzip', Metadata=metadata)['UploadId']
+    slots = threading.BoundedSemaphore(mqparams.get('partWorkers', 4))
+
+    def sendPart(partNumber, body, raw):
+        try:
+            res = client.upload_part(Bucket=mqBucket, Key=key, UploadId=uploadId, PartNumber=partNumber, Body=body,
+                ContentMD5=contentMd5(body))
+            callback(raw)
+            return partNumber, res['ETag']
+        finally:
+            slots.release()
+
+    futures = []
+    sent = 0
+    try:
+        with ThreadPoolExecutor(max_workers=mqparams.get('partWorkers', 4)) as pool, open(f, 'rb') as fh:
+            pending, buffered, raw = [], 0, 0
+            while True:
+                chunk = fh.read(compressChunk)
+                checksum.update(chunk)
+                data = compressor.compress(chunk) if chunk else compressor.flush()
+                pending.append(data)
+                buffered += len(data)
+                raw += len(chunk)
+                if buffered >= partSize or not chunk:
+                    # wait for a free slot so the reader stays at most 'partWorkers' parts ahead of the uploads
+                    slots.acquire()
+                    futures.append(pool.submit(sendPart, len(futures) + 1, b''.join(pending), raw))
+                    sent += buffered
+                    pending, buffered, raw = [], 0, 0
+                if not chunk:
+                    break
+        etags = dict(future.result() for future in futures)
+        checksum.check()
+    except Exception:
+        client.abort_multipart_upload(Bucket=mqBucket, Key=key, UploadId=uploadId)
+        raise
+    client.complete_multipart_upload(Bucket=mqBucket, Key=key, UploadId=uploadId,
+        MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etags[n]} for n in sorted(etags)]})
+    record = checksum.record(compressed=True, sent=sent)
+    addChecksumMetadata(client, mqBucket, key, mqparams, metadata, record, 'application/gzip')
+    journal.objectDone(key, f, record)
+    return record
+
+
+def uploadFiles(client, mqBucket, uploads, mqparams, metadata=None, journal=None):
+    """
+    Upload a list of (local file, S3 key) pairs to the job bucket. Up to 'uploadWorkers' files are sent at once
+    and each file is split into 'partSize' MB multipart chunks that are sent 'partWorkers' at a time.
+    Optional per-file object metadata can be provided as a dict of {local file: {name: value}}.
+    Files the journal already records as uploaded are skipped. The checksums computed while uploading (see
+    UploadChecksum) are recorded in the journal and the hash cache, so a later submit with the blob store doesn't
+    read the files again to hash them.
+    Returns when every file has finished uploading; the first failure is re-raised.
+    """
+    journal = journal or TransferJournal()
+    metadata = metadata or {}
+    pending = [(f, key) for f, key in uploads if not journal.completed(key, f)]
+    if len(pending) < len(uploads):
+        print("\t{0} file(s) already uploaded by a previous attempt, skipping".format(len(uploads) - len(pending)))
+    progress = TransferProgress(dict((f, os.path.getsize(f)) for f, key in pending))
+    cache = loadHashCache()
+    hashed = {}
+
+    def upload(f, key):
+        progress.start(f)
+        fileMetadata = dict(metadata.get(f, {}))
+        stamp = journal.fileStamp(f)
+        if 'sha256' not in fileMetadata and cachedHash(f, cache):
+            fileMetadata['sha256'] = cachedHash(f, cache)
+        with phase(mqparams, 'upload', file=os.path.basename(f), key=key, bytes=progress.sizes[f]) as details:
+            try:
+                record = putFile(client, mqBucket, f, key, mqparams, journal, progress.callback(f), fileMetadata)
+            except ValueError:
+                # the SHA-256 the cache had for the file is wrong, the next submit hashes it again
+                hashed[os.path.abspath(f)] = {'size': -1, 'mtime': -1, 'sha256': None}
+                raise
+            if 'sent' in record:
+                progress.compressed(f, record['sent'])
+                details['sent'] = record['sent']
+        hashed[os.path.abspath(f)] = {'size': stamp['size'], 'mtime': stamp['mtime'], 'sha256': record['sha256']}
+        progress.finish(f)
+
+    # In a batch submit several jobs upload at once; their progress lines would write over each other
+    stop = threading.Event()
+    if mqparams.get('progress', True):
+        display = threading.Thread(target=progress.display, args=(stop,))
+    else:
+        display = threading.Thread(target=stop.wait)
+    display.daemon = True
+    display.start()
+    try:
+        with ThreadPoolExecutor(max_workers=mqparams.get('uploadWorkers', 4)) as pool:
+            futures = [pool.submit(upload, f, key) for f, key in pending]
+            for future in as_completed(futures):
+                future.result()
+    finally:
+        stop.set()
+        display.join()
+        if hashed:
+            saveHashCache(hashed)
+    progress.summary()
+    return progress
+
+
+"""
+Content addressed blob store: every data and FASTA file is stored once in the jobs bucket under blobs/<sha256> and
+server-side copied into each job folder that uses it, so files that are resubmitted are never uploaded twice.
+The local hash cache avoids re-reading files that have not changed since they were last hashed.
+"""
+blobPrefix = "blobs"
+hashCacheFile = os.path.join(os.path.expanduser('~'), '.mqsubmit', 'hashcache.json')
+# Blobs being uploaded by this process, {sha256: threading.Event set when the upload is over}
+blobsInFlight = {}
+blobsLock = threading.Lock()
+
+
+def loadHashCache(cacheFile=hashCacheFile):
+    """
+    Load the local sha256 cache, a dict of {absolute path: {'size': bytes, 'mtime': seconds, 'sha256': digest}}
+    """
+    try:
+        with open(cacheFile) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def saveHashCache(cache, cacheFile=hashCacheFile):
+    """
+    Save the local sha256 cache, merged with what other submits saved meanwhile; a cache that can't be written only
+    costs a re-hash next time
+    """
+    merged = loadHashCache(cacheFile)
+    merged.update(cache)
+    cache = merged
+    try:
+        if not os.path.isdir(os.path.dirname(cacheFile)):
+            os.makedirs(os.path.dirname(cacheFile))
+        tmp = "{0}.{1}".format(cacheFile, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump(cache, fh)
+        os.rename(tmp, cacheFile)
+    except (IOError, OSError):
+        pass
+
+
+def cachedHash(f, cache):
+    """
+    The sha256 hex digest of a file from the cache if the file has not changed since, otherwise None
+    """
+    path = os.path.abspath(f)
+    st = os.stat(path)
+    entry = cache.get(path)
+    if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+        return entry['sha256']
+    return None
+
+
+def hashFile(f, cache, blockSize=8 * 1024 * 1024):
+    """
+    Return the sha256 hex digest of a file. The cache is consulted (and updated) using the files
+    absolute path, size and modification time so that unchanged files are not read again.
+    """
+    path = os.path.abspath(f)
+    st = os.stat(path)
+    digest = cachedHash(path, cache)
+    if digest:
+        return digest
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blockSize), b''):
+            sha.update(block)
+    cache[path] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': sha.hexdigest()}
+    return cache[path]['sha256']
+
+
+def blobExists(client, mqBucket, digest):
+    """
+    Check to see if a blob with this sha256 (plus .gz for a compressed blob) has already been stored in the jobs bucket
+    """
+    try:
+        client.head_object(Bucket=mqBucket, Key="{0}/{1}".format(blobPrefix, digest))
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise e
+    return True
+
+
+def storeBlobs(client, mqBucket, files, mqparams, journal=None):
+    """
+    Put each (local file, S3 key) in the job folder by way of the blob store: hash it, upload it to blobs/<sha256>
+    only if that blob is not already there, then server-side copy the blob to its key in the job folder.
+    Files sent compressed (key ending in .gz) are stored as compressed blobs, blobs/<sha256>.gz.
+    """
+    journal = journal or TransferJournal()
+    workers = mqparams.get('uploadWorkers', 4)
+    paths = [f for f, key in files]
+    cache = loadHashCache()
+    sys.stdout.write("\tHashing {0} file(s)...".format(len(files)))
+    sys.stdout.flush()
+    with phase(mqparams, 'hash', files=len(paths)), ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = dict(zip(paths, pool.map(lambda f: hashFile(f, cache), paths)))
+    saveHashCache(cache)
+    print(" Done!")
+
+    # one upload per distinct blob, even if the same content is listed under two names
+    blobs = dict((f, digests[f] + (compressSuffix if key.endswith(compressSuffix) else "")) for f, key in files)
+    unique = {}
+    for f in paths:
+        unique.setdefault(blobs[f], f)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        present = dict(zip(unique, pool.map(lambda d: blobExists(client, mqBucket, d), unique)))
+    # Jobs of a batch share their data often; a blob another job of this process is already uploading is waited for
+    mine, waits = [], []
+    with blobsLock:
+        for d in unique:
+            if present[d]:
+                continue
+            if d in blobsInFlight:
+                waits.append(blobsInFlight[d])
+            else:
+                blobsInFlight[d] = threading.Event()
+                mine.append(d)
+    missing = [(unique[d], "{0}/{1}".format(blobPrefix, d)) for d in mine]
+    reused = [unique[d] for d in unique if present[d]]
+    if reused:
+        print("\t{0} file(s) ({1}) already in the blob store, skipping upload".format(len(reused),
+            formatBytes(sum(os.path.getsize(f) for f in reused))))
+    try:
+        if missing:
+            uploadFiles(client, mqBucket, missing, mqparams, metadata=dict((f, {'sha256': digests[f]}) for f, key in missing), journal=journal)
+    finally:
+        # Whether the upload worked or not the blob is no longer in flight; a later submit checks the store again
+        with blobsLock:
+            for d in mine:
+                blobsInFlight.pop(d).set()
+    for event in waits:
+        event.wait()
+
+    copies = [(f, key) for f, key in files if not journal.completed(key, f)]
+    sys.stdout.write("\tCopying {0} file(s) into the job folder...".format(len(copies)))
+    sys.stdout.flush()
+    config = transferConfig(mqparams)
+
+    def copy(f, key):
+        client.copy({'Bucket': mqBucket, 'Key': "{0}/{1}".format(blobPrefix, blobs[f])}, mqBucket, key, Config=config)
+        record = {'sha256': digests[f], 'size': os.path.getsize(f)}
+        if key.endswith(compressSuffix) and not f.endswith(compressSuffix):
+            record['compressed'] = True
+        journal.objectDone(key, f, record)
+
+    with phase(mqparams, 'blobCopy', files=len(copies)), ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(copy, f, key) for f, key in copies]
+        for future in as_completed(futures):
+            future.result()
+    print(" Done!")
+    return digests
+
+
+def jobManifest(jobFolder, files, journal):
+    """
+    The job's checksum manifest from the (local file, S3 key) pairs uploaded to the job folder:
+    {'algorithm': 'sha256', 'files': {name in the job server's job directory: {'sha256', 'size', 'key'}}}, the name
+    without the .gz of a file sent compressed, which the job server has decompressed before it checks it. The checksums
+    were computed as the files were uploaded; only a file a previous submit (from before the checksums) recorded as
+    uploaded is read to hash it.
+    """
+    cache, hashed = loadHashCache(), False
+    manifest = {}
+    for f, key in files:
+        record = journal.checksum(key)
+        if record is None:
+            hashed = True
+            record = {'sha256': hashFile(f, cache), 'size': os.path.getsize(f), 'compressed': key.endswith(compressSuffix) and not f.endswith(compressSuffix)}
+        name = key[len(jobFolder) + 1:]
+        if record.get('compressed'):
+            name = name[:-len(compressSuffix)]
+        manifest[name] = {'sha256': record['sha256'], 'size': record['size'], 'key': key}
+    if hashed:
+        saveHashCache(cache)
+    return {'algorithm': 'sha256', 'files': manifest}
+
+
+def uploadS3(mqBucket, jobFolder, mqparams, mqconfig, journal=None):
     """
     Upload the datafiles, fastafiles, configuration file, etc... needed by the job to
-    the job folder in the maxquant-jobs S3 bucket
-    """
-    client = boto3.client('s3', 'us-west-2')
-    transfer = boto3.s3.transfer.S3Transfer(client)
-    print("\nUploading data file(s)...")
-    for f in mqparams['mzxmlFiles']:
-        sys.stdout.write("\tUploading: {0}...".format(f))
-        transfer.upload_file(f, mqBucket, "{0}/{1}".format(jobFolder, f))
-        print(" Done!")
-    print("\nUploading FASTA file(s)...")
-    for f in mqparams['fastaFiles']:
-        sys.stdout.write("\tUploading: {0}...".format(f))
-        transfer.upload_file(f, mqBucket, "{0}/{1}".format(jobFolder, f))
-        print(" Done!")
+    the job folder in the maxquant-jobs S3 bucket. Progress is recorded in the (optional) transfer journal
+    so that an interrupted upload can be resumed.
+    """
+    journal = journal or TransferJournal()
+    client = awsClient('s3')
+
+    dataFiles = [(jobPath(mqparams, f), "{0}/{1}".format(jobFolder, uploadName(mqparams, f))) for f in mqparams['mzxmlFiles'] + mqparams['fastaFiles']]
+    uploads = []
+    if mqparams.get('dedup', True):
+        print("\nStoring {0} data and FASTA file(s) ({1} at a time)...".format(len(dataFiles), mqparams.get('uploadWorkers', 4)))
+        storeBlobs(client, mqBucket, dataFiles, mqparams, journal)
+    else:
+        uploads.extend(dataFiles)
+    # If a custom database and/or modifications file was provided, upload it to the job folder in S3
+    for custom in ['database', 'modifications']:
+        if custom in mqparams:
+            uploads.append((jobPath(mqparams, mqparams[custom]), "{0}/{1}".format(jobFolder, mqparams[custom])))
+
+    # The configuration of each shard of a sharded job
+    for shard in mqparams.get('shardPlan', []):
+        uploads.append((shard['path'], "{0}/{1}".format(jobFolder, shard['config'])))
+
+    if uploads:
+        print("\nUploading {0} file(s) ({1} at a time)...".format(len(uploads), mqparams.get('uploadWorkers', 4)))
+        uploadFiles(client, mqBucket, uploads, mqparams, journal=journal)
+
+    # The configuration file goes last; checkJobAlreadyExists keys off of it. It's the job's copy (see adjustConfig)
     sys.stdout.write("\nUploading configuration file...")
-    transfer.upload_file(mqconfig, mqBucket, "{0}/{1}".format(jobFolder, "mqpar.xml"))
+    staged = mqparams.get('stagedConfig', mqconfig)
+    configKey = "{0}/{1}".format(jobFolder, "mqpar.xml")
+    with phase(mqparams, 'uploadConfig', file='mqpar.xml', bytes=os.path.getsize(staged)):
+        putFile(client, mqBucket, staged, configKey, mqparams, journal, lambda n: None)
+    journal.stage('config')
     print(" Done!")
 
-    # If a custom database was provided, upload it to the job folder in S3
-    if 'database' in mqparams:
-        sys.stdout.write("\nUploading custom databases.xml file...")
-        transfer.upload_file(mqparams['database'], mqBucket, "{0}/{1}".format(jobFolder, mqparams['database']))
-        print(" Done!")
-
-    # If a custom modifications file was provided, upload it to the job folder in S3
-    if 'modifications' in mqparams:
-        sys.stdout.write("\nUploading custom modifications.xml file...")
-        transfer.upload_file(mqparams['modifications'], mqBucket, "{0}/{1}".format(jobFolder, mqparams['modifications']))
-        print(" Done!")
+    # The job server checks what it downloads against the checksums of the files as they were uploaded
+    with phase(mqparams, 'manifest'):
+        manifest = jobManifest(jobFolder, dataFiles + uploads + [(staged, configKey)], journal)
+        client.put_object(Body=json.dumps(manifest, indent=1, sort_keys=True), Bucket=mqBucket,
+            Key="{0}/{1}".format(jobFolder, manifestKey), ContentType='application/json')
 
+    # Every data object has finished uploading at this point, it is now safe to write the control objects
     sys.stdout.write("\nSetting Job Ready Flag...")
-    # Create a file object that contains metadata about the job
-    client.put_object(Body="{0},{1},{2}".format(mqparams['jobName'], mqparams['department'], mqparams['contactEmail']), Bucket = mqBucket, Key="{0}/jobCtrl/jobinfo.txt".format(jobFolder))
-    # Create a file object signaling that the job is ready to run
-    client.put_object(Body="ready", Bucket = mqBucket, Key="{0}/jobCtrl/ready.txt".format(jobFolder))
-    # Precalcuate and generate a temp url to the not yet created results and save it in a text file to use when job is complete 
-    resultsUrl = genTempUrl(mqBucket, jobFolder).strip()
-    client.put_object(Body = resultsUrl, Bucket = mqBucket, Key="{0}/jobCtrl/resultsUrl.txt".format(jobFolder))
+    with phase(mqparams, 'readyFlags'):
+        # Create a file object that contains metadata about the job
+        client.put_object(Body="{0},{1},{2}".format(mqparams['jobName'], mqparams['department'], mqparams['contactEmail']), Bucket = mqBucket, Key="{0}/jobCtrl/jobinfo.txt".format(jobFolder))
+        # Create a file object signaling that the job is ready to run
+        client.put_object(Body="ready", Bucket = mqBucket, Key="{0}/jobCtrl/ready.txt".format(jobFolder))
+        # Precalcuate and generate a temp url to the not yet created results and save it in a text file to use when job is complete 
+        resultsUrl = genTempUrl(mqBucket, jobFolder).strip()
+        client.put_object(Body = resultsUrl, Bucket = mqBucket, Key="{0}/jobCtrl/resultsUrl.txt".format(jobFolder))
+    journal.stage('ready')
     print(" Done!")
 
-def startWorker(mqBucket, mqparams, UserDataScript):
+def unzippedPolicy(value):
+    """
+    The parts of the combined folder a job server stores unzipped (next to the results bundle, which always has
+    everything) from --unzipped: a list of folders or files relative to combined/, '*' for all of it
+    """
+    if value is None or value.strip().lower() in ('', 'none'):
+        return []
+    subtrees = [v.strip().replace('\\', '/').strip('/') for v in value.split(',')]
+    return [v for v in subtrees if v]
+
+
+def powershellList(values):
+    """
+    The items of a PowerShell @(...) array of strings
+    """
+    return ", ".join("'{0}'".format(v.replace("'", "''")) for v in values)
+
+
+def startWorker(mqBucket, mqparams, UserDataScript, **script):
     """
     Create an job server in AWS/EC2. This process creates the server, installs maxquant and starts running the job (via user data script)
+    Any extra keyword arguments fill in the placeholders of the UserData script that are specific to it.
     """
     region = 'us-west-2'
     securityGroups = ['sg-a2dd8dc6']
-    instanceType = mqparams['instanceType']
-    subnetId = 'subnet-a95a0ede'
-    # The volume should be four times the size of the datafiles (room for resutls) and padded 150GB.
-    volumeSize = (getDataSize(mqparams['mzxmlFiles']) * 4) + 150 
     password = passwordGen(15)
-    UserData = UserDataScript.format(bucket = mqBucket, jobFolder = "{0}-{1}".format(mqparams['department'], mqparams['jobName']), jobContact = mqparams['contactEmail'], password = password)
-    image_id = find_image(region)
-    #image_id = 'ami-59ba7139'  # hack until ThermoFisher MSFileReader can be packaged, when fixed delete this and uncomment line above
-    instanceID = create_ec2worker(region, image_id, securityGroups, instanceType, subnetId, volumeSize, UserData, mqparams)
+    # A batch submit looks the image up once for all of its jobs
+    if 'image' in mqparams:
+        image_id, baked = mqparams['image']
+    else:
+        with phase(mqparams, 'imageLookup'):
+            image_id, baked = workerImage(region, mqparams['maxquantVersion'], mqparams.get('stockImage', False))
+    # Images baked with this MaxQuant version already have the software installed
+    if baked:
+        install = ""
+    else:
+        install = SoftwareInstallScript.format(maxquantVersion = mqparams['maxquantVersion'])
+    # Put the job directory on the NVMe instance store if the storage plan says so
+    storage = mqparams['storage']
+    if storage['scratch']:
+        scratch = ScratchScript
+    else:
+        scratch = ""
+    # The transfer functions don't fit in the 16KB of UserData with the rest of the script, the job server reads them
+    # from the job folder
+    jobFolder = "{0}-{1}".format(mqparams['department'], mqparams['jobName'])
+    transferKey = "{0}/{1}".format(jobFolder, transferScriptKey)
+    awsClient('s3').put_object(Bucket=mqBucket, Key=transferKey,
+        Body=TransferScript.format(region = region, partSize = workerPartSize * 1024 * 1024, workers = workerTransfers, manifest = manifestKey))
+    fields = {'shardWait': "", 'shardMerge': "", 'maxquantArgs': "", 'metrics': MetricsScript,
+        'transfer': TransferLoader.format(key = transferKey), 'unzipped': powershellList(mqparams.get('unzipped', []))}
+    fields.update(script)
+    fields.setdefault('verify', VerifyScript.format(names = "", failedKey = "$jobFolder/jobCtrl/failed.txt"))
+    # A spot job server keeps a checkpoint of its MaxQuant run and picks the job up again after an interruption
+    if spotMarket(mqparams):
+        fields.update({'spot': SpotScript, 'persist': SpotPersist, 'maxquant': "Invoke-MaxQuant 'C:/mq-job' $firstStep\n"})
+        if install:
+            install = SpotInstallScript.format(install = install)
+    else:
+        fields.update({'spot': "", 'persist': "", 'maxquant': "C:/MaxQuant/bin/MaxQuantCmd.exe C:/mq-job/mqpar.xml{0}\n".format(fields['maxquantArgs'])})
+    # Files sent with --compress are decompressed after they are downloaded
+    if mqparams.get('compress'):
+        fields['decompress'] = DecompressScript.format(jobDir = 'C:/mq-job')
+    else:
+        fields['decompress'] = ""
+
+    UserData = UserDataScript.format(bucket = mqBucket, jobFolder = jobFolder, jobContact = mqparams['contactEmail'], password = password, readyTimeout = mqparams.get('readyTimeout', 24), install = install, scratch = scratch, **fields)
+    options = launchOptions(mqparams, mqparams['instanceType'], storage, mqparams.get('plan', {}).get('memory'))
+    instanceID = create_ec2worker(region, image_id, securityGroups, options, storage, UserData, mqparams)
     return instanceID, password
 
+def startJobWorkers(mqBucket, mqparams, journal):
+    """
+    Start the job server, and for a sharded job one job server per shard as well. The shards run the per-file steps
+    on their share of the raw files and upload the per-file output folders; the job server gathers them and runs the
+    rest of the job. Returns the instance ID and Administrator password of the job server.
+    """
+    if not mqparams.get('shardPlan'):
+        return startWorker(mqBucket, mqparams, UserDataScript)
+
+    if not journal.get('shardInstances'):
+        def startShard(shard):
+            # shards run on-demand (a shard has no checkpoint) as the planned type or an equivalent
+            shardParams = dict(mqparams, instanceType=shard['instanceType'], storage=shard['storage'], plan=shard['plan'],
+                market='on-demand', instanceTypes=None)
+            files = ", ".join("'{0}'".format(uploadName(mqparams, f)) for f in shard['files'] + mqparams['fastaFiles'] + [manifestKey])
+            outputs = ", ".join("'{0}'".format(o) for o in shard['outputs'])
+            verify = VerifyScript.format(names = powershellList(shard['files'] + mqparams['fastaFiles']),
+                failedKey = "$jobFolder/jobCtrl/shards/$shard.failed")
+            return startWorker(mqBucket, shardParams, ShardScript, shard=shard['shard'], shardConfig=shard['config'], shardFiles=files,
+                shardOutputs=outputs, lastStep=mqshard.shardLastStep, shardPrefix=mqshard.shardPrefix, verify=verify)[0]
+        print("\nStarting {0} job servers for the shards...".format(len(mqparams['shardPlan'])))
+        with ThreadPoolExecutor(max_workers=len(mqparams['shardPlan'])) as pool:
+            journal.stage('shardInstances', list(pool.map(startShard, mqparams['shardPlan'])))
+
+    shardWait = ShardWaitScript.format(shards=len(mqparams['shardPlan']))
+    shardMerge = ShardMergeScript.format(shardPrefix=mqshard.shardPrefix, lastStep=mqshard.shardLastStep)
+    return startWorker(mqBucket, mqparams, UserDataScript, shardWait=shardWait, shardMerge=shardMerge, maxquantArgs=" --partial-processing=$firstStep")
+
 def genTempUrl(mqBucket, jobFolder):
     """
     Generate a temporary signed URL to the results bundle
     """
-    client = boto3.client('s3')
+    client = awsClient('s3')
     expiresIn = 2937600 # 34 days
     resultsBundleFile = "maxquant-{0}-results-combined.zip".format(jobFolder)
     url = client.generate_presigned_url('get_object', Params = {'Bucket': mqBucket, 'Key': "{0}/{1}".format(jobFolder, resultsBundleFile)}, ExpiresIn = expiresIn)
     return url
 
 
+def queueJob(mqBucket, jobFolder, mqparams):
+    """
+    Put the job on the shared job server queue, with the resources the scheduler packs it by: threads (cores),
+    estimated memory and disk. Jobs with custom databases/modifications are run on a server of their own, since
+    MaxQuant reads those from its program directory.
+    """
+    plan = mqparams['plan']
+    entry = {
+        'jobFolder': jobFolder,
+        'cores': int(plan['threads']),
+        'memory': plan['memory'] or 2.0 * int(plan['threads']),
+        'disk': scratchSize(mqparams),
+        'instanceType': plan['instanceType'],
+        'customConf': 'database' in mqparams or 'modifications' in mqparams,
+        'maxquantVersion': mqparams['maxquantVersion'],
+        'contactEmail': mqparams['contactEmail'],
+        'unzipped': mqparams.get('unzipped', []),
+        'queued': time.time(),
+    }
+    sys.stdout.write("\nQueueing job for a shared job server...")
+    awsClient('s3').put_object(Bucket=mqBucket, Key="{0}/{1}.json".format(queuePrefix, jobFolder), Body=json.dumps(entry))
+    print(" Done!")
+
+
 def checkfiles(files):
     """
     Check to see if the files exists before attempting to upload
@@ -242,61 +1521,250 @@ def checkfiles(files):
         sys.exit(1)
 
 
-def main(parms):
+def preflight(mqconfig, mqparams):
     """
-    Program execution starts and is driven from this function
+    Scan the data and FASTA files of the job (in parallel, see mqcheck.py) before anything is uploaded: truncated or
+    corrupt mzXML/mzML files, files that aren't Thermo RAW files and FASTA headers MaxQuant can't parse with the
+    job's identifierParseRule. Exits if any file has a problem. The per-file stats (scans, sequences) are kept in
+    mqparams['fileStats'] for the instance planner.
     """
+    inventory = configInventory(mqconfig, mqparams)
+    rules = inventory['fastaRules']
+    names = inventory['datafiles'] + inventory['fastaFiles']
+    files = [(jobPath(mqparams, f), rules.get(f)) for f in names]
+    sys.stdout.write("Checking {0} data and FASTA file(s)...".format(len(files)))
+    sys.stdout.flush()
+    started = time.time()
+    results = mqcheck.scanFiles(files)
+    print(" Done in {0}".format(formatDuration(time.time() - started)))
+
+    mqparams['fileStats'] = {}
+    failed = False
+    for name, result in zip(names, results):
+        stats = result['stats']
+        mqparams['fileStats'][name] = stats
+        if 'scans' in stats:
+            summary = "{0} scans".format(stats['scans'])
+        elif 'sequences' in stats:
+            summary = "{0} sequences, {1} residues".format(stats['sequences'], stats['residues'])
+        else:
+            summary = "ok"
+        if result['problems']:
+            failed = True
+            summary = "; ".join(result['problems'])
+        print("\t{0}: {1}".format(name, summary))
+        for warning in result['warnings']:
+            print("\t\twarning: {0}".format(warning))
+    if failed:
+        print("\nError: the job has input files MaxQuant would fail on (see above); fix them or submit with --no-preflight")
+        sys.exit(1)
+
+
+def commaList(value):
+    """
+    The items of a comma separated option, [] if it wasn't given
+    """
+    return [v.strip() for v in (value or '').split(',') if v.strip()]
 
-    print("\nMaxQuant version: %s\n" % maxquant_ver)
 
+def jobParams(parms, jobName, department, contact, jobDir=''):
+    """
+    Store the job metadata provided via command-line parameters in the mqparams dict that will hold all info about the job
+    """
     mqparams = {}
-    # Store the job metadata provided via command-line parameters in the mqparams dict that will hold all info about the job
-    mqparams['jobName'] = parms.jobname.strip().replace(' ','')
-    mqparams['department'] = parms.department.strip().replace(' ','')
-    mqparams['contactEmail'] = parms.contact.strip().replace(' ','')
+    mqparams['jobName'] = jobName.strip().replace(' ','')
+    mqparams['department'] = department.strip().replace(' ','')
+    mqparams['contactEmail'] = contact.strip().replace(' ','')
+    # The directory holding the job files (relative file names in the job are relative to it)
+    mqparams['jobDir'] = jobDir
+    # S3 upload tuning
+    mqparams['uploadWorkers'] = max(parms.uploadWorkers, 1)
+    mqparams['partSize'] = max(parms.partSize, 5)  # S3 does not allow multipart chunks smaller than 5MB
+    mqparams['partWorkers'] = max(parms.partWorkers, 1)
+    mqparams['dedup'] = parms.dedup
+    # Which MaxQuant version the job server runs, and whether to skip the baked image for it
+    mqparams['maxquantVersion'] = maxquant_ver
+    mqparams['stockImage'] = parms.stockImage
+    # Which planner picks the instance type and thread count
+    mqparams['planner'] = parms.planner
+    # How long a pipelined worker waits for the upload to finish before giving up
+    mqparams['readyTimeout'] = parms.readyTimeout
+    # Queue the job for a shared job server instead of starting one for it
+    mqparams['shared'] = parms.shared
+    # Send the text inputs compressed
+    mqparams['compress'] = parms.compress
+    # Scan the input files before submitting
+    mqparams['preflight'] = parms.preflight
+    # Split the per-file processing of the job over this many job servers
+    mqparams['shards'] = max(parms.shards, 1)
+    if mqparams['shared'] and mqparams['shards'] > 1:
+        print("A sharded job (--shards) can't be run on a shared job server (--shared)")
+        sys.exit(1)
+    # Phase timings of the submit, stored in the job folder for 'mqsubmit metrics'
+    mqparams['metrics'] = mqmetrics.PhaseTimer()
+    # The parts of the combined folder that are stored unzipped as well as in the results bundle
+    mqparams['unzipped'] = unzippedPolicy(parms.unzipped)
+    # How the job server is launched: spot or on-demand, the instance types and the subnets to try (see launchOptions)
+    mqparams['market'] = parms.market
+    mqparams['instanceTypes'] = commaList(parms.instanceTypes)
+    mqparams['subnets'] = commaList(parms.subnets)
+    unknown = [t for t in mqparams['instanceTypes'] if not instanceSpec(t)['vcpu']]
+    if unknown:
+        print("Unknown instance type(s) in --instance-types: {0}".format(", ".join(unknown)))
+        sys.exit(1)
+    if mqparams['shared'] and mqparams['market'] != 'on-demand':
+        print("A job on a shared job server (--shared) runs on-demand; --market doesn't apply to it")
+        sys.exit(1)
 
     # If a custom 'databases.xml' file is found in the job submission directory, include it.
-    if os.path.isfile("databases.xml"):
+    if os.path.isfile(jobPath(mqparams, "databases.xml")):
         print("Found custom 'databases.xml' file...")
         mqparams['database'] = "databases.xml"
 
     # If a custom 'modifications.xml' file is found in the job submission directory, include it.
-    if os.path.isfile("modifications.xml"):
+    if os.path.isfile(jobPath(mqparams, "modifications.xml")):
         print("Found custom 'modifications.xml' file...")
         mqparams['modifications'] = "modifications.xml"
+    return mqparams
 
-    # This is the top-level S3 bucket that all job folders will live under
-    mqBucket = "fredhutch-maxquant-jobs"
-    # The job files will be uploaded and run in this directory on the job server
-    mqdir = "c:\\mq-job\\"
+
+def prepareJob(mqBucket, mqconfig, mqparams, resume=False):
+    """
+    Adjust the configuration, check the job files and make sure the job can be submitted (or resumed).
+    Returns the transfer journal for the submission; exits if the job can't be submitted.
+    """
     # The job folder in S3 that will hold the data/results (child of the maxquant jobs bucket)
     jobFolder = "{0}-{1}".format(mqparams['department'], mqparams['jobName'])
+
+    # Scan the input files before anything is uploaded or started
+    if mqparams.get('preflight', True):
+        with phase(mqparams, 'preflight'):
+            preflight(mqconfig, mqparams)
+
+    sys.stdout.write("\nAdjusting MaxQuant configuration file: {0}...".format(mqconfig))
     
-    sys.stdout.write("Adjusting MaxQuant configuration file: {0}...".format(parms.mqconfig))
-    
-    # Adjust the config file (update paths, threads)
-    datafiles, fastas = adjustConfig(parms.mqconfig, mqdir, mqparams)
+    # Adjust the config file (update paths, threads); jobs for a shared job server each get their own directory
+    if mqparams.get('shared'):
+        mqdir = "{0}{1}\\".format(sharedJobServerDir, jobFolder)
+    else:
+        mqdir = jobServerDir
+    with phase(mqparams, 'config'):
+        datafiles, fastas = adjustConfig(mqconfig, mqdir, mqparams)
     print(" Done!")
 
     # Check to see that the data and fasta files listed in the maxquant configuration file (XML) are located in the job directory
-    checkfiles(datafiles)
-    checkfiles(fastas)
-
-    # Store the file inventory and calculated instance type in the mq job dictionary
-    mqparams['mzxmlFiles'] = [e.strip() for e in datafiles]
-    mqparams['fastaFiles'] = [e.strip() for e in fastas]
-    mqparams['instanceType'] = pickInstanceType(mqparams['mzxmlFiles'], mqparams)[0]
+    with phase(mqparams, 'checkFiles', files=len(datafiles) + len(fastas)):
+        checkfiles([jobPath(mqparams, f) for f in datafiles])
+        checkfiles([jobPath(mqparams, f) for f in fastas])
+
+    if resume:
+        # Pick up an interrupted submission where its transfer journal left off
+        if not os.path.isfile(journalPath(mqparams, jobFolder)):
+            print("\nThere is no interrupted submission of job '{0}' for the '{1}' department/lab to resume (missing {2})".format(mqparams['jobName'], mqparams['department'], journalPath(mqparams, jobFolder)))
+            sys.exit(1)
+        journal = TransferJournal(journalPath(mqparams, jobFolder))
+        if journal.get('instanceId') and journal.get('ready'):
+            print("\nJob '{0}' was already submitted and is running on instance {1}; there is nothing to resume".format(mqparams['jobName'], journal.get('instanceId')))
+            sys.exit(1)
+        print("Resuming the interrupted submission recorded in {0}...".format(journalPath(mqparams, jobFolder)))
+        mqparams['metrics'].info['resumed'] = True
+    else:
+        # Make sure that this is a uniqe job (department + jobname) so a previous jobs files in S3 don't get overwritten
+        with phase(mqparams, 'jobCheck'):
+            exists = checkJobAlreadyExists(mqBucket, jobFolder)
+        if exists:
+            print("\nThere is already an existing job named '{0}' for the '{1}' department/lab; choose a different job name and try again".format(mqparams['jobName'], mqparams['department']))
+            if os.path.isfile(journalPath(mqparams, jobFolder)):
+                print("If a previous submission of this job was interrupted, rerun the same command with --resume to finish it")
+            sys.exit(1)
+        # Start a fresh journal, cleaning up after any abandoned attempt that never reached the configuration upload
+        if os.path.isfile(journalPath(mqparams, jobFolder)):
+            abortStaleUploads(awsClient('s3'), mqBucket, TransferJournal(journalPath(mqparams, jobFolder)))
+            os.remove(journalPath(mqparams, jobFolder))
+        journal = TransferJournal(journalPath(mqparams, jobFolder))
+
+    return journal
+
+
+def submitJob(mqBucket, mqconfig, mqparams, journal, pipeline=False):
+    """
+    Upload the job files and start the job server (both at once for a pipelined submit).
+    Returns the instance ID and Administrator password of the job server.
+    """
+    jobFolder = "{0}-{1}".format(mqparams['department'], mqparams['jobName'])
 
-    # Make sure that this is a uniqe job (department + jobname) so a previous jobs files in S3 don't get overwritten
-    if checkJobAlreadyExists(mqBucket, jobFolder):
-        print("\nThere is already an existing job named '{0}' for the '{1}' department/lab; choose a different job name and try again".format(mqparams['jobName'], mqparams['department']))
-        sys.exit(1)
+    if mqparams.get('shared'):
+        # The scheduler (mqsched.py) packs the job onto a shared job server once it is uploaded
+        uploadS3(mqBucket, jobFolder, mqparams, mqconfig, journal)
+        queueJob(mqBucket, jobFolder, mqparams)
+        journal.stage('queued')
+        saveMetrics(mqBucket, jobFolder, mqparams, pipeline)
+        return None, None
+
+    # A worker launched by an earlier (pipelined) attempt is still waiting for the ready flag; don't start another
+    instanceID, password = journal.get('instanceId'), None
+    worker = None
+    if pipeline and not instanceID:
+        # Pipelined submit: boot the worker and install MaxQuant while the job files upload. The worker waits on the
+        # ready flag, which uploadS3 only sets after everything else is in S3.
+        print("\nLaunching the job server while the job files upload...")
+        launcher = ThreadPoolExecutor(max_workers=1)
+        worker = launcher.submit(startJobWorkers, mqBucket, mqparams, journal)
+
+        def recordWorker(w):
+            if w.exception() is None:
+                journal.stage('instanceId', w.result()[0])
+                journal.stage('launch', mqparams.get('launch'))
+        worker.add_done_callback(recordWorker)
+        launcher.shutdown(wait=False)
 
     # Upload all the jobs files to the S3 job folder
-    uploadS3(mqBucket, jobFolder, mqparams, parms.mqconfig)
-    
+    try:
+        uploadS3(mqBucket, jobFolder, mqparams, mqconfig, journal)
+    except Exception:
+        if worker is not None and worker.exception() is None:
+            print("\nThe upload failed; job server {0} will wait {1} hours for it to be finished with --resume".format(worker.result()[0], mqparams['readyTimeout']))
+        raise
+
     # Fetch information about the job server to provide conection infomation if job summitted with the --connect option
-    instanceID, password = startWorker(mqBucket, mqparams, UserDataScript)
+    if worker is not None:
+        instanceID, password = worker.result()
+    elif not instanceID:
+        instanceID, password = startJobWorkers(mqBucket, mqparams, journal)
+        journal.stage('instanceId', instanceID)
+        journal.stage('launch', mqparams.get('launch'))
+    saveMetrics(mqBucket, jobFolder, mqparams, pipeline)
+    return instanceID, password
+
+
+def main(parms):
+    """
+    Program execution starts and is driven from this function
+    """
+
+    print("\nMaxQuant version: %s\n" % maxquant_ver)
+
+    mqparams = jobParams(parms, parms.jobname, parms.department, parms.contact)
+    configureAws(mqparams['uploadWorkers'] * mqparams['partWorkers'] + 10)
+
+    # This is the top-level S3 bucket that all job folders will live under
+    mqBucket = jobsBucket
+    
+    if parms.plan:
+        # Dry run: show what the planner would pick for this job without changing or submitting anything
+        if mqparams['preflight']:
+            preflight(parms.mqconfig, mqparams)
+        adjustConfig(parms.mqconfig, jobServerDir, mqparams, write=False)
+        printPlan(mqparams)
+        return
+
+    journal = prepareJob(mqBucket, parms.mqconfig, mqparams, parms.resume)
+
+    # Upload all the jobs files to the S3 job folder and start the job server
+    instanceID, password = submitJob(mqBucket, parms.mqconfig, mqparams, journal, parms.pipeline)
+    if instanceID is None:
+        print("\nYour MaxQuant job has been queued for a shared job server. An email will be sent to {0} when complete with a link to download the results".format(mqparams['contactEmail']))
+        return
     instanceIP = getInstanceIP('us-west-2', instanceID)
 
     print("\nYour MaxQuant job has been successfully submitted. An email will be sent to {0} when complete with a link to download the results".format(mqparams['contactEmail']))
@@ -307,10 +1775,628 @@ def main(parms):
         print("\tServer: {0}".format(instanceIP))
         print("\tUsername: {0}".format("Administrator"))
         print("\tDomain: {0}".format("None - leave blank"))
-        print("\tPassword: {0}".format(password))
+        print("\tPassword: {0}".format(password or "(shown when the job server was first launched)"))
         print("\tStatus files: {0}".format('C:\\mq-job\\combined\\proc\\*'))
 
 
+def readManifest(manifest, parms):
+    """
+    Read a batch manifest: a CSV file with one job per line, 'mqconfig,jobname[,department[,email]]'. Blank lines and
+    lines starting with '#' are ignored, the department and email default to the --department and --email options and
+    mqpar.xml paths are relative to the manifest. Returns a list of (mqconfig, jobname, department, email, line number).
+    """
+    jobs = []
+    baseDir = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as fh:
+        for lineNumber, row in enumerate(csv.reader(fh), 1):
+            row = [c.strip() for c in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            row = row + [None] * (4 - len(row))
+            mqconfig, jobName, department, contact = row[:4]
+            jobs.append((os.path.join(baseDir, mqconfig), jobName, department or parms.department, contact or parms.contact, lineNumber))
+    return jobs
+
+
+def batchCommand(argv):
+    """
+    mqsubmit batch: validate every job of a manifest, then upload and launch them a few at a time sharing one AWS
+    session and one image lookup. Nothing is submitted if any job fails validation.
+    """
+    p = optparse.OptionParser(usage="%prog batch [options] <manifest>")
+    p.add_option('-d', '--department',  action='store', type='string', dest='department', help='[OPTIONAL] Department or lab for the jobs that do not list one')
+    p.add_option('-e', '--email',  action='store', type='string', dest='contact', help='[OPTIONAL] Email address for the jobs that do not list one')
+    p.add_option('-j', '--jobs',  action='store', type='int', dest='jobs', help='[OPTIONAL] Number of jobs to upload and launch at the same time (default: 4)')
+    p.set_defaults(jobs=4)
+    addSubmitOptions(p)
+    parms, args = p.parse_args(argv)
+    if len(args) != 1:
+        p.error("A manifest file is required")
+    if not os.path.isfile(args[0]):
+        p.error("Can't find manifest file {0}".format(args[0]))
+    parms.jobs = max(parms.jobs, 1)
+    configureAws(parms.jobs * max(parms.uploadWorkers, 1) * max(parms.partWorkers, 1) + 10)
+    mqBucket = jobsBucket
+
+    print("\nMaxQuant version: %s\n" % maxquant_ver)
+
+    # Validate every job before anything is uploaded
+    jobs = []
+    failed = []
+    seen = {}
+    for mqconfig, jobName, department, contact, lineNumber in readManifest(args[0], parms):
+        print("\n[{0}] line {1}: {2}".format(jobName, lineNumber, mqconfig))
+        if not (jobName and department and contact):
+            print("Error: a job name, department and email are required")
+            failed.append((jobName, lineNumber))
+            continue
+        if not os.path.isfile(mqconfig):
+            print("Error: can't find MaxQuant configuration file {0}".format(mqconfig))
+            failed.append((jobName, lineNumber))
+            continue
+        started = time.time()
+        mqparams = jobParams(parms, jobName, department, contact, jobDir=os.path.dirname(mqconfig))
+        mqparams['progress'] = False
+        jobFolder = "{0}-{1}".format(mqparams['department'], mqparams['jobName'])
+        if jobFolder in seen:
+            print("Error: job '{0}' is also on line {1} of the manifest".format(jobFolder, seen[jobFolder]))
+            failed.append((jobName, lineNumber))
+            continue
+        seen[jobFolder] = lineNumber
+        try:
+            journal = prepareJob(mqBucket, mqconfig, mqparams)
+        except SystemExit:
+            failed.append((jobName, lineNumber))
+            continue
+        jobs.append({'mqconfig': mqconfig, 'mqparams': mqparams, 'journal': journal, 'jobFolder': jobFolder, 'validate': time.time() - started})
+
+    if failed:
+        print("\n{0} of {1} job(s) failed validation, nothing was submitted:".format(len(failed), len(failed) + len(jobs)))
+        for jobName, lineNumber in failed:
+            print("\tline {0}: {1}".format(lineNumber, jobName))
+        sys.exit(1)
+    if not jobs:
+        print("\nThe manifest has no jobs")
+        sys.exit(1)
+
+    # One image lookup for the whole batch
+    image = workerImage('us-west-2', maxquant_ver, parms.stockImage)
+    for job in jobs:
+        job['mqparams']['image'] = image
+
+    def run(job):
+        started = time.time()
+        try:
+            job['instanceId'], password = submitJob(mqBucket, job['mqconfig'], job['mqparams'], job['journal'], parms.pipeline)
+            job['status'] = 'queued' if job['mqparams']['shared'] else 'submitted'
+        except Exception as e:
+            job['instanceId'] = None
+            job['status'] = "failed: {0}".format(e)
+        job['submit'] = time.time() - started
+        return job
+
+    print("\nSubmitting {0} job(s), {1} at a time...".format(len(jobs), parms.jobs))
+    with ThreadPoolExecutor(max_workers=parms.jobs) as pool:
+        list(pool.map(run, jobs))
+
+    columns = "{0:<32} {1:<20} {2:<14} {3:>9} {4:>9}  {5}"
+    print("\n" + columns.format("Job", "Instance", "Type", "Validate", "Submit", "Status"))
+    for job in jobs:
+        print(columns.format(job['jobFolder'], job['instanceId'] or '-', job['mqparams']['instanceType'],
+            formatDuration(job['validate']), formatDuration(job['submit']), job['status']))
+    if any(job['status'] not in ('submitted', 'queued') for job in jobs):
+        print("\nRerun the failed job(s) on their own with 'mqsubmit ... --resume' to finish them")
+        sys.exit(1)
+
+
+"""
+Telemetry: every phase of a submit is timed (see mqmetrics.py) and stored in the job folder as jobCtrl/metrics/submit.json;
+the job servers add their own timestamps next to it. 'mqsubmit metrics' merges both sides into one timeline per job,
+or aggregates the timelines of many jobs.
+"""
+
+
+def phase(mqparams, name, **details):
+    """
+    Time a phase of the submit in the job's metrics (a throwaway timer if the job doesn't keep any)
+    """
+    timer = mqparams.get('metrics') or mqmetrics.PhaseTimer()
+    return timer.phase(name, **details)
+
+
+def saveMetrics(mqBucket, jobFolder, mqparams, pipeline=False):
+    """
+    Store the phase timings of the submit in the job folder. Telemetry is not worth failing a submit over, so an error
+    is only reported.
+    """
+    data = mqparams['metrics'].data()
+    data['info'] = dict(data['info'], jobFolder=jobFolder, maxquantVersion=mqparams['maxquantVersion'],
+        instanceType=mqparams.get('instanceType'), shards=len(mqparams.get('shardPlan', [])) or 1, pipeline=pipeline,
+        shared=mqparams.get('shared', False), compress=mqparams.get('compress', False), launch=mqparams.get('launch'))
+    key = "{0}/{1}/{2}.json".format(jobFolder, mqmetrics.metricsPrefix, mqmetrics.submitSide)
+    try:
+        awsClient('s3').put_object(Bucket=mqBucket, Key=key, Body=json.dumps(data, indent=1, sort_keys=True), ContentType='application/json')
+    except botocore.exceptions.ClientError as e:
+        print("\nWarning: the submit timings could not be saved to {0}: {1}".format(key, e))
+
+
+def loadMetrics(client, mqBucket, jobFolder):
+    """
+    The timelines stored in a job folder, {side: timeline} (submit, worker, shard-N)
+    """
+    sides = {}
+    prefix = "{0}/{1}/".format(jobFolder, mqmetrics.metricsPrefix)
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=mqBucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            name = obj['Key'][len(prefix):]
+            if name.endswith('.json') and '/' not in name:
+                body = client.get_object(Bucket=mqBucket, Key=obj['Key'])['Body'].read()
+                # PowerShell may write a byte order mark
+                sides[name[:-len('.json')]] = json.loads(body.decode('utf-8-sig'))
+    return sides
+
+
+def listJobFolders(client, mqBucket, prefix=''):
+    """
+    The top-level folders of the jobs bucket whose names start with the prefix (a department, say), leaving out the
+    blob store, the shared job server queue and the scheduler's state
+    """
+    folders = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=mqBucket, Prefix=prefix, Delimiter='/'):
+        for common in page.get('CommonPrefixes', []):
+            folder = common['Prefix'].rstrip('/')
+            if folder not in (blobPrefix, queuePrefix, 'scheduler'):
+                folders.append(folder)
+    return folders
+
+
+def formatPhase(seconds):
+    """
+    The length of a phase: seconds (to a tenth) for short phases, [h:]mm:ss for the rest
+    """
+    if seconds < 60:
+        return "{0:.1f}s".format(seconds)
+    return formatDuration(seconds)
+
+
+def phaseDetails(p):
+    """
+    The details of a phase for the timeline table: file and transfer rate for uploads, name=value for the rest
+    """
+    details = []
+    if 'file' in p:
+        details.append(p['file'])
+    if 'bytes' in p:
+        details.append("{0} at {1}/s".format(formatBytes(p['bytes']), formatBytes(p['bytes'] / max(p['seconds'], 0.001))))
+    if 'sent' in p:
+        details.append("{0} sent".format(formatBytes(p['sent'])))
+    for name in sorted(p):
+        if name not in ('phase', 'side', 'start', 'end', 'seconds', 'offset', 'file', 'bytes', 'sent', 'key'):
+            details.append("{0}={1}".format(name, p[name]))
+    return ", ".join(details)
+
+
+def metricsCommand(argv):
+    """
+    mqsubmit metrics: show the merged submit and job server timeline of jobs, or with --aggregate the per-phase
+    statistics over many jobs (the job folders given, or every job folder starting with --prefix)
+    """
+    p = optparse.OptionParser(usage="%prog metrics [options] <department-jobname> [...]\n       %prog metrics --aggregate [--prefix <department>] [<department-jobname> ...]")
+    p.add_option('-a', '--aggregate',  action='store_true', dest='aggregate', help='[OPTIONAL] Per-phase statistics over all of the jobs instead of a timeline per job')
+    p.add_option('-p', '--prefix',  action='store', type='string', dest='prefix', help='[OPTIONAL] Include every job folder whose name starts with this (e.g. a department)')
+    p.add_option('--json',  action='store_true', dest='json', help='[OPTIONAL] Print JSON instead of a table')
+    p.add_option('-w', '--workers',  action='store', type='int', dest='workers', help='[OPTIONAL] Number of job folders to read at the same time (default: 16)')
+    p.set_defaults(aggregate=False, json=False, workers=16)
+    parms, args = p.parse_args(argv)
+    if not args and parms.prefix is None:
+        p.error("Name at least one job folder (department-jobname) or use --prefix")
+    configureAws(max(parms.workers, 1) + 4)
+    mqBucket = jobsBucket
+    client = awsClient('s3')
+
+    folders = list(args)
+    if parms.prefix is not None:
+        folders.extend(f for f in listJobFolders(client, mqBucket, parms.prefix) if f not in folders)
+    with ThreadPoolExecutor(max_workers=max(parms.workers, 1)) as pool:
+        sides = dict(zip(folders, pool.map(lambda f: loadMetrics(client, mqBucket, f), folders)))
+    timelines = dict((f, mqmetrics.timeline(sides[f])) for f in folders if sides[f])
+    missing = [f for f in folders if not sides[f]]
+
+    if parms.aggregate:
+        stats = mqmetrics.aggregate(timelines)
+        if parms.json:
+            print(json.dumps({'jobs': sorted(timelines), 'phases': stats}, indent=1, sort_keys=True))
+        else:
+            print("\nPhase timings over {0} job(s):".format(len(timelines)))
+            columns = "{0:<10} {1:<14} {2:>5} {3:>9} {4:>9} {5:>9} {6:>9}"
+            print(columns.format("Side", "Phase", "Jobs", "Mean", "Median", "P90", "Max"))
+            for s in stats:
+                print(columns.format(s['side'], s['phase'], s['jobs'], formatPhase(s['mean']), formatPhase(s['median']),
+                    formatPhase(s['p90']), formatPhase(s['max'])))
+    elif parms.json:
+        print(json.dumps(timelines, indent=1, sort_keys=True))
+    else:
+        for folder in sorted(timelines):
+            print("\nTimeline of job {0} (from the start of the submit):".format(folder))
+            columns = "{0:>9} {1:>9}  {2:<10} {3:<14} {4}"
+            print(columns.format("Start", "Length", "Side", "Phase", "Details"))
+            for ph in timelines[folder]:
+                print(columns.format("+" + formatDuration(ph['offset']), formatPhase(ph['seconds']), ph['side'], ph['phase'], phaseDetails(ph)))
+    if missing:
+        sys.stderr.write("No timings found for {0} job folder(s): {1}\n".format(len(missing), ", ".join(missing)))
+    if not timelines:
+        sys.exit(1)
+
+
+"""
+Results retrieval: 'mqsubmit fetch' downloads single files of a finished job's results, from the combined/ prefix of
+the job folder for the files the job server stored unzipped, the rest as members of the results bundle read with range
+requests (see mqfetch.py). Every file is downloaded in ranges, several at a time, checked and can be resumed.
+"""
+
+
+def listCombined(client, mqBucket, jobFolder):
+    """
+    The files the job server uploaded under the job's combined/ prefix: {path relative to combined/: object}, in one
+    paginated listing
+    """
+    prefix = "{0}/{1}/".format(jobFolder, mqfetch.combinedPrefix)
+    files = {}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=mqBucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('/'):
+                files[obj['Key'][len(prefix):]] = obj
+    return files
+
+
+def rangeReader(client, mqBucket, key):
+    """
+    A readRange(start, end) function for an object: the bytes from start up to (not including) end
+    """
+    def readRange(start, end):
+        if end <= start:
+            return b''
+        return client.get_object(Bucket=mqBucket, Key=key, Range="bytes={0}-{1}".format(start, end - 1))['Body'].read()
+    return readRange
+
+
+def multipartSize(client, mqBucket, key):
+    """
+    The part size of an object uploaded in parts (the size of part 1), needed to check its ETag; None if S3 won't say
+    """
+    try:
+        return client.head_object(Bucket=mqBucket, Key=key, PartNumber=1)['ContentLength']
+    except botocore.exceptions.ClientError:
+        return None
+
+
+def fetchRanges(client, mqBucket, key, start, length, part, name, entry, journal, progress, pool):
+    """
+    Download length bytes of an object, from start, into the part file with ranged GETs run in the pool. Ranges the
+    journal entry records as done (by an interrupted fetch) are not downloaded again.
+    """
+    if not os.path.isfile(part) or os.path.getsize(part) != length:
+        if entry['ranges']:
+            journal.reset(name)
+        with open(part, 'wb') as fh:
+            fh.truncate(length)
+    done = set(entry['ranges'])
+    progress.callback(name)(sum(min(rangeStart + mqfetch.rangeSize, start + length) - rangeStart for rangeStart in done))
+
+    def download(rangeStart, rangeEnd):
+        body = client.get_object(Bucket=mqBucket, Key=key, Range="bytes={0}-{1}".format(rangeStart, rangeEnd - 1))['Body']
+        with open(part, 'r+b') as fh:
+            fh.seek(rangeStart - start)
+            for chunk in iter(lambda: body.read(mqfetch.readSize), b''):
+                fh.write(chunk)
+                progress.callback(name)(len(chunk))
+        journal.rangeDone(name, rangeStart)
+
+    futures = [pool.submit(download, rangeStart, rangeEnd) for rangeStart, rangeEnd in mqfetch.ranges(start, length)
+        if rangeStart not in done and rangeEnd > rangeStart]
+    for future in as_completed(futures):
+        future.result()
+
+
+def fetchObject(client, mqBucket, name, obj, dest, journal, progress, pool):
+    """
+    Fetch one file of the combined/ prefix and check it against the object's ETag
+    """
+    target = os.path.join(dest, *name.split('/'))
+    part = target + ".part"
+    entry = journal.entry(name, {'key': obj['Key'], 'etag': obj['ETag']})
+    fetchRanges(client, mqBucket, obj['Key'], 0, obj['Size'], part, name, entry, journal, progress, pool)
+    partSize = multipartSize(client, mqBucket, obj['Key']) if '-' in obj['ETag'] else None
+    if mqfetch.etagMatches(part, obj['ETag'], partSize) is False:
+        os.remove(part)
+        journal.reset(name)
+        raise ValueError("the download does not match the object's ETag")
+    os.rename(part, target)
+    journal.fileDone(name)
+
+
+def fetchMember(client, mqBucket, name, member, bundle, dest, journal, progress, pool):
+    """
+    Fetch one member of the results bundle: its compressed data with range requests, then inflated and checked
+    against the CRC-32 in the zip's central directory
+    """
+    target = os.path.join(dest, *name.split('/'))
+    part = target + ".part"
+    entry = journal.entry(name, {'key': bundle['Key'], 'etag': bundle['ETag'], 'member': member['name']})
+    start = mqfetch.memberDataOffset(rangeReader(client, mqBucket, bundle['Key']), member)
+    fetchRanges(client, mqBucket, bundle['Key'], start, member['compressedSize'], part, name, entry, journal, progress, pool)
+    try:
+        mqfetch.inflate(part, target + ".tmp", member)
+    except (ValueError, zlib.error):
+        for f in (part, target + ".tmp"):
+            if os.path.isfile(f):
+                os.remove(f)
+        journal.reset(name)
+        raise
+    os.rename(target + ".tmp", target)
+    os.remove(part)
+    journal.fileDone(name)
+
+
+def fetchCommand(argv):
+    """
+    mqsubmit fetch: download some (or all) of the results of a finished job without the whole results bundle
+    """
+    p = optparse.OptionParser(usage="%prog fetch [options] <department-jobname>")
+    p.add_option('-o', '--only',  action='append', dest='only', help='[OPTIONAL] Files to fetch, relative to the combined folder (e.g. txt/proteinGroups.txt), a folder (txt) or a pattern (txt/*.txt); comma separated or repeated. Default: everything')
+    p.add_option('-d', '--dest',  action='store', type='string', dest='dest', help='[OPTIONAL] Folder to save the files to (default: <department-jobname>/combined)')
+    p.add_option('-l', '--list',  action='store_true', dest='list', help='[OPTIONAL] Only list the files that would be fetched')
+    p.add_option('-w', '--workers',  action='store', type='int', dest='workers', help='[OPTIONAL] Number of ranged downloads to run at the same time (default: 8)')
+    p.set_defaults(only=[], list=False, workers=8)
+    parms, args = p.parse_args(argv)
+    if len(args) != 1:
+        p.error("Name the job folder (department-jobname) to fetch results from")
+    jobFolder = args[0].strip('/')
+    only = [o.strip() for option in parms.only for o in option.split(',') if o.strip()]
+    dest = parms.dest or os.path.join(jobFolder, mqfetch.combinedPrefix)
+    workers = max(parms.workers, 1)
+    configureAws(workers * 2 + 4)
+    mqBucket = jobsBucket
+    client = awsClient('s3')
+
+    # The files stored unzipped under the combined/ prefix (see --unzipped), the rest from the results bundle;
+    # the bundle isn't needed when every file asked for by name is stored unzipped
+    files = dict((name, obj) for name, obj in listCombined(client, mqBucket, jobFolder).items() if mqfetch.selected(name, only))
+    members, bundle = {}, None
+    if not only or any(o not in files for o in only):
+        key = "{0}/{1}".format(jobFolder, mqfetch.resultsBundle.format(jobFolder))
+        try:
+            head = client.head_object(Bucket=mqBucket, Key=key)
+            bundle = {'Key': key, 'ETag': head['ETag'], 'Size': head['ContentLength']}
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ("404", "NoSuchKey"):
+                raise e
+        if bundle is not None:
+            try:
+                zipped = mqfetch.zipMembers(rangeReader(client, mqBucket, key), bundle['Size'])
+            except ValueError as e:
+                print("Can't read the results bundle {0}: {1}".format(key, e))
+                sys.exit(1)
+            members = dict((m['name'], m) for m in zipped if mqfetch.selected(m['name'], only) and m['name'] not in files)
+    if not files and not members:
+        if only:
+            print("None of the results of job {0} match {1}".format(jobFolder, ", ".join(only)))
+        else:
+            print("No results found for job {0}; it may still be running (see 'mqsubmit metrics {0}')".format(jobFolder))
+        sys.exit(1)
+    sizes = dict((name, obj['Size']) for name, obj in files.items())
+    sizes.update((name, m['size']) for name, m in members.items())
+
+    if parms.list:
+        print("\n{0} file(s), {1}: {2} stored unzipped, {3} in the results bundle only (*)".format(len(sizes),
+            formatBytes(sum(sizes.values())), len(files), len(members)))
+        for name in sorted(sizes):
+            print("\t{0:>10}  {1}{2}".format(formatBytes(sizes[name]), name, " *" if name in members else ""))
+        return
+
+    # Files a previous fetch finished (and checked) are kept
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    journal = mqfetch.FetchJournal(os.path.join(dest, ".mqsubmit-fetch.journal"))
+    pending = []
+    for name in sorted(sizes):
+        entry = journal.data['files'].get(name)
+        target = os.path.join(dest, *name.split('/'))
+        source = files[name]['ETag'] if name in files else bundle['ETag']
+        if entry and entry['done'] and entry['source'].get('etag') == source and os.path.isfile(target) and os.path.getsize(target) == sizes[name]:
+            continue
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        pending.append(name)
+    print("\nFetching {0} file(s) of job {1} to {2} ({3} from the results bundle)".format(len(pending), jobFolder, dest,
+        len([name for name in pending if name in members])))
+    if len(pending) < len(sizes):
+        print("\t{0} file(s) already fetched by a previous attempt, skipping".format(len(sizes) - len(pending)))
+    progress = TransferProgress(dict((name, files[name]['Size'] if name in files else members[name]['compressedSize']) for name in pending))
+
+    def fetch(name):
+        progress.start(name)
+        if name in files:
+            fetchObject(client, mqBucket, name, files[name], dest, journal, progress, rangePool)
+        else:
+            fetchMember(client, mqBucket, name, members[name], bundle, dest, journal, progress, rangePool)
+        progress.finish(name)
+
+    failed = []
+    stop = threading.Event()
+    display = threading.Thread(target=progress.display, args=(stop,))
+    display.daemon = True
+    display.start()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as rangePool, ThreadPoolExecutor(max_workers=workers) as filePool:
+            futures = dict((filePool.submit(fetch, name), name) for name in pending)
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except (ValueError, zlib.error, botocore.exceptions.ClientError) as e:
+                    failed.append("{0}: {1}".format(futures[future], e))
+    finally:
+        stop.set()
+        display.join()
+    progress.summary("Fetch summary")
+    if failed:
+        print("\nError: {0} file(s) could not be fetched (rerun the same command to retry them):".format(len(failed)))
+        for f in sorted(failed):
+            print("\t{0}".format(f))
+        sys.exit(1)
+
+
+"""
+Job status: 'mqsubmit status' shows the state of the jobs in the bucket (or of one department), joined with their
+EC2 instances, from one listing of the job folders, one listing of each job's jobCtrl/ folder, one of the shared job
+server queue and one paginated DescribeInstances; with --watch it keeps refreshing (see mqstatus.py).
+"""
+
+
+def epochSeconds(when):
+    """
+    A datetime from boto3 (in UTC) as seconds since the epoch
+    """
+    return calendar.timegm(when.utctimetuple())
+
+
+def listJobFlags(client, mqBucket, jobFolder):
+    """
+    The objects under a job's jobCtrl/ folder: {name under jobCtrl/: (time written, ETag)}
+    """
+    prefix = "{0}/jobCtrl/".format(jobFolder)
+    flags = {}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=mqBucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            flags[obj['Key'][len(prefix):]] = (epochSeconds(obj['LastModified']), obj['ETag'])
+    return flags
+
+
+def loadWorkerMarks(client, mqBucket, jobFolder):
+    """
+    The marks the job server of a job has written so far, None if there are none
+    """
+    try:
+        body = client.get_object(Bucket=mqBucket, Key="{0}/{1}/worker.json".format(jobFolder, mqmetrics.metricsPrefix))['Body'].read()
+    except botocore.exceptions.ClientError:
+        return None
+    # PowerShell may write a byte order mark
+    return json.loads(body.decode('utf-8-sig'))
+
+
+def listSharedJobs(client, mqBucket):
+    """
+    Where the shared jobs are: {job folder: {'queued': True}} for the jobs waiting in the queue, {job folder:
+    {'worker': id}} for the jobs assigned to a shared job server (scheduler/workers/<id>/assignments/<job folder>.json)
+    """
+    shared = {}
+    for prefix in (queuePrefix + "/", "scheduler/workers/"):
+        for page in client.get_paginator('list_objects_v2').paginate(Bucket=mqBucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                parts = obj['Key'][len(prefix):].split('/')
+                if len(parts) == 1 and parts[0].endswith('.json') and prefix != "scheduler/workers/":
+                    shared[parts[0][:-len('.json')]] = {'queued': True}
+                elif len(parts) == 3 and parts[1] == 'assignments' and parts[2].endswith('.json'):
+                    shared[parts[2][:-len('.json')]] = {'worker': parts[0]}
+    return shared
+
+
+def listJobInstances(client, department=None):
+    """
+    The EC2 instances of MaxQuant jobs (of a department, and the shared job servers), found by their Name tag with one
+    paginated DescribeInstances
+    """
+    names = ["maxquant-{0}-*".format(department), "maxquant-shared-*"] if department else ["maxquant-*"]
+    instances = []
+    for page in client.get_paginator('describe_instances').paginate(Filters=[{'Name': 'tag:Name', 'Values': names}]):
+        for reservation in page.get('Reservations', []):
+            for i in reservation.get('Instances', []):
+                tags = dict((t['Key'], t['Value']) for t in i.get('Tags', []))
+                instances.append({'name': tags.get('Name'), 'instanceId': i['InstanceId'], 'state': i['State']['Name'],
+                    'instanceType': i['InstanceType'], 'market': i.get('InstanceLifecycle', 'on-demand'), 'launchTime': epochSeconds(i['LaunchTime'])})
+    return instances
+
+
+def statusLine(s):
+    """
+    A job's row of the status table
+    """
+    instance = "-"
+    if s['instances']:
+        instance = "{0} {1}".format(s['instances'][0]['instanceId'], s['instances'][0]['state'])
+        if len(s['instances']) > 1:
+            instance += " +{0}".format(len(s['instances']) - 1)
+    seconds = lambda value: formatPhase(value) if value is not None else "-"
+    phases = ", ".join("{0} {1}".format(p['phase'], formatPhase(p['seconds'])) for p in s['phases'])
+    return "{0:<32} {1:<9} {2:<13} {3:>9} {4:>9}  {5:<30} {6}".format(s['jobFolder'], s['state'], s['phase'] or "-",
+        seconds(s['phaseSeconds']), seconds(s['totalSeconds']), instance, phases)
+
+
+def statusCommand(argv):
+    """
+    mqsubmit status: the state of every job (or of one department's jobs), the phase it is in and how long each phase
+    took, with the EC2 instances running it
+    """
+    if sys.version_info[0] < 3:
+        sys.exit("Error: 'mqsubmit status' needs Python 3")
+    # asyncio: only imported here so the rest of mqsubmit still runs under Python 2
+    import mqstatus
+    p = optparse.OptionParser(usage="%prog status [options]")
+    p.add_option('-d', '--department',  action='store', type='string', dest='department', help='[OPTIONAL] Only show the jobs of this department or lab')
+    p.add_option('-w', '--watch',  action='store_true', dest='watch', help='[OPTIONAL] Keep refreshing until every job has finished')
+    p.add_option('-i', '--interval',  action='store', type='int', dest='interval', help='[OPTIONAL] Seconds between refreshes with --watch while jobs change; the wait grows to {0} seconds while they do not (default: {1})'.format(mqstatus.maxInterval, mqstatus.minInterval))
+    p.add_option('-a', '--active',  action='store_true', dest='active', help='[OPTIONAL] Leave out the jobs that are done or failed')
+    p.add_option('--json',  action='store_true', dest='json', help='[OPTIONAL] Print JSON instead of a table (one line per refresh with --watch)')
+    p.add_option('--workers',  action='store', type='int', dest='workers', help='[OPTIONAL] Number of job folders to read at the same time (default: 16)')
+    p.set_defaults(watch=False, interval=mqstatus.minInterval, active=False, json=False, workers=16)
+    parms, args = p.parse_args(argv)
+    if args:
+        p.error("status takes no arguments (use --department to pick the jobs)")
+    configureAws(max(parms.workers, 1) + 4)
+    mqBucket = jobsBucket
+    client = awsClient('s3')
+    prefix = "{0}-".format(parms.department) if parms.department else ''
+    monitor = mqstatus.StatusMonitor(lambda: listJobFolders(client, mqBucket, prefix),
+        lambda jobFolder: listJobFlags(client, mqBucket, jobFolder),
+        lambda jobFolder: loadWorkerMarks(client, mqBucket, jobFolder),
+        lambda: listSharedJobs(client, mqBucket),
+        lambda: listJobInstances(awsClient('ec2'), parms.department),
+        workers=max(parms.workers, 1))
+
+    def show(statuses, wait):
+        if parms.active:
+            statuses = [s for s in statuses if s['state'] not in mqstatus.finalStates]
+        if parms.json:
+            if parms.watch:
+                print(json.dumps({'time': time.time(), 'jobs': statuses}, sort_keys=True))
+            else:
+                print(json.dumps(statuses, indent=1, sort_keys=True))
+            sys.stdout.flush()
+            return
+        if parms.watch and sys.stdout.isatty():
+            sys.stdout.write("\033[H\033[J")
+        counts = dict((state, 0) for state in mqstatus.states)
+        for s in statuses:
+            counts[s['state']] += 1
+        print("\n{0} job(s){1} at {2}: {3}".format(len(statuses), " of " + parms.department if parms.department else "",
+            time.strftime('%Y-%m-%d %H:%M:%S'), ", ".join("{0} {1}".format(counts[state], state) for state in mqstatus.states if counts[state])))
+        if statuses:
+            print("{0:<32} {1:<9} {2:<13} {3:>9} {4:>9}  {5:<30} {6}".format("Job", "State", "Phase", "In phase", "Total", "Instance", "Phases"))
+            for s in statuses:
+                print(statusLine(s))
+        if wait is not None:
+            print("\nNext refresh in {0} (Ctrl-C to stop)".format(formatPhase(wait)))
+        sys.stdout.flush()
+
+    try:
+        if parms.watch:
+            mqstatus.run(mqstatus.watch(monitor, show, max(parms.interval, 1), max(parms.interval, mqstatus.maxInterval)))
+        else:
+            show(mqstatus.run(monitor.refresh()), None)
+    except KeyboardInterrupt:
+        print("")
+
+
 def checkRequiredArguments(parms, p):
     """
     Check to make sure all required parameters where provided and the data/fasta file defined in the maxquant
@@ -324,72 +2410,85 @@ def checkRequiredArguments(parms, p):
     if len(missing_options) > 0:
         p.error('Missing REQUIRED parameters: ' + str(missing_options))
     
-    if not os.path.isfile(parms.mqconfig):
+    if hasattr(parms, 'mqconfig') and not os.path.isfile(parms.mqconfig):
         p.error("Can't find specified MaxQuant configuration file {0}".format(parms.mqconfig))
 
 
-def create_ec2worker(region, image_id, securityGroups, instanceType, subnetId, volumeSize, UserData, mqparams):
+def instanceTags(mqparams):
+    """
+    The tags of a job server (and its volume)
+    """
+    return [{'Key': 'Name', 'Value': "maxquant-{0}-{1}".format(mqparams['department'], mqparams['jobName'])},
+        {'Key': 'technical_contact', 'Value': mqparams['contactEmail']},
+        {'Key': 'billing_contact', 'Value': mqparams['contactEmail']},
+        {'Key': 'description', 'Value': 'Maxquant worker node'},
+        {'Key': 'owner', 'Value': mqparams['department']},
+        {'Key': 'sle', 'Value': 'hours=variable / grant=no / phi=no / pii=no / public=no'}
+        ]
+
+
+def create_ec2worker(region, image_id, securityGroups, options, storage, UserData, mqparams):
     """
-    Creates, tags, and starts a MaxQuant worker instance
+    Creates and starts a MaxQuant worker instance, tagged as it is launched. The launch options (see launchOptions)
+    are tried in order; an option EC2 has no capacity for (or that runs into a limit) is given up on at once for the
+    next one. The option the instance was launched with is recorded in mqparams['launch'].
     """
     # Connect to AWS
     sys.stdout.write("\nConnecting to AWS EC2 Region {0}...".format(region))
-    ec2 = boto3.resource('ec2', region_name = "{0}".format(region))
+    ec2 = awsClient('ec2', region)
     print(" Done!")
     # Create an EC2 instance
     sys.stdout.write("\nCreating EC2 instance...")
-    res = ec2.create_instances(
-        ImageId = image_id,
-        SubnetId = subnetId,
-        MinCount = 1,
-        MaxCount = 1,
-        KeyName = 'rmcdermo-fredhutch_key',
-        SecurityGroupIds = securityGroups,
-        InstanceType = instanceType,
-        Monitoring = {'Enabled': True},
-        UserData = UserData,
-        BlockDeviceMappings = [
-            {
-                'DeviceName': '/dev/sda1',
-                'Ebs': {
-                        'VolumeSize': volumeSize,
-                        'DeleteOnTermination': True,
-                        'VolumeType': 'gp2'
-                        }
-            }],
-        IamInstanceProfile={'Arn': 'arn:aws:iam::458818213009:instance-profile/maxquant'}
-        )
-
-    instanceId = res[0].id
-    print(" Instance {0} created".format(instanceId))
-
-
-    # Sleep for a bit to make sure the instances are ready to be tagged 
-    time.sleep(15)
-
-    # Tag the job server
-    sys.stdout.write("\nTagging EC2 instance...")
-    ec2.create_tags(Resources=["{0}".format(instanceId)],
-        Tags=[{'Key': 'Name', 'Value': "maxquant-{0}-{1}".format(mqparams['department'], mqparams['jobName'])},
-            {'Key': 'technical_contact', 'Value': mqparams['contactEmail']},
-            {'Key': 'billing_contact', 'Value': mqparams['contactEmail']},
-            {'Key': 'description', 'Value': 'Maxquant worker node'},
-            {'Key': 'owner', 'Value': mqparams['department']},
-            {'Key': 'sle', 'Value': 'hours=variable / grant=no / phi=no / pii=no / public=no'}
-            ])
-    print(" Done!")
-    return instanceId
+    tags = instanceTags(mqparams)
+    failures = []
+    for option in options:
+        request = {}
+        if option['market'] == 'spot':
+            request['InstanceMarketOptions'] = spotMarketOptions
+        try:
+            with phase(mqparams, 'runInstances', **option):
+                res = ec2.run_instances(
+                    ImageId = image_id,
+                    SubnetId = option['subnetId'],
+                    MinCount = 1,
+                    MaxCount = 1,
+                    KeyName = 'rmcdermo-fredhutch_key',
+                    SecurityGroupIds = securityGroups,
+                    InstanceType = option['instanceType'],
+                    Monitoring = {'Enabled': True},
+                    UserData = UserData,
+                    BlockDeviceMappings = blockDeviceMappings(storage),
+                    IamInstanceProfile={'Arn': 'arn:aws:iam::458818213009:instance-profile/maxquant'},
+                    TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags}, {'ResourceType': 'volume', 'Tags': tags}],
+                    **request
+                    )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in capacityErrors:
+                raise e
+            failures.append("{0} {1} in {2}: {3}".format(option['market'], option['instanceType'], option['subnetId'], e.response['Error']['Code']))
+            error = e
+            continue
+        instanceId = res['Instances'][0]['InstanceId']
+        mqparams['launch'] = dict(option, instanceId=instanceId, attempts=len(failures) + 1)
+        print(" Instance {0} created ({1} {2} in {3})".format(instanceId, option['market'], option['instanceType'], option['subnetId']))
+        for failure in failures:
+            print("\t{0}, tried the next option".format(failure))
+        return instanceId
+
+    print(" Failed!")
+    for failure in failures:
+        print("\t{0}".format(failure))
+    raise error
 
 
 def getInstanceIP(region, instanceID):
     """
     Determine the IP address of the jobs server
     """
-    ec2 = boto3.resource('ec2', region_name = "{0}".format(region))
-    # Get instance object
-    i = ec2.Instance(instanceID)
+    ec2 = awsClient('ec2', region)
     # Get instance private IP
-    ipAddr = i.private_ip_address
+    res = ec2.describe_instances(InstanceIds=[instanceID])
+    ipAddr = res['Reservations'][0]['Instances'][0].get('PrivateIpAddress')
     return ipAddr
 
 
@@ -398,8 +2497,8 @@ def find_image(region):
     Finds the latest Windows 2012R2 offical Amazon AMI and returns the ID
     """
     sys.stdout.write("\nFinding latest Windows 2012R2 image...")
-    ec2 = boto3.resource('ec2', region_name = "{0}".format(region))
-    images = ec2.images.filter(
+    ec2 = awsClient('ec2', region)
+    images = ec2.describe_images(
         Owners=['amazon'],
         Filters=[
             {'Name': 'name','Values': ['Windows_Server-2012-R2_RTM-English-64Bit-Base-*']},
@@ -411,21 +2510,717 @@ def find_image(region):
             ]
     )
     candidates = {}
-    for image in images:
-        candidates[image.creation_date] = image.image_id
+    for image in images['Images']:
+        candidates[image['CreationDate']] = image['ImageId']
     cDate = sorted(candidates.keys(), reverse=True)[0]
     ami = candidates[cDate]
     print(" Selected {0}".format(ami))
     return(ami)
 
+"""
+Image catalog: job server images baked with a MaxQuant version pre-installed are recorded, keyed by MaxQuant version, in a
+catalog in the software bucket. A local copy of the catalog (plus the last stock image found by find_image) is kept so
+that most submits don't have to look anything up at all.
+"""
+imageBucket = "fredhutch-maxquant"
+imageCatalogKey = "images/catalog.json"
+imageCacheFile = os.path.join(os.path.expanduser('~'), '.mqsubmit', 'images.json')
+# How long the local copy of the catalog and the last stock image lookup are trusted
+imageCacheTTL = 24 * 3600
+# Baked images older than this are skipped (they miss Windows updates); re-run 'mqsubmit bake' to refresh them
+bakedImageMaxAge = 90 * 24 * 3600
+
+
+def loadImageCatalog(region):
+    """
+    Return the image catalog {'images': {maxquant version: {'imageId', 'created', ...}}} from S3
+    """
+    client = awsClient('s3', region)
+    try:
+        body = client.get_object(Bucket=imageBucket, Key=imageCatalogKey)['Body'].read()
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            return {'images': {}}
+        raise e
+    return json.loads(body.decode('utf-8'))
+
+
+def saveImageCatalog(region, catalog):
+    client = awsClient('s3', region)
+    client.put_object(Bucket=imageBucket, Key=imageCatalogKey, Body=json.dumps(catalog, indent=1, sort_keys=True))
+
+
+def loadImageCache():
+    try:
+        with open(imageCacheFile) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def saveImageCache(cache):
+    try:
+        if not os.path.isdir(os.path.dirname(imageCacheFile)):
+            os.makedirs(os.path.dirname(imageCacheFile))
+        with open(imageCacheFile, 'w') as fh:
+            json.dump(cache, fh, indent=1, sort_keys=True)
+    except (IOError, OSError):
+        pass
+
+
+def workerImage(region, version, stockOnly=False):
+    """
+    Pick the image for a job server: the baked image for this MaxQuant version if there is a current one, otherwise the
+    latest stock Windows image (in which case the UserData script has to install the software).
+    Returns the AMI ID and whether it is a baked image.
+    """
+    now = time.time()
+    cache = loadImageCache()
+    if not stockOnly:
+        if now - cache.get('fetched', 0) > imageCacheTTL:
+            cache['images'] = loadImageCatalog(region)['images']
+            cache['fetched'] = now
+            saveImageCache(cache)
+        entry = cache.get('images', {}).get(version)
+        if entry and now - entry['created'] < bakedImageMaxAge:
+            print("\nUsing MaxQuant {0} image {1}".format(version, entry['imageId']))
+            return entry['imageId'], True
+        if entry:
+            print("\nThe MaxQuant {0} image {1} is out of date; run 'mqsubmit bake' to refresh it".format(version, entry['imageId']))
+    stock = cache.get('stock')
+    if stock and stock.get('region') == region and now - stock['checked'] < imageCacheTTL:
+        print("\nUsing Windows 2012R2 image {0}".format(stock['imageId']))
+        return stock['imageId'], False
+    ami = find_image(region)
+    cache['stock'] = {'imageId': ami, 'region': region, 'checked': now}
+    saveImageCache(cache)
+    return ami, False
+
+
+def bakeImage(region, version, contact):
+    """
+    Build a job server image with MSFileReader and the given MaxQuant version installed: launch a stock Windows
+    instance that installs the software and stops itself, image it, and record the image in the catalog.
+    """
+    client = awsClient('ec2', region)
+    s3 = awsClient('s3', region)
+    bakeId = "{0}-{1}".format(version, time.strftime("%Y%m%d%H%M%S"))
+    bakeFlag = "images/bake/{0}/installed.txt".format(bakeId)
+    UserData = BakeScript.format(install = SoftwareInstallScript.format(maxquantVersion = version), maxquantVersion = version, bakeFlag = bakeFlag)
+    baseImage = find_image(region)
+    bakeparams = {'department': 'scicomp', 'jobName': "bake-{0}".format(version), 'contactEmail': contact}
+    storage = {'volumeSize': 60, 'volumeType': 'gp3', 'iops': 3000, 'throughput': 125}
+    instanceId = create_ec2worker(region, baseImage, ['sg-a2dd8dc6'], launchOptions(bakeparams, 'c4.large', storage), storage, UserData, bakeparams)
+    try:
+        sys.stdout.write("\nWaiting for the software install to finish...")
+        sys.stdout.flush()
+        client.get_waiter('instance_stopped').wait(InstanceIds=[instanceId], WaiterConfig={'Delay': 30, 'MaxAttempts': 120})
+        try:
+            s3.head_object(Bucket=imageBucket, Key=bakeFlag)
+        except botocore.exceptions.ClientError:
+            print(" Failed!")
+            print("Error: MaxQuant {0} was not installed; check the system log of instance {1}".format(version, instanceId))
+            sys.exit(1)
+        print(" Done!")
+
+        sys.stdout.write("\nCreating image...")
+        sys.stdout.flush()
+        image = client.create_image(InstanceId=instanceId, Name="maxquant-{0}".format(bakeId),
+            Description="MaxQuant {0} job server (base {1})".format(version, baseImage))
+        imageId = image['ImageId']
+        client.get_waiter('image_available').wait(ImageIds=[imageId], WaiterConfig={'Delay': 30, 'MaxAttempts': 120})
+        client.create_tags(Resources=[imageId], Tags=[{'Key': 'Name', 'Value': "maxquant-{0}".format(version)},
+            {'Key': 'maxquant_version', 'Value': version}, {'Key': 'technical_contact', 'Value': contact}])
+        print(" {0} available".format(imageId))
+    finally:
+        client.terminate_instances(InstanceIds=[instanceId])
+
+    catalog = loadImageCatalog(region)
+    catalog['images'][version] = {'imageId': imageId, 'created': time.time(), 'baseImage': baseImage}
+    saveImageCatalog(region, catalog)
+    # Make this machine pick up the new image right away
+    cache = loadImageCache()
+    cache['images'] = catalog['images']
+    cache['fetched'] = time.time()
+    saveImageCache(cache)
+    print("\nMaxQuant {0} job servers will now start from image {1}".format(version, imageId))
+    return imageId
+
+
+def bakeCommand(argv):
+    """
+    mqsubmit bake: build (or rebuild) the job server image for a MaxQuant version
+    """
+    p = optparse.OptionParser(usage="%prog bake [options]")
+    p.add_option('-v', '--version',  action='store', type='string', dest='version', help='[OPTIONAL] MaxQuant version to install (default: {0})'.format(maxquant_ver))
+    p.add_option('-e', '--email',  action='store', type='string', dest='contact', help='[REQUIRED] Your email address; used to tag the image')
+    p.set_defaults(version=maxquant_ver)
+    parms, args = p.parse_args(argv)
+    checkRequiredArguments(parms, p)
+    bakeImage('us-west-2', parms.version, parms.contact.strip())
+
+
+"""
+SoftwareInstallScript: The part of the UserData script that installs MSFileReader and MaxQuant on the job server. It is
+left out when the job server is started from an image that was baked (mqsubmit bake) with the MaxQuant version already installed.
+"""
+SoftwareInstallScript = """Write-Host "Downloading Thermo Fisher MSFileReader 3.0SP3"
+Read-S3Object -BucketName 'fredhutch-maxquant' -Key 'MSFileReader_3.0SP3.msi' -File 'C:/MSFileReader_3.0SP3.msi'
+Write-Host "Installing MSFileReader_3.0SP3.msi"
+Start-Process "C:/MSFileReader_3.0SP3.msi" /qn -Wait
+Write-Host "Downloading MaxQuant application"
+Read-S3Object -BucketName 'fredhutch-maxquant' -Key 'MaxQuant_{maxquantVersion}.zip' -File 'C:/MaxQuant_{maxquantVersion}.zip'
+$BackUpPath = 'C:/MaxQuant_{maxquantVersion}.zip'
+$Destination = 'C:/'
+Write-Host "Unzipping MaxQuant application"
+Add-Type -assembly "system.io.compression.filesystem"
+[io.compression.zipfile]::ExtractToDirectory($BackUpPath, $Destination)
+"""
+
+"""
+BakeScript: The PowerShell script run by the instance that 'mqsubmit bake' turns into a job server image. It installs the
+software, re-enables UserData handling so the script of each job runs when an instance is launched from the image,
+reports success to S3 and shuts the instance down so the image can be created.
+"""
+BakeScript = """<powershell>
+Import-Module AwsPowerShell
+{install}
+Write-Host "Enabling UserData handling for instances launched from this image"
+$ec2config = 'C:/Program Files/Amazon/Ec2ConfigService/Settings/config.xml'
+$xml = [xml](Get-Content $ec2config)
+foreach ($plugin in $xml.Ec2ConfigurationSettings.Plugins.Plugin) {{
+if ($plugin.Name -eq 'Ec2HandleUserData') {{$plugin.State = 'Enabled'}}
+}}
+$xml.Save($ec2config)
+if (Test-Path 'C:/MaxQuant/bin/MaxQuantCmd.exe') {{
+Write-S3Object -BucketName 'fredhutch-maxquant' -Key "{bakeFlag}" -Content "{maxquantVersion}"
+}}
+Write-Host "All Done! Shutting down so the image can be created..."
+Stop-Computer -Force -Confirm:$false
+</powershell>
+"""
+
+"""
+ScratchScript: Part of the UserData script, used when the job server has an NVMe instance store. It formats the instance
+store disk(s) (striped if there is more than one) as S: and makes C:/mq-job and the temp folder point at it.
+If that fails the job simply runs from the root volume.
+"""
+ScratchScript = """Write-Host "Formatting the NVMe instance store for the job directory"
+$scratchDisks = @(Get-PhysicalDisk -CanPool $true)
+if ($scratchDisks.Count -gt 1) {
+New-StoragePool -FriendlyName 'scratch' -StorageSubSystemFriendlyName 'Storage Spaces*' -PhysicalDisks $scratchDisks | New-VirtualDisk -FriendlyName 'scratch' -ResiliencySettingName Simple -NumberOfColumns $scratchDisks.Count -UseMaximumSize | Initialize-Disk -PartitionStyle GPT -PassThru | New-Partition -DriveLetter S -UseMaximumSize | Format-Volume -FileSystem NTFS -NewFileSystemLabel 'scratch' -Confirm:$false
+}
+else {
+Get-Disk | Where-Object PartitionStyle -eq 'RAW' | Select-Object -First 1 | Initialize-Disk -PartitionStyle GPT -PassThru | New-Partition -DriveLetter S -UseMaximumSize | Format-Volume -FileSystem NTFS -NewFileSystemLabel 'scratch' -Confirm:$false
+}
+if (Test-Path 'S:/') {
+New-Item -ItemType Directory -Path 'S:/mq-job', 'S:/temp' -Force | Out-Null
+cmd /c mklink /J C:\\mq-job S:\\mq-job
+$env:TEMP = 'S:/temp'
+$env:TMP = 'S:/temp'
+[Environment]::SetEnvironmentVariable('TEMP', 'S:/temp', 'Machine')
+[Environment]::SetEnvironmentVariable('TMP', 'S:/temp', 'Machine')
+}
+else {
+Write-Host -ForegroundColor Red "Instance store not available, using the root volume"
+}
+"""
+
+"""
+DecompressScript: Part of the UserData script of jobs submitted with --compress. It decompresses the downloaded .gz
+job files in the job directory, several at a time (one background job per core), and removes the .gz files.
+"""
+DecompressScript = """$compressed = @(Get-ChildItem "{jobDir}" -Filter '*.gz' | Where-Object {{-not $_.PSIsContainer}})
+if ($compressed.Count -gt 0) {{
+Write-Host "Decompressing $($compressed.Count) job file(s)"
+$decompress = {{
+param($path)
+$source = [IO.File]::OpenRead($path)
+$gzip = New-Object IO.Compression.GZipStream($source, [IO.Compression.CompressionMode]::Decompress)
+$target = [IO.File]::Create($path.Substring(0, $path.Length - 3))
+$gzip.CopyTo($target, 1048576)
+$target.Close()
+$gzip.Close()
+Remove-Item $path
+}}
+foreach ($file in $compressed) {{
+while (@(Get-Job -State Running).Count -ge [Environment]::ProcessorCount) {{Start-Sleep -Milliseconds 500}}
+Start-Job -ScriptBlock $decompress -ArgumentList $file.FullName | Out-Null
+}}
+Get-Job | Wait-Job | Receive-Job
+Get-Job | Remove-Job
+}}
+"""
+
+"""
+VerifyScript: Part of the UserData scripts. It checks the downloaded (and decompressed) job files against the checksums
+of the job's manifest (see Test-JobFiles); if one of them is missing or differs the job is flagged as failed, naming the
+files, and the server shuts down instead of running MaxQuant on them.
+"""
+VerifyScript = """Write-Phase 'verify'
+$badFiles = @(Test-JobFiles 'C:/mq-job' @({names}))
+if ($badFiles.Count -gt 0) {{
+Write-Host -ForegroundColor Red "Job files do not match what was uploaded: $($badFiles -join ', ')"
+Write-S3Object -BucketName $bucket -Key "{failedKey}" -Content "the checksums of $($badFiles.Count) job file(s) do not match what was uploaded: $($badFiles -join ', ')"
+Write-Phase 'failed'
+Stop-Computer -Force -Confirm:$false
+exit 1
+}}
+"""
+
+"""
+SpotScript: Part of the UserData script of a job server that may be a spot instance (--market). EC2 stops a spot job
+server when it takes the capacity back and starts it again later (see spotMarketOptions); the UserData is kept
+(<persist>) so the script runs again then: a job that is over is left alone, the software installed the first time is
+not installed again (SpotInstallScript) and a job that has a checkpoint in the job directory skips the download and
+continues MaxQuant after the last step it finished (see Invoke-MaxQuant).
+"""
+SpotScript = """if ((Get-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/done.txt") -or (Get-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/failed.txt")) {
+Stop-Computer -Force -Confirm:$false
+exit
+}
+$spotRequest = (Get-EC2Instance -InstanceId (Invoke-RestMethod 'http://169.254.169.254/latest/meta-data/instance-id')).Instances[0].SpotInstanceRequestId
+$restarted = [bool](Get-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/running.txt")
+$resume = $restarted -and (Test-Path 'C:/mq-job/jobCtrl/checkpoint.json')
+if ($restarted) {Write-Phase 'restart'}
+"""
+SpotPersist = "<persist>true</persist>\n"
+SpotInstallScript = """if (-not $restarted) {{
+{install}}}
+"""
+
+"""
+MetricsScript: Part of the UserData scripts. It defines Write-Phase, which marks the start of a phase of the job server's
+run (seconds since the epoch, UTC) and writes the marks so far to jobCtrl/metrics/$metricsName.json for 'mqsubmit
+metrics', and marks the boot of the server and the start of the UserData script. Once a spot job server is done (or
+has failed) it cancels its spot request, so that EC2 doesn't start it again (see SpotScript).
+"""
+MetricsScript = """$epoch = [datetime]'1970-01-01'
+$metrics = New-Object System.Collections.ArrayList
+function Write-Phase($phase, $time = (Get-Date).ToUniversalTime()) {
+$metrics.Add(@{phase = $phase; time = ($time - $epoch).TotalSeconds}) | Out-Null
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/metrics/$metricsName.json" -Content (ConvertTo-Json -InputObject @($metrics) -Compress) -ContentType 'application/json' | Out-Null
+if ($spotRequest -and ('failed', 'shutdown') -contains $phase) {Stop-EC2SpotInstanceRequest -SpotInstanceRequestId $spotRequest -Force | Out-Null}
+}
+$bootTime = (Get-CimInstance Win32_OperatingSystem).LastBootUpTime.ToUniversalTime()
+Write-Phase 'boot' $bootTime
+Write-Phase 'userdata' $userdataTime
+"""
+
+"""
+TransferLoader: Part of the UserData scripts. It loads the functions of TransferScript, which is stored in S3 next to the job.
+"""
+TransferLoader = """Read-S3Object -BucketName $bucket -Key "{key}" -File "$env:TEMP/transfer.ps1" | Out-Null
+. ([ScriptBlock]::Create((Get-Content "$env:TEMP/transfer.ps1" -Raw)))
+"""
+
+"""
+TransferScript: The PowerShell functions the UserData scripts load with TransferLoader. Receive-S3Prefix downloads the job
+files with ranged GETs, many parts of many files at a time (Read-S3Object fetches one file after the other). Test-JobFiles
+checks them against the checksums in the job's manifest (FileChecks), several files at a time. Invoke-MaxQuant runs
+MaxQuant with checkpoints on a spot job server. Send-Results
+uploads the results: the parts of the combined folder the job stores unzipped (see unzippedPolicy) as separate objects
+and all of it as the results bundle, zipped in memory straight into a multipart upload (S3UploadStream) instead of
+being written to a zip file and read back.
+"""
+TransferScript = """Add-Type -AssemblyName System.IO.Compression, System.IO.Compression.FileSystem
+if (-not ('S3UploadStream' -as [type])) {{
+Add-Type -ReferencedAssemblies (@([Amazon.S3.AmazonS3Client].Assembly.Location, [Amazon.Runtime.AmazonServiceClient].Assembly.Location, 'System.Core') | Select-Object -Unique) -TypeDefinition @'
+using System;
+using System.Collections.Concurrent;
+using System.Collections.Generic;
+using System.IO;
+using System.Linq;
+using System.Security.Cryptography;
+using System.Threading;
+using System.Threading.Tasks;
+using Amazon.S3;
+using Amazon.S3.Model;
+
+// A write-only stream that sends what is written to it to S3 as a multipart upload: each part is sent as soon as it
+// is full, with at most 'workers' parts in flight (writes wait for a free slot)
+public class S3UploadStream : Stream
+{{
+    private IAmazonS3 client;
+    private string bucket, key, uploadId;
+    private int partSize;
+    private long written;
+    private MemoryStream buffer;
+    private SemaphoreSlim slots;
+    private List<Task<PartETag>> parts = new List<Task<PartETag>>();
+
+    public S3UploadStream(IAmazonS3 client, string bucket, string key, int partSize, int workers)
+    {{
+        this.client = client;
+        this.bucket = bucket;
+        this.key = key;
+        this.partSize = partSize;
+        InitiateMultipartUploadRequest request = new InitiateMultipartUploadRequest();
+        request.BucketName = bucket;
+        request.Key = key;
+        uploadId = client.InitiateMultipartUpload(request).UploadId;
+        buffer = new MemoryStream(partSize);
+        slots = new SemaphoreSlim(workers);
+    }}
+
+    public override bool CanRead {{ get {{ return false; }} }}
+    public override bool CanSeek {{ get {{ return false; }} }}
+    public override bool CanWrite {{ get {{ return true; }} }}
+    public override long Length {{ get {{ return written; }} }}
+    public override long Position {{ get {{ return written; }} set {{ throw new NotSupportedException(); }} }}
+    public override void Flush() {{ }}
+    public override int Read(byte[] data, int offset, int count) {{ throw new NotSupportedException(); }}
+    public override long Seek(long offset, SeekOrigin origin) {{ throw new NotSupportedException(); }}
+    public override void SetLength(long length) {{ throw new NotSupportedException(); }}
+
+    public override void Write(byte[] data, int offset, int count)
+    {{
+        while (count > 0)
+        {{
+            int n = Math.Min(count, partSize - (int)buffer.Length);
+            buffer.Write(data, offset, n);
+            offset += n;
+            count -= n;
+            written += n;
+            if (buffer.Length == partSize)
+                SendPart();
+        }}
+    }}
+
+    private void SendPart()
+    {{
+        foreach (Task<PartETag> sent in parts)
+            if (sent.IsFaulted)
+                throw sent.Exception.InnerException;
+        slots.Wait();
+        MemoryStream part = buffer;
+        int number = parts.Count + 1;
+        buffer = new MemoryStream(partSize);
+        parts.Add(Task.Run(() => {{
+            try
+            {{
+                part.Position = 0;
+                UploadPartRequest request = new UploadPartRequest();
+                request.BucketName = bucket;
+                request.Key = key;
+                request.UploadId = uploadId;
+                request.PartNumber = number;
+                request.PartSize = part.Length;
+                request.InputStream = part;
+                return new PartETag(number, client.UploadPart(request).ETag);
+            }}
+            finally
+            {{
+                slots.Release();
+            }}
+        }}));
+    }}
+
+    // Send the last part and complete the upload
+    public void Complete()
+    {{
+        if (buffer.Length > 0 || parts.Count == 0)
+            SendPart();
+        Task.WaitAll(parts.ToArray());
+        CompleteMultipartUploadRequest request = new CompleteMultipartUploadRequest();
+        request.BucketName = bucket;
+        request.Key = key;
+        request.UploadId = uploadId;
+        request.AddPartETags(parts.Select(p => p.Result));
+        client.CompleteMultipartUpload(request);
+    }}
+
+    // Give up on the upload so S3 doesn't keep its parts
+    public void Abort()
+    {{
+        try {{ Task.WaitAll(parts.ToArray()); }} catch (AggregateException) {{ }}
+        AbortMultipartUploadRequest request = new AbortMultipartUploadRequest();
+        request.BucketName = bucket;
+        request.Key = key;
+        request.UploadId = uploadId;
+        client.AbortMultipartUpload(request);
+    }}
+}}
+
+// Checks files against their SHA-256 checksums, 'workers' files at a time. No more files are started once one is
+// missing or differs; returns the names of those found.
+public static class FileChecks
+{{
+    public static string[] Mismatches(string folder, string[] names, string[] checksums, int workers)
+    {{
+        ConcurrentBag<string> bad = new ConcurrentBag<string>();
+        ParallelOptions options = new ParallelOptions();
+        options.MaxDegreeOfParallelism = workers;
+        Parallel.For(0, names.Length, options, (i, loop) => {{
+            string path = Path.Combine(folder, names[i]);
+            string checksum = null;
+            if (File.Exists(path))
+                using (SHA256 sha = SHA256.Create())
+                using (FileStream file = new FileStream(path, FileMode.Open, FileAccess.Read, FileShare.Read, 1048576))
+                    checksum = BitConverter.ToString(sha.ComputeHash(file)).Replace("-", "").ToLowerInvariant();
+            if (checksum != checksums[i])
+            {{
+                bad.Add(names[i]);
+                loop.Stop();
+            }}
+        }});
+        return bad.ToArray();
+    }}
+}}
+'@
+}}
+$transferPartSize = {partSize}
+$transferWorkers = {workers}
+$s3Client = New-Object Amazon.S3.AmazonS3Client([Amazon.RegionEndpoint]::GetBySystemName('{region}'))
+$transferPool = [RunspaceFactory]::CreateRunspacePool(1, $transferWorkers)
+$transferPool.Open()
+# Download one range of an object into its place in the (already sized) file, trying three times
+$receivePart = @'
+param($client, $bucket, $key, $path, $first, $last)
+for ($attempt = 1; ; $attempt++) {{
+try {{
+$request = New-Object Amazon.S3.Model.GetObjectRequest
+$request.BucketName = $bucket
+$request.Key = $key
+$request.ByteRange = New-Object Amazon.S3.Model.ByteRange($first, $last)
+$response = $client.GetObject($request)
+$file = New-Object IO.FileStream($path, [IO.FileMode]::Open, [IO.FileAccess]::Write, [IO.FileShare]::ReadWrite)
+try {{
+$file.Seek($first, [IO.SeekOrigin]::Begin) | Out-Null
+$response.ResponseStream.CopyTo($file, 1048576)
+}}
+finally {{
+$file.Close()
+$response.Dispose()
+}}
+return
+}}
+catch {{
+if ($attempt -ge 3) {{throw}}
+Start-Sleep -Seconds (5 * $attempt)
+}}
+}}
+'@
+# Download the objects under a prefix (only the named ones, relative to the prefix, if $only is given) into a folder:
+# every object is split into parts and all of the parts are downloaded $transferWorkers at a time. Returns $false if
+# any part could not be downloaded.
+function Receive-S3Prefix($prefix, $folder, $only) {{
+$tasks = New-Object System.Collections.ArrayList
+foreach ($object in Get-S3Object -BucketName $bucket -KeyPrefix "$prefix/") {{
+$name = $object.Key.Substring($prefix.Length + 1)
+if (-not $name -or $name.EndsWith('/') -or ($only -and $only -notcontains $name)) {{continue}}
+$path = Join-Path $folder $name
+New-Item -ItemType Directory -Path (Split-Path $path) -Force | Out-Null
+$file = [IO.File]::Create($path)
+$file.SetLength($object.Size)
+$file.Close()
+for ($first = 0; $first -lt $object.Size; $first += $transferPartSize) {{
+$last = [Math]::Min($first + $transferPartSize, $object.Size) - 1
+$ps = [PowerShell]::Create().AddScript($receivePart).AddArgument($s3Client).AddArgument($bucket).AddArgument($object.Key).AddArgument($path).AddArgument($first).AddArgument($last)
+$ps.RunspacePool = $transferPool
+$tasks.Add(@{{ps = $ps; handle = $ps.BeginInvoke()}}) | Out-Null
+}}
+}}
+$ok = $true
+foreach ($task in $tasks) {{
+try {{$task.ps.EndInvoke($task.handle) | Out-Null}}
+catch {{
+Write-Host -ForegroundColor Red "Download failed: $_"
+$ok = $false
+}}
+$task.ps.Dispose()
+}}
+return $ok
+}}
+# Check the job files in a folder (only the named ones if $names is given) against the SHA-256 checksums mqsubmit
+# computed as it uploaded them (jobCtrl/manifest.json), one file per core at a time. Returns the names of the files that
+# are missing or differ; a job submitted without a manifest is not checked.
+function Test-JobFiles($folder, $names) {{
+$manifestFile = Join-Path $folder '{manifest}'
+if (-not (Test-Path $manifestFile)) {{
+Write-Host "The job has no checksum manifest, its files are not checked"
+return @()
+}}
+$manifest = Get-Content $manifestFile -Raw | ConvertFrom-Json
+$files = @($manifest.files.PSObject.Properties | Where-Object {{-not $names -or $names -contains $_.Name}})
+Write-Host "Checking the checksums of $($files.Count) job file(s)"
+return [FileChecks]::Mismatches($folder, [string[]]@($files | ForEach-Object {{$_.Name}}), [string[]]@($files | ForEach-Object {{$_.Value.sha256}}), [Environment]::ProcessorCount)
+}}
+# Run MaxQuant on a spot job server (from $firstStep for a sharded job), keeping a checkpoint of the last step it finished
+# in jobCtrl/checkpoint.json, in the job directory and in S3, as the steps finish (a line each in #runningTimes.txt).
+# After an interruption MaxQuant continues from the step after the checkpoint. EC2's notice of the interruption, two
+# minutes ahead, is logged.
+function Invoke-MaxQuant($folder, $firstStep) {{
+$checkpointFile = Join-Path $folder 'jobCtrl/checkpoint.json'
+$times = Join-Path $folder 'combined/proc/#runningTimes.txt'
+$finishedSteps = {{[Math]::Max(@(Get-Content $times -ErrorAction SilentlyContinue).Count - 1, 0)}}
+$start = [Math]::Max([int]$firstStep, 1)
+if ((Test-Path $checkpointFile) -and (Test-Path $times)) {{
+$start = (Get-Content $checkpointFile -Raw | ConvertFrom-Json).step + 1
+Write-Host "Continuing MaxQuant from step $start"
+}}
+$counted = & $finishedSteps
+$step = $start - 1
+$noticed = $false
+$maxquant = Start-Process -FilePath 'C:/MaxQuant/bin/MaxQuantCmd.exe' -ArgumentList "$folder/mqpar.xml --partial-processing=$start" -PassThru -NoNewWindow
+while (-not $maxquant.HasExited) {{
+Start-Sleep -Seconds 30
+$finished = $start - 1 + [Math]::Max((& $finishedSteps) - $counted, 0)
+if ($finished -gt $step) {{
+$step = $finished
+$checkpoint = ConvertTo-Json @{{step = $step; time = (Get-Date).ToUniversalTime().ToString('o')}}
+Set-Content -Path $checkpointFile -Value $checkpoint
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/checkpoint.json" -Content $checkpoint | Out-Null
+}}
+if (-not $noticed) {{
+try {{
+$notice = Invoke-RestMethod 'http://169.254.169.254/latest/meta-data/spot/instance-action' -TimeoutSec 2
+$noticed = $true
+Write-Host "Spot interruption: EC2 will $($notice.action) the job server at $($notice.time), MaxQuant continues from step $($step + 1) when it is started again"
+Write-Phase 'interrupted'
+}}
+catch {{}}
+}}
+}}
+}}
+# Upload the results folder: the subtrees named in $unzipped ('*' for all of it) as separate objects under $prefix,
+# and all of it as the results bundle, zipped straight into a multipart upload (each file is read once and nothing
+# is written to disk). Returns $false if the bundle could not be uploaded.
+function Send-Results($folder, $prefix, $bundleKey, $unzipped) {{
+$root = (Resolve-Path $folder).Path.TrimEnd('\\')
+foreach ($subtree in $unzipped) {{
+$path = Join-Path $root $subtree
+if ($subtree -eq '*') {{Write-S3Object -BucketName $bucket -KeyPrefix $prefix -Folder $root -Recurse | Out-Null}}
+elseif (Test-Path $path -PathType Container) {{Write-S3Object -BucketName $bucket -KeyPrefix "$prefix/$subtree" -Folder $path -Recurse | Out-Null}}
+elseif (Test-Path $path -PathType Leaf) {{Write-S3Object -BucketName $bucket -Key "$prefix/$subtree" -File $path | Out-Null}}
+}}
+$upload = New-Object S3UploadStream($s3Client, $bucket, $bundleKey, $transferPartSize, $transferWorkers)
+try {{
+$zip = New-Object IO.Compression.ZipArchive($upload, [IO.Compression.ZipArchiveMode]::Create, $true)
+foreach ($file in Get-ChildItem $root -Recurse | Where-Object {{-not $_.PSIsContainer}}) {{
+$name = $file.FullName.Substring($root.Length + 1).Replace('\\', '/')
+[IO.Compression.ZipFileExtensions]::CreateEntryFromFile($zip, $file.FullName, $name, [IO.Compression.CompressionLevel]::Fastest) | Out-Null
+}}
+$zip.Dispose()
+$upload.Complete()
+return $true
+}}
+catch {{
+Write-Host -ForegroundColor Red "Results bundle upload failed: $_"
+$upload.Abort()
+return $false
+}}
+}}
+"""
+
+"""
+ShardScript: The PowerShell script run by the job server of one shard of a sharded job (mqsubmit --shards). It waits for
+the upload, downloads the shard's configuration and raw files, runs the per-file steps of MaxQuant up to the last shard
+step (looked up by name in the MaxQuantCmd --dryrun step list), uploads the per-file output folders and flags the shard
+as finished (or failed) for the job server that gathers the shards.
+"""
+ShardScript = """<powershell>
+$userdataTime = (Get-Date).ToUniversalTime()
+$bucket = '{bucket}'
+$jobFolder = '{jobFolder}'
+$shard = '{shard}'
+$metricsName = "shard-$shard"
+# Set the local Administrator password
+$ComputerName = $env:COMPUTERNAME
+$user = [adsi]"WinNT://$ComputerName/Administrator,user"
+$user.setpassword("{password}")
+# Disable the Windows Firewall
+Get-NetFirewallProfile | Set-NetFirewallProfile Enabled False -Confirm:$false
+Rename-Computer -NewName "maxquant-$jobFolder-$shard" -Force
+Import-Module AwsPowerShell
+{metrics}{transfer}{scratch}Write-Phase 'install'
+{install}Write-Phase 'waitReady'
+$readyDeadline = (Get-Date).AddHours({readyTimeout})
+while (-not (Get-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/ready.txt")) {{
+if ((Get-Date) -gt $readyDeadline) {{
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/shards/$shard.failed" -Content "upload did not finish within {readyTimeout} hours"
+Write-Phase 'failed'
+Stop-Computer -Force -Confirm:$false
+exit 1
+}}
+Write-Host "Waiting for job upload to finish"
+Start-Sleep -Seconds 30
+}}
+Write-Phase 'download'
+Write-Host "Downloading shard $shard of the job from S3: $bucket/$jobFolder"
+New-Item -ItemType Directory -Path 'C:/mq-job' -Force | Out-Null
+Read-S3Object -BucketName $bucket -Key "$jobFolder/{shardConfig}" -File 'C:/mq-job/mqpar.xml'
+if (-not (Receive-S3Prefix $jobFolder 'C:/mq-job' @({shardFiles}))) {{
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/shards/$shard.failed" -Content "the shard's files could not be downloaded"
+Write-Phase 'failed'
+Stop-Computer -Force -Confirm:$false
+exit 1
+}}
+{decompress}{verify}foreach ($conf in 'databases.xml', 'modifications.xml') {{
+if (Get-S3Object -BucketName $bucket -Key "$jobFolder/$conf") {{Read-S3Object -BucketName $bucket -Key "$jobFolder/$conf" -File "C:/MaxQuant/bin/conf/$conf" | Out-Null}}
+}}
+$lastStep = C:/MaxQuant/bin/MaxQuantCmd.exe C:/mq-job/mqpar.xml --dryrun | Where-Object {{$_ -match '^\\s*(\\d+)\\s.*{lastStep}\\s*$'}} | ForEach-Object {{[int]$Matches[1]}} | Select-Object -Last 1
+if (-not $lastStep) {{
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/shards/$shard.failed" -Content "MaxQuant has no '{lastStep}' step"
+Write-Phase 'failed'
+Stop-Computer -Force -Confirm:$false
+exit 1
+}}
+Write-Phase 'maxquant'
+Write-Host "Starting MaxQuant steps 1-$lastStep for shard $shard"
+C:/MaxQuant/bin/MaxQuantCmd.exe C:/mq-job/mqpar.xml --partial-processing-end=$lastStep
+Write-Phase 'uploadResults'
+Write-Host "Uploading the per-file results of shard $shard to S3"
+foreach ($output in @({shardOutputs})) {{
+if (Test-Path "C:/mq-job/$output") {{Write-S3Object -BucketName $bucket -KeyPrefix "$jobFolder/{shardPrefix}/$shard/$output" -Folder "C:/mq-job/$output" -Recurse}}
+}}
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/shards/$shard.done" -Content "$lastStep"
+Write-Phase 'shutdown'
+Write-Host "All Done! Shutting down server..."
+Stop-Computer -Force -Confirm:$false
+</powershell>
+"""
+
+"""
+ShardWaitScript: Part of the UserData script of the job server of a sharded job. Before it takes the ready flag it waits
+for all of the shards to finish; if one of them failed the job is flagged as failed and the server shuts down.
+"""
+ShardWaitScript = """Write-Phase 'waitShards'
+Write-Host "Waiting for the {shards} shard(s) of the job to finish"
+while (@(Get-S3Object -BucketName $bucket -KeyPrefix "$jobFolder/jobCtrl/shards/" | Where-Object {{$_.Key -like '*.done'}}).Count -lt {shards}) {{
+if (Get-S3Object -BucketName $bucket -KeyPrefix "$jobFolder/jobCtrl/shards/" | Where-Object {{$_.Key -like '*.failed'}}) {{
+Write-Host -ForegroundColor Red "A shard of the job failed"
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/failed.txt" -Content "a shard of the job failed, see jobCtrl/shards"
+Write-Phase 'failed'
+Stop-Computer -Force -Confirm:$false
+exit 1
+}}
+Start-Sleep -Seconds 60
+}}
+"""
+
+"""
+ShardMergeScript: Part of the UserData script of the job server of a sharded job. It moves the per-file output folders
+of the shards next to the raw files and picks the step to continue the job from.
+"""
+ShardMergeScript = """Write-Phase 'mergeShards'
+Write-Host "Gathering the per-file results of the shards"
+foreach ($shardDir in Get-ChildItem 'C:/mq-job/{shardPrefix}' -Directory) {{
+robocopy $shardDir.FullName 'C:/mq-job' /E /MOVE | Out-Null
+}}
+$firstStep = 1 + (C:/MaxQuant/bin/MaxQuantCmd.exe C:/mq-job/mqpar.xml --dryrun | Where-Object {{$_ -match '^\\s*(\\d+)\\s.*{lastStep}\\s*$'}} | ForEach-Object {{[int]$Matches[1]}} | Select-Object -Last 1)
+"""
+
 """
 UserDataScipt: This is the PowerShell script that will be run on the Windows instance running in EC2. This script is the entire automation of the
 remote process including installing software, pulling data, running the maxquant job, saving results and sending email to user.
 """
 UserDataScript = """<powershell>
+$userdataTime = (Get-Date).ToUniversalTime()
 $bucket = '{bucket}'
 $jobFolder = '{jobFolder}'
 $jobContact = '{jobContact}'
+$metricsName = 'worker'
 # Set the local Administrator password
 $ComputerName = $env:COMPUTERNAME
 $user = [adsi]"WinNT://$ComputerName/Administrator,user"
@@ -443,47 +3238,65 @@ Set-ItemProperty -Path $reg -Name legalnoticetext -Type STRING -Value $LegalNoti
 #Rename the computer to match the provided instance name are reboot
 Rename-Computer -NewName "maxquant-$jobFolder" -Force
 Import-Module AwsPowerShell
-Write-Host "Testing to see if bucket $bucket is present"
+{metrics}{transfer}{spot}{scratch}Write-Host "Testing to see if bucket $bucket is present"
 if (Test-S3Bucket -BucketName $bucket){{
+Write-Phase 'install'
+{install}{shardWait}# In a pipelined submit the job files may still be uploading; wait (with backoff) for the ready flag
+Write-Phase 'waitReady'
+$readyDelay = 5
+$readyDeadline = (Get-Date).AddHours({readyTimeout})
+while (-not $restarted -and -not (Get-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/ready.txt")) {{
+if ((Get-Date) -gt $readyDeadline) {{
+Write-Host -ForegroundColor Red "Gave up waiting for the job upload to finish"
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/failed.txt" -Content "upload did not finish within {readyTimeout} hours"
+Write-Phase 'failed'
+Stop-Computer -Force -Confirm:$false
+exit 1
+}}
+Write-Host "Waiting for job upload to finish, checking again in $readyDelay seconds"
+Start-Sleep -Seconds $readyDelay
+$readyDelay = [Math]::Min($readyDelay * 2, 120)
+}}
 Write-Host "Removing ready flag: $jobFolder/jobCtrl/ready.txt"
 Remove-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/ready.txt" -Force
 Write-Host "Adding running flag: $jobFolder/jobCtrl/running.txt"
 Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/running.txt" -Content "running"
-Write-Host "Downloading Thermo Fisher MSFileReader 3.0SP3"
-Read-S3Object -BucketName 'fredhutch-maxquant' -Key 'MSFileReader_3.0SP3.msi' -File 'C:/MSFileReader_3.0SP3.msi'
-Write-Host "Installing MSFileReader_3.0SP3.msi"
-Start-Process "C:/MSFileReader_3.0SP3.msi" /qn -Wait
-Write-Host "Downloading MaxQuant application"
-Read-S3Object -BucketName 'fredhutch-maxquant' -Key 'MaxQuant_1.6.11.0.zip' -File 'C:/MaxQuant_1.6.11.0.zip'
-$BackUpPath = 'C:/MaxQuant_1.6.11.0.zip'
-$Destination = 'C:/'
-Write-Host "Unzipping MaxQuant application"
-Add-Type -assembly "system.io.compression.filesystem"
-[io.compression.zipfile]::ExtractToDirectory($BackUpPath, $Destination)
-Write-Host "Downloading job data and configuration from S3: $bucket/$jobFolder"
-Read-S3Object -BucketName $bucket -KeyPrefix "$jobFolder" -Folder 'C:/mq-job'
-if (Test-Path 'C:/mq-job/databases.xml') {{Copy-Item 'C:/mq-job/databases.xml' -Destination 'C:/MaxQuant/bin/conf/'}}
+Write-Phase 'download'
+if ($resume) {{
+Write-Host "Continuing the job from its checkpoint, the job files are still here"
+}}
+elseif (-not (Receive-S3Prefix $jobFolder 'C:/mq-job')) {{
+Write-Host -ForegroundColor Red "Some of the job files could not be downloaded"
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/failed.txt" -Content "the job files could not be downloaded"
+Write-Phase 'failed'
+Stop-Computer -Force -Confirm:$false
+exit 1
+}}
+Write-Phase 'prepare'
+{decompress}{verify}if (Test-Path 'C:/mq-job/databases.xml') {{Copy-Item 'C:/mq-job/databases.xml' -Destination 'C:/MaxQuant/bin/conf/'}}
 if (Test-Path 'C:/mq-job/modifications.xml') {{Copy-Item 'C:/mq-job/modifications.xml' -Destination 'C:/MaxQuant/bin/conf/'}}
+{shardMerge}Write-Phase 'maxquant'
 Write-Host "Starting MaxQuant Job"
-C:/MaxQuant/bin/MaxQuantCmd.exe C:/mq-job/mqpar.xml
-Write-Host "Job complete, uploading job results to S3"
-Write-S3Object -BucketName $bucket -KeyPrefix "$jobFolder/combined" -Folder 'C:/mq-job/combined' -Recurse
+{maxquant}Write-Phase 'uploadResults'
+$resultsBundleFile = "maxquant-${{jobFolder}}-results-combined.zip"
+Write-Host "Job complete, uploading job results to S3 and zipping them into the results bundle on the way: $jobFolder/$resultsBundleFile"
+if (-not (Send-Results 'C:/mq-job/combined' "$jobFolder/combined" "$jobFolder/$resultsBundleFile" @({unzipped}))) {{
+Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/failed.txt" -Content "the results bundle could not be uploaded"
+Write-Phase 'failed'
+Stop-Computer -Force -Confirm:$false
+exit 1
+}}
 Write-Host "Removing running flag: $jobFolder/jobCtrl/running.txt"
 Remove-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/running.txt" -Force
 Write-Host "Adding done flag: $jobFolder/jobCtrl/done.txt"
 Write-S3Object -BucketName $bucket -Key "$jobFolder/jobCtrl/done.txt" -Content "done"
-$resultsBundleFile = "maxquant-${{jobFolder}}-results-combined.zip"
-Write-Host "Creating job result bundle: $resultsBundleFile"
-$resultsBundlePath = "$env:TEMP/$resultsBundleFile"
-Add-Type -assembly "system.io.compression.filesystem"
-[io.compression.zipfile]::CreateFromDirectory("C:/mq-job/combined", $resultsBundlePath)
-Write-Host "Uploading results bundle to S3: $jobFolder/$resultsBundleFile"
-Write-S3Object -BucketName $bucket -Key "$jobFolder/$resultsBundleFile" -File $resultsBundlePath
+Write-Phase 'notify'
 Write-Host "Sending $jobContact a link to download the results from S3"
 $resultsURL = Get-Content -path "C:/mq-job/jobCtrl/resultsUrl.txt"
 $ExpirationDate = (Get-Date).AddDays(30)
 #$resultsURL = Get-S3PreSignedURL -Verb GET -Expires $ExpirationDate -Bucket $bucket -Key "$jobFolder/$resultsBundleFile"
 Send-MailMessage -SmtpServer "smtp.fhcrc.org" -From "maxquant-do-not-reply@fredhutch.org" -Body "Your MaxQuant job results are available for download:`n`n$resultsURL`n`nThis link will expire on $ExpirationDate" -Subject "Maxquant Job Results for job: $jobFolder (30 day download link)" -To $jobContact
+Write-Phase 'shutdown'
 Write-Host "All Done! Shutting down server..."
 Stop-Computer -Force -Confirm:$false
 }}
@@ -491,14 +3304,72 @@ else {{
 Write-Host -ForegroundColor Red "bucket not found"
 }}
 </powershell>
-"""
+{persist}"""
+
+
+def addSubmitOptions(p):
+    """
+    Add the options shared by a single submit and a batch submit: upload tuning, pipelining, images and planning
+    """
+    # Tune the S3 uploads: how many files are sent at once, and the multipart chunk size/concurrency used for each file
+    p.add_option('--upload-workers',  action='store', type='int', dest='uploadWorkers', help='[OPTIONAL] Number of files to upload at the same time (default: 4)')
+    p.add_option('--part-size',  action='store', type='int', dest='partSize', help='[OPTIONAL] Multipart upload chunk size in MB (default: 64)')
+    p.add_option('--part-workers',  action='store', type='int', dest='partWorkers', help='[OPTIONAL] Number of parts of each file to upload at the same time (default: 4)')
+    p.set_defaults(uploadWorkers=4, partSize=64, partWorkers=4)
+
+    # Data and FASTA files are normally stored once in the shared blob store and copied into the job folder
+    p.add_option('--no-dedup',  action='store_false', dest='dedup', help='[OPTIONAL] Upload every file directly to the job folder instead of going through the shared blob store')
+    p.set_defaults(dedup=True)
+
+    # Launch the job server while the files upload so its boot and software install overlap with the upload
+    p.add_option('--pipeline',  action='store_true', dest='pipeline', help='[OPTIONAL] Start the job server while the job files are uploading')
+    p.add_option('--ready-timeout',  action='store', type='int', dest='readyTimeout', help='[OPTIONAL] Hours a pipelined job server waits for the upload to finish before shutting down (default: 24)')
+    p.set_defaults(pipeline=False, readyTimeout=24)
+
+    # Ignore the baked job server image for this MaxQuant version and install the software on a stock Windows image
+    p.add_option('--stock-image',  action='store_true', dest='stockImage', help='[OPTIONAL] Install MaxQuant on a stock Windows image instead of using the pre-built job server image')
+    p.set_defaults(stockImage=False)
+
+    # Choose the instance planner
+    p.add_option('--planner',  action='store', type='choice', choices=sorted(instancePlanners), dest='planner', help='[OPTIONAL] How to pick the instance type and thread count: {0} (default: workload)'.format(', '.join(sorted(instancePlanners))))
+    p.set_defaults(planner='workload')
+
+    # The input files are scanned for problems MaxQuant would fail on before the job is submitted
+    p.add_option('--no-preflight',  action='store_false', dest='preflight', help='[OPTIONAL] Skip the check of the data and FASTA files before submitting')
+    p.set_defaults(preflight=True)
+
+    # Compress the text inputs (mzXML, mzML, FASTA) on the way up; the job server decompresses them
+    p.add_option('--compress',  action='store_true', dest='compress', help='[OPTIONAL] Send mzXML, mzML and FASTA files gzip compressed (RAW files are sent as they are)')
+    p.set_defaults(compress=False)
+
+    # Scatter-gather: run the per-file steps of the job on several job servers, then finish it on one
+    p.add_option('--shards',  action='store', type='int', dest='shards', help='[OPTIONAL] Split the per-file processing of the raw files over this many job servers (default: 1, no sharding)')
+    p.set_defaults(shards=1)
+
+    # Which results the job server also stores as separate files next to the results bundle
+    p.add_option('--unzipped',  action='store', type='string', dest='unzipped', help="[OPTIONAL] Comma separated folders or files of the combined folder to also store unzipped, for 'mqsubmit fetch' (default: txt; '*' for everything, 'none' for only the results bundle)")
+    p.set_defaults(unzipped=defaultUnzipped)
+
+    # Where and how the job server is launched; the options are tried in order until EC2 has one
+    p.add_option('--market',  action='store', type='choice', choices=sorted(launchMarkets), dest='market', help='[OPTIONAL] Launch the job server on-demand, as a spot instance (spot), or as a spot instance if there is one and on-demand if not (spot-first). A spot job server continues from the last finished MaxQuant step after an interruption (default: on-demand)')
+    p.add_option('--instance-types',  action='store', type='string', dest='instanceTypes', help='[OPTIONAL] Comma separated instance types to launch the job server as, in order (default: the planned type and up to {0} equivalent types of other families)'.format(launchTypes - 1))
+    p.add_option('--subnets',  action='store', type='string', dest='subnets', help='[OPTIONAL] Comma separated subnets (availability zones) to launch the job servers in, in order (default: {0})'.format(", ".join(jobSubnets)))
+    p.set_defaults(market='on-demand', instanceTypes=None, subnets=None)
+
+    # Let the scheduler run the job on a shared job server alongside other small jobs
+    p.add_option('--shared',  action='store_true', dest='shared', help='[OPTIONAL] Queue the job to share a job server with other jobs instead of starting a server for it')
+    p.set_defaults(shared=False)
 
 
 if __name__ == "__main__":
 
-    maxquant_ver = "1.6.11.0"
+    # Sub-commands: "mqsubmit <command> [options]"; without one mqsubmit submits a job
+    subcommands = {'bake': bakeCommand, 'batch': batchCommand, 'fetch': fetchCommand, 'metrics': metricsCommand, 'status': statusCommand}
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        subcommands[sys.argv[1]](sys.argv[2:])
+        sys.exit(0)
 
-    p = optparse.OptionParser()
+    p = optparse.OptionParser(usage="%prog [options]\n       %prog bake [options]\n       %prog batch [options] <manifest>\n       %prog fetch [options] <department-jobname>\n       %prog metrics [options] <department-jobname> [...]\n       %prog status [options]")
     
     # Get the filename of the XML formated maxquant configuration file that was generated by the MaxQuant GUI
     p.add_option('-m', '--mqconfig',  action='store', type='string', dest='mqconfig', help='[REQUIRED] Filename of the MaxQuant .XML configuration file')
@@ -517,6 +3388,16 @@ if __name__ == "__main__":
     # the connect option is off by default 
     p.set_defaults(connect=False)
 
+    # Finish a submission that was interrupted part way through, using the transfer journal left in the job directory
+    p.add_option('--resume',  action='store_true', dest='resume', help='[OPTIONAL] Resume an interrupted submission of this job from its transfer journal')
+    p.set_defaults(resume=False)
+
+    # Just show the planner's decision without submitting the job
+    p.add_option('--plan',  action='store_true', dest='plan', help='[OPTIONAL] Print the planned instance type and thread count, and why, without submitting the job')
+    p.set_defaults(plan=False)
+
+    addSubmitOptions(p)
+
     parms, args = p.parse_args()
 
     # Check to see ensure that the requried parameters where provided and that the datafiles exist in the job directory
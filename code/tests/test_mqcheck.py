@@ -0,0 +1,60 @@
+"""
+FASTA preflight checks (mqcheck.scanFasta) with the identifierParseRule of the configuration
+"""
+import mqcheck
+import mqpar
+
+uniprot = b""">sp|P69905|HBA_HUMAN Hemoglobin subunit alpha OS=Homo sapiens OX=9606 GN=HBA1 PE=1 SV=2
+MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHFDLSHGSAQVKGHGKKVADALTNAVAHV
+>sp|P68871|HBB_HUMAN Hemoglobin subunit beta OS=Homo sapiens OX=9606 GN=HBB PE=1 SV=2
+MVHLTPEEKSAVTALWGKVNVDEVGGEALGRLLVVYPWTQRFFESFGDLSTPDAVMGNPKVKAHGKKVLGAFSDGLAHL
+>tr|A0A024R161|A0A024R161_HUMAN Guanine nucleotide-binding protein subunit gamma OS=Homo sapiens
+MSSKTASTNSIAQARRTVQQLRLEASIERIKVSKASADLMSYCEEHARSDPLLIGIPTSENPFKDKKTCIIL
+"""
+
+
+def scan(tmp_path, content, rule):
+    path = tmp_path / "test.fasta"
+    path.write_bytes(content)
+    return mqcheck.scanFile(str(path), rule)
+
+
+def test_default_rule(tmp_path):
+    result = scan(tmp_path, uniprot, None)
+    assert result['problems'] == []
+    assert result['warnings'] == []
+    assert result['stats']['sequences'] == 3
+
+
+def test_unanchored_rule_matches_inside_the_header(tmp_path):
+    # MaxQuant's UniProt rule: the accession between the first two bars, not at the start of the header
+    result = scan(tmp_path, uniprot, r'\|([^|]*)\|')
+    assert result['problems'] == []
+    assert result['warnings'] == []
+    result = scan(tmp_path, uniprot, r'GN=([^ ]*)')
+    assert result['problems'] == ["1 header(s) don't give an identifier with 'GN=([^ ]*)' (line 5)"]
+
+
+def test_unanchored_rule_from_the_configuration(tmp_path):
+    config = tmp_path / "mqpar.xml"
+    config.write_text(u"""<?xml version="1.0" encoding="utf-8"?>
+<MaxQuantParams>
+   <fastaFiles>
+      <FastaFileInfo>
+         <fastaFilePath>D:\\fasta\\test.fasta</fastaFilePath>
+         <identifierParseRule>.*\\|(.*)\\|</identifierParseRule>
+      </FastaFileInfo>
+   </fastaFiles>
+   <filePaths />
+</MaxQuantParams>
+""")
+    rule = mqpar.readConfig(str(config))['fastaRules']['test.fasta']
+    assert rule == r'.*\|(.*)\|'
+    assert scan(tmp_path, uniprot, rule)['problems'] == []
+
+
+def test_unparsed_and_duplicate_identifiers(tmp_path):
+    content = uniprot + b">sp|P69905|HBA_HUMAN again\nMVLS\n>no bars here\nMVLS\n"
+    result = scan(tmp_path, content, r'\|([^|]*)\|')
+    assert result['problems'] == [r"1 header(s) don't give an identifier with '\|([^|]*)\|' (line 9)"]
+    assert result['warnings'] == ["1 duplicate identifier(s) (line 7)"]
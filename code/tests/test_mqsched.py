@@ -0,0 +1,265 @@
+"""
+Scheduler packing, run offline against LocalStore and SimLauncher with a fake clock
+"""
+import json
+
+import pytest
+
+import mqsched
+import mqsubmit
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def store():
+    return mqsched.LocalStore()
+
+
+@pytest.fixture
+def launcher():
+    return mqsched.SimLauncher()
+
+
+@pytest.fixture
+def scheduler(store, launcher, clock):
+    return mqsched.Scheduler(store, launcher, clock=clock, workerType='c5.9xlarge', packWait=300, idleTimeout=900)
+
+
+def queueJob(store, name, cores, memory=1.0, disk=10, queued=0.0, customConf=False, version=mqsubmit.maxquant_ver):
+    job = {'jobFolder': name, 'cores': cores, 'memory': memory, 'disk': disk, 'customConf': customConf,
+        'maxquantVersion': version, 'contactEmail': 'test@example.org', 'queued': queued}
+    store.put("{0}/{1}.json".format(mqsubmit.queuePrefix, name), json.dumps(job))
+    return job
+
+
+def placement(scheduler):
+    return sorted(sorted(worker['jobs']) for worker in scheduler.workers())
+
+
+def test_first_fit_decreasing(scheduler, store, launcher, clock):
+    # First fit in arrival order would give [5, 20, 8] and [16, 4]; with the biggest jobs first 20 + 16 fill a
+    # c5.9xlarge and 8 + 5 + 4 go on a second server
+    for name, cores in [('job5', 5), ('job20', 20), ('job16', 16), ('job8', 8), ('job4', 4)]:
+        queueJob(store, name, cores)
+    clock.now = 300
+    summary = scheduler.tick()
+    assert summary['launched'] == 2
+    assert summary['assigned'] == 5
+    assert placement(scheduler) == [['job16', 'job20'], ['job4', 'job5', 'job8']]
+    assert len(launcher.launched) == 2
+    assert store.list(mqsubmit.queuePrefix + "/") == []
+    for name in ('job5', 'job20', 'job16', 'job8', 'job4'):
+        assert store.get("{0}/jobCtrl/assigned.txt".format(name)) is not None
+
+
+def test_new_servers_shrink_to_the_smallest_type(scheduler, store, clock):
+    queueJob(store, 'job20', 20)
+    queueJob(store, 'job16', 16)
+    queueJob(store, 'job3', 3, memory=5.0)
+    clock.now = 300
+    scheduler.tick()
+    types = dict((tuple(sorted(worker['jobs'])), worker['instanceType']) for worker in scheduler.workers())
+    assert types == {('job16', 'job20'): 'c5.9xlarge', ('job3',): 'c5.xlarge'}
+
+
+def test_queued_jobs_wait_for_company(scheduler, store, launcher, clock):
+    queueJob(store, 'job2', 2)
+    clock.now = 299
+    summary = scheduler.tick()
+    assert summary['waiting'] == 1
+    assert launcher.launched == []
+    clock.now = 300
+    summary = scheduler.tick()
+    assert summary['launched'] == 1
+    assert placement(scheduler) == [['job2']]
+
+
+def test_best_fit_on_running_servers(scheduler, store, clock):
+    roomy = dict(scheduler.newWorker({'cores': 1, 'memory': 1, 'maxquantVersion': mqsubmit.maxquant_ver, 'customConf': False}),
+        id='roomy', instanceId='i-roomy', disk=200)
+    tight = dict(roomy, id='tight', instanceId='i-tight', jobs={})
+    roomy['jobs'] = {'old1': {'jobFolder': 'old1', 'cores': 26, 'memory': 1.0, 'disk': 10}}
+    tight['jobs'] = {'old2': {'jobFolder': 'old2', 'cores': 32, 'memory': 1.0, 'disk': 10}}
+    scheduler.saveWorker(roomy)
+    scheduler.saveWorker(tight)
+    # 3 cores fit on both (10 and 4 free): the one it leaves the fewest cores free on gets it
+    queueJob(store, 'small', 3)
+    summary = scheduler.tick()
+    assert summary['assigned'] == 1
+    assert summary['launched'] == 0
+    jobs = dict((worker['id'], sorted(worker['jobs'])) for worker in scheduler.workers())
+    assert jobs == {'roomy': ['old1'], 'tight': ['old2', 'small']}
+    # 6 cores only fit on the roomy one now
+    queueJob(store, 'medium', 6)
+    scheduler.tick()
+    jobs = dict((worker['id'], sorted(worker['jobs'])) for worker in scheduler.workers())
+    assert jobs == {'roomy': ['medium', 'old1'], 'tight': ['old2', 'small']}
+
+
+def test_fit_worker_type_is_the_smallest_that_fits():
+    maxSpec = mqsubmit.instanceSpec('c5.9xlarge')
+    assert mqsched.fitWorkerType(1, 1.0, maxSpec)['type'] == 'c5.large'
+    # 4GB of memory on a 4GB type leaves nothing for Windows
+    assert mqsched.fitWorkerType(2, 4.0, maxSpec)['type'] == 'm5.large'
+    assert mqsched.fitWorkerType(3, 5.0, maxSpec)['type'] == 'c5.xlarge'
+    assert mqsched.fitWorkerType(8, 40.0, maxSpec)['type'] == 'r5.2xlarge'
+    for cores, memory in [(1, 1.0), (3, 5.0), (8, 40.0), (17, 20.0)]:
+        spec = mqsched.fitWorkerType(cores, memory, maxSpec)
+        vcpu, mem = mqsched.workerCapacity(spec)
+        assert spec['instanceStore'] == 0
+        assert vcpu >= cores and mem >= memory
+        smaller = [s for s in mqsubmit.instanceCatalog if not s['instanceStore'] and (s['vcpu'], s['memory']) < (spec['vcpu'], spec['memory'])]
+        assert not any(s['vcpu'] >= cores and s['memory'] - mqsched.workerOsMemory >= memory for s in smaller)
+
+
+def test_fit_worker_type_falls_back_to_the_largest_allowed():
+    maxSpec = mqsubmit.instanceSpec('c5.9xlarge')
+    assert mqsched.fitWorkerType(40, 1.0, maxSpec) is maxSpec
+    # only the cores are capped: a type with more memory but no more cores is fine
+    assert mqsched.fitWorkerType(8, 100.0, maxSpec)['type'] == 'r5.4xlarge'
+
+
+def test_big_job_gets_a_server_of_its_own(scheduler, store, clock):
+    queueJob(store, 'big', 64, memory=100.0)
+    clock.now = 300
+    scheduler.tick()
+    [worker] = scheduler.workers()
+    assert worker['instanceType'] == 'c5.18xlarge'
+    assert sorted(worker['jobs']) == ['big']
+
+
+def test_idle_server_is_retired_after_the_timeout(scheduler, store, launcher, clock):
+    queueJob(store, 'job2', 2)
+    clock.now = 300
+    scheduler.tick()
+    [worker] = scheduler.workers()
+    store.put("job2/jobCtrl/done.txt", "done")
+    clock.now = 1000
+    summary = scheduler.tick()
+    assert summary['finished'] == 1
+    assert summary['retired'] == 0
+    [worker] = scheduler.workers()
+    assert worker['jobs'] == {}
+    assert worker['idleSince'] == 1000
+    clock.now = 1000 + 899
+    assert scheduler.tick()['retired'] == 0
+    clock.now = 1000 + 900
+    assert scheduler.tick()['retired'] == 1
+    assert scheduler.workers() == []
+    assert store.get("{0}/{1}/retire.txt".format(mqsched.workersPrefix, worker['id'])) == "retire"
+
+
+def test_new_job_keeps_an_idle_server(scheduler, store, clock):
+    queueJob(store, 'job2', 2)
+    clock.now = 300
+    scheduler.tick()
+    store.put("job2/jobCtrl/done.txt", "done")
+    clock.now = 1000
+    scheduler.tick()
+    # the server was shrunk to a c5.large for job2
+    queueJob(store, 'next', 2, queued=1500)
+    clock.now = 1500
+    summary = scheduler.tick()
+    assert summary['assigned'] == 1
+    assert summary['launched'] == 0
+    clock.now = 1000 + 900
+    assert scheduler.tick()['retired'] == 0
+    [worker] = scheduler.workers()
+    assert sorted(worker['jobs']) == ['next']
+    assert worker['idleSince'] is None
+
+
+@pytest.mark.parametrize('cores, memory', [(200, 10.0), (8, 1000.0)])
+def test_job_larger_than_any_type_is_rejected(scheduler, store, launcher, clock, cores, memory):
+    queueJob(store, 'huge', cores, memory=memory)
+    queueJob(store, 'job2', 2)
+    clock.now = 300
+    summary = scheduler.tick()
+    assert summary['rejected'] == 1
+    assert summary['launched'] == 1
+    assert placement(scheduler) == [['job2']]
+    assert store.get("huge/jobCtrl/failed.txt") is not None
+    assert store.list(mqsubmit.queuePrefix + "/") == []
+    # nothing is left to retry
+    clock.now = 600
+    summary = scheduler.tick()
+    assert summary['rejected'] == 0
+    assert summary['launched'] == 0
+    assert len(launcher.launched) == 1
+
+
+def test_versions_and_custom_configurations_do_not_share(scheduler, store, clock):
+    queueJob(store, 'a', 2)
+    queueJob(store, 'b', 2, version='1.6.17.0')
+    queueJob(store, 'c', 2, customConf=True)
+    queueJob(store, 'd', 2, customConf=True)
+    clock.now = 300
+    scheduler.tick()
+    assert placement(scheduler) == [['a'], ['b'], ['c'], ['d']]
+
+
+def test_new_servers_get_disk_for_their_jobs(scheduler, store, clock):
+    queueJob(store, 'small', 2, disk=10)
+    queueJob(store, 'a', 4, disk=300)
+    queueJob(store, 'b', 4, disk=250)
+    clock.now = 300
+    scheduler.tick()
+    disks = dict((tuple(sorted(worker['jobs'])), (worker['disk'], worker['volumeSize'])) for worker in scheduler.workers())
+    assert disks == {('a', 'b', 'small'): (560, 560 + mqsched.workerRootDisk)}
+    queueJob(store, 'alone', 2, disk=10, customConf=True)
+    scheduler.tick()
+    [worker] = [w for w in scheduler.workers() if 'alone' in w['jobs']]
+    assert (worker['disk'], worker['volumeSize']) == (mqsched.minWorkerDisk, mqsched.minWorkerDisk + mqsched.workerRootDisk)
+
+
+def test_running_server_volume_does_not_grow(scheduler, store, launcher, clock):
+    queueJob(store, 'small', 2, disk=10)
+    clock.now = 300
+    scheduler.tick()
+    [first] = scheduler.workers()
+    assert first['disk'] == mqsched.minWorkerDisk
+    store.put("small/jobCtrl/done.txt", "done")
+    clock.now = 600
+    scheduler.tick()
+    # the idle server has the cores and memory, but its volume is too small for the job
+    queueJob(store, 'large', 2, disk=800, queued=600)
+    clock.now = 900
+    summary = scheduler.tick()
+    assert summary['launched'] == 1
+    servers = dict((worker['id'], worker) for worker in scheduler.workers())
+    assert servers[first['id']]['jobs'] == {}
+    assert servers[first['id']]['disk'] == mqsched.minWorkerDisk
+    [second] = [w for w in servers.values() if w['id'] != first['id']]
+    assert sorted(second['jobs']) == ['large']
+    assert second['volumeSize'] == 800 + mqsched.workerRootDisk
+    # a job that fits the free disk of a running server still goes there
+    queueJob(store, 'medium', 2, disk=150, queued=900)
+    summary = scheduler.tick()
+    assert summary['launched'] == 0
+    servers = dict((worker['id'], worker) for worker in scheduler.workers())
+    assert sorted(servers[first['id']]['jobs']) == ['medium']
+
+
+def test_disk_of_running_jobs_is_taken(scheduler, store, clock):
+    queueJob(store, 'a', 2, disk=150)
+    clock.now = 300
+    scheduler.tick()
+    [worker] = scheduler.workers()
+    assert worker['disk'] == mqsched.minWorkerDisk
+    # 50GB left: the next job needs more, so it gets a server of its own
+    queueJob(store, 'b', 2, disk=60, queued=300)
+    clock.now = 600
+    assert scheduler.tick()['launched'] == 1
+    assert placement(scheduler) == [['a'], ['b']]
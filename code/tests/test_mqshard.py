@@ -0,0 +1,181 @@
+"""
+Shard planning (mqshard) and the shard configurations written by mqpar, on synthetic mqpar.xml files
+"""
+import re
+import string
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import mqpar
+import mqshard
+import mqsubmit
+
+# The per-file lists of mqpar.xml next to filePaths; spelled out here so a list missing from mqshard.perFileElements shows
+perFileLists = ['experiments', 'fractions', 'ptms', 'paramGroupIndices', 'referenceChannel']
+
+
+def perFileValues(i):
+    """
+    The entries of raw file i in each per-file list, all derived from i so a misaligned list shows
+    """
+    return {'experiments': "exp{0}".format(i), 'fractions': str(i + 1), 'ptms': "True" if i % 3 == 0 else "False",
+        'paramGroupIndices': str(i % 2), 'referenceChannel': "ch{0}".format(i)}
+
+
+def writeMqpar(path, count, fastaRule='>([^\\s]*)'):
+    entry = {'experiments': 'string', 'fractions': 'short', 'ptms': 'boolean', 'paramGroupIndices': 'int', 'referenceChannel': 'string'}
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+        '<MaxQuantParams xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">',
+        '   <fastaFiles>', '      <FastaFileInfo>', '         <fastaFilePath>D:\\fasta\\test.fasta</fastaFilePath>',
+        '         <identifierParseRule>{0}</identifierParseRule>'.format(fastaRule.replace('>', '&gt;')),
+        '      </FastaFileInfo>', '   </fastaFiles>', '   <numThreads>1</numThreads>', '   <filePaths>']
+    lines += ['      <string>D:\\data\\file{0:03d}.raw</string>'.format(i) for i in range(count)]
+    lines.append('   </filePaths>')
+    for name in perFileLists:
+        lines.append('   <{0}>'.format(name))
+        lines += ['      <{0}>{1}</{0}>'.format(entry[name], perFileValues(i)[name]) for i in range(count)]
+        lines.append('   </{0}>'.format(name))
+    lines += ['   <parameterGroups>', '      <parameterGroup>', '         <variableModifications>',
+        '            <string>Oxidation (M)</string>', '         </variableModifications>', '      </parameterGroup>',
+        '   </parameterGroups>', '</MaxQuantParams>']
+    with open(str(path), 'w') as fh:
+        fh.write("\n".join(lines) + "\n")
+    return str(path)
+
+
+def lists(path):
+    root = ET.parse(path).getroot()
+    return dict((name, [e.text for e in root.find(name)]) for name in ['filePaths'] + perFileLists)
+
+
+@pytest.mark.parametrize('count, shards', [(10, 3), (7, 2), (5, 4), (3, 8), (1, 5), (6, 1), (4, 0)])
+def test_split_covers_every_file_once(count, shards):
+    sizes = [(i * 37) % 11 + 1 for i in range(count)]
+    split = mqshard.splitFiles(sizes, shards)
+    assert len(split) == max(min(shards, count), 1)
+    assert all(split)
+    assert sorted(i for part in split for i in part) == list(range(count))
+    for part in split:
+        assert part == sorted(part)
+
+
+def test_split_balances_sizes():
+    sizes = [100, 90, 80, 40, 30, 20, 10, 5, 5]
+    split = mqshard.splitFiles(sizes, 3)
+    # 100 | 90 | 80, then 40 onto 80, 30 onto 90, 20 onto 100, 10 onto the first of three at 120, 5 and 5 onto the others
+    loads = [sum(sizes[i] for i in part) for part in split]
+    assert sorted(loads) == [125, 125, 130]
+
+
+def test_split_equal_sizes_is_even():
+    split = mqshard.splitFiles([1] * 10, 4)
+    assert sorted(len(part) for part in split) == [2, 2, 3, 3]
+
+
+@pytest.mark.parametrize('count, shards', [(10, 3), (7, 2), (3, 8), (6, 1)])
+def test_shard_configs_keep_per_file_lists_aligned(tmp_path, count, shards):
+    config = writeMqpar(tmp_path / "mqpar.xml", count)
+    inventory = mqpar.readConfig(config)
+    assert inventory['datafiles'] == ["file{0:03d}.raw".format(i) for i in range(count)]
+    for name in ['filePaths'] + perFileLists:
+        assert inventory['counts'][name] == count
+
+    sizes = [1000 + 100 * (i % 4) for i in range(count)]
+    plan = mqshard.planShards(inventory['datafiles'], inventory['counts'], sizes, shards)
+    assert [shard['shard'] for shard in plan] == list(range(1, len(plan) + 1))
+    assert len(plan) == min(shards, count)
+    seen = []
+    for shard in plan:
+        target = str(tmp_path / shard['config'])
+        mqpar.writeConfig(config, target, 'C:\\mq-job\\', 4, keep=set(shard['indices']), perFile=mqshard.perFileElements)
+        written = lists(target)
+        assert written['filePaths'] == ['C:\\mq-job\\' + inventory['datafiles'][i] for i in shard['indices']]
+        for name in perFileLists:
+            assert written[name] == [perFileValues(i)[name] for i in shard['indices']], name
+        assert shard['files'] == [inventory['datafiles'][i] for i in shard['indices']]
+        assert shard['outputs'] == [f[:-len('.raw')] for f in shard['files']]
+        assert shard['size'] == sum(sizes[i] for i in shard['indices'])
+
+        root = ET.parse(target).getroot()
+        assert root.find('numThreads').text == '4'
+        assert root.find('fastaFiles/FastaFileInfo/fastaFilePath').text == 'C:\\mq-job\\test.fasta'
+        assert len(root.find('parameterGroups')) == 1
+        assert mqpar.readConfig(target)['counts']['filePaths'] == len(shard['indices'])
+        seen.extend(shard['files'])
+    assert sorted(seen) == inventory['datafiles']
+
+
+def test_unsharded_config_keeps_everything(tmp_path):
+    config = writeMqpar(tmp_path / "mqpar.xml", 5)
+    target = str(tmp_path / "out.xml")
+    mqpar.writeConfig(config, target, 'C:\\mq-job\\', 2)
+    written = lists(target)
+    for name in perFileLists:
+        assert written[name] == [perFileValues(i)[name] for i in range(5)]
+
+
+def test_plan_rejects_misaligned_lists():
+    files = ["a.raw", "b.raw", "c.raw"]
+    with pytest.raises(ValueError, match="experiments"):
+        mqshard.planShards(files, {'filePaths': 3, 'experiments': 2}, [1, 1, 1], 2)
+    with pytest.raises(ValueError, match="file sizes"):
+        mqshard.planShards(files, {'filePaths': 3}, [1, 1], 2)
+    # lists MaxQuant leaves out are fine
+    assert len(mqshard.planShards(files, {'filePaths': 3}, [1, 1, 1], 2)) == 2
+
+
+def test_plan_rejects_shared_output_folders():
+    with pytest.raises(ValueError, match="output folder"):
+        mqshard.planShards(["a.raw", "A.mzXML"], {'filePaths': 2}, [1, 1], 2)
+
+
+# What MaxQuantCmd --dryrun lists: the step numbers depend on the configuration
+dryrun = """Processing steps:
+  1  Configuring
+  2  Testing raw files
+  3  Feature detection
+  4  Deisotoping
+  5  Preparing mass recalibration
+  6  MS/MS preparation
+  7  Calculating peak properties
+  8  Combining apl files for first search
+  9  Preparing searches
+ 10  MS/MS first search
+ 11  Read search results for recalibration
+ 12  Mass recalibration
+ 13  Calculating masses
+ 14  MS/MS preparation for main search
+ 15  Combining apl files for main search
+ 16  MS/MS main search
+ 17  Preparing combined folder
+"""
+
+
+def stepLookup(script):
+    """
+    The step number the job server's PowerShell finds in the dryrun listing: the last line -match (which ignores case)
+    accepts, as in "Where-Object {$_ -match ...} | Select-Object -Last 1"
+    """
+    pattern = re.search(r"-match '([^']*)'", script).group(1)
+    steps = [int(m.group(1)) for m in (re.match(pattern, line, re.IGNORECASE) for line in dryrun.splitlines()) if m]
+    return steps[-1] if steps else None
+
+
+def formatted(template, **fields):
+    names = set(name for _, name, _, _ in string.Formatter().parse(template) if name)
+    return template.format(**dict(dict((name, "") for name in names), **fields))
+
+
+def test_partial_processing_steps():
+    shardScript = formatted(mqsubmit.ShardScript, lastStep=mqshard.shardLastStep, shardPrefix=mqshard.shardPrefix)
+    mergeScript = mqsubmit.ShardMergeScript.format(lastStep=mqshard.shardLastStep, shardPrefix=mqshard.shardPrefix)
+    # the shards stop after mass recalibration (not at "Preparing mass recalibration")...
+    assert stepLookup(shardScript) == 12
+    assert "--partial-processing-end=$lastStep" in shardScript
+    # ...and the job server that gathers them continues with the step after it
+    assert stepLookup(mergeScript) == 12
+    assert "$firstStep = 1 + (" in mergeScript
+    finish = formatted(mqsubmit.UserDataScript, shardMerge=mergeScript, maxquantArgs=" --partial-processing=$firstStep",
+        maxquant="C:/MaxQuant/bin/MaxQuantCmd.exe C:/mq-job/mqpar.xml --partial-processing=$firstStep\n")
+    assert finish.index("$firstStep = 1 + (") < finish.index("mqpar.xml --partial-processing=$firstStep")